@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Compares two results files written by run.py or by micro.py, see
+README.md.
+"""
+import argparse
+import json
+import sys
+
+# compared metrics of run.py and micro.py: name, value of a result and
+# direction of an improvement (-1 when lower is better)
+RUN_METRICS = [
+    ('p50 ms', lambda r: r['latency_ms']['p50'], -1),
+    ('p99 ms', lambda r: r['latency_ms']['p99'], -1),
+    ('req/s', lambda r: r['throughput'], 1)]
+
+MICRO_METRICS = [
+    ('median ms', lambda r: r['median_ms'], -1),
+    ('peak bytes', lambda r: r['peak_bytes'], -1)]
+
+
+def load(filename):
+    """
+    Returns the content of a results file and its results by key
+    """
+    with open(filename, 'r') as f:
+        content = json.load(f)
+    runs = {}
+    for result in content['results']:
+        runs[result_key(result)] = result
+    return [content, runs]
+
+
+def result_key(result):
+    if 'case' in result:
+        return (result['case'], result['points'])
+    return (result['endpoint'], result['depth'] or 0, result['concurrency'])
+
+
+def change(base, new):
+    """
+    Returns the relative change in percent from base to new
+    """
+    if not base or new is None:
+        return None
+    return (new - base) * 100.0 / base
+
+
+def regressions(base, new, metrics, threshold):
+    """
+    Returns the metrics of a run which are worse than base by more than
+    threshold percent
+    """
+    worse = []
+    for [name, value, direction] in metrics:
+        delta = change(value(base), value(new))
+        if delta is not None and -direction * delta > threshold:
+            worse.append(name)
+    if new.get('errors', 0) > base.get('errors', 0):
+        worse.append('errors')
+    return worse
+
+
+def format_change(delta):
+    return '' if delta is None else '{0:+.1f}%'.format(delta)
+
+
+if __name__ == '__main__':
+
+    # arg parse
+    descr = 'Compare the results of two runs of the benchmarks'
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument('base', type=str, help='results of the reference')
+    parser.add_argument('new', type=str, help='results to compare')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='change in percent reported as a regression')
+
+    args = parser.parse_args()
+
+    [base_content, base_runs] = load(args.base)
+    [new_content, new_runs] = load(args.new)
+
+    micro = any('case' in result for result in new_content['results'])
+    metrics = MICRO_METRICS if micro else RUN_METRICS
+
+    print("{0} -> {1}".format(base_content['label'], new_content['label']))
+    print("{0:32} ".format('') + ' '.join(
+        "{0:>12} {1:>8}".format(name, '') for name, value, d in metrics))
+
+    failed = False
+    for key in sorted(new_runs):
+        if key not in base_runs:
+            continue
+        [base, new] = [base_runs[key], new_runs[key]]
+
+        worse = regressions(base, new, metrics, args.threshold)
+        failed = failed or bool(worse)
+
+        print("{0:32} ".format(' '.join(str(k) for k in key)) + ' '.join(
+            "{0!s:>12} {1:>8}".format(
+                value(new), format_change(change(value(base), value(new))))
+            for name, value, d in metrics) + ' ' + ' '.join(worse))
+
+    # non zero exit status on regressions, for scripts
+    sys.exit(1 if failed else 0)
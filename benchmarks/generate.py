@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Generates a synthetic point cloud and loads it in a local pgpointcloud
+database along with a configuration file for lopocs, see README.md.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+
+import numpy as np
+import psycopg2
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DBBUILDER = os.path.join(ROOT, 'tools', 'dbbuilder')
+
+# pcids of the output schemas, see tools/dbbuilder
+POTREE_SCH_PCID_SCALE_01 = 2
+POTREE_SCH_PCID_SCALE_001 = 3
+
+# points generated and copied at once
+CHUNK_SIZE = 1000000
+
+STAGING_COLUMNS = ('cell', 'n', 'x', 'y', 'z', 'intensity', 'classification',
+                   'red', 'green', 'blue')
+
+
+def connect(args, dbname=None):
+    return psycopg2.connect(dbname=dbname or args.db, user=args.user,
+                            password=args.password, host=args.host,
+                            port=args.port)
+
+
+def bounds(args):
+    """
+    Returns the extent [xmin, ymin, zmin, xmax, ymax, zmax] of the cloud
+    """
+    side = math.sqrt(args.points / args.density)
+    [x, y, z] = args.origin
+    return [x, y, z, x + side, y + side, z + args.height]
+
+
+def lod_max(patch_size):
+    """
+    Returns the number of levels of detail needed to read every point of a
+    patch, a level reading 4^lod points (see greyhound.points_range)
+    """
+    depth = 0
+    npoints = 0
+    while npoints < patch_size:
+        npoints += pow(4, depth)
+        depth += 1
+    return depth
+
+
+def generate_points(rng, count, box, amplitude):
+    """
+    Returns count points spread over box: a wavy ground (class 2) with
+    some vegetation (class 5) and buildings (class 6) above it
+    """
+    x = rng.uniform(box[0], box[3], count)
+    y = rng.uniform(box[1], box[4], count)
+
+    wavelength = max(box[3] - box[0], 1.0) / 4
+    ground = amplitude * (np.sin(x / wavelength) + np.cos(y / wavelength))
+    classification = rng.choice([2, 5, 6], count, p=[0.7, 0.2, 0.1])
+    top = max(box[5] - box[2] - 4 * amplitude, 0)
+    height = np.where(classification == 2, 0, rng.uniform(0, top, count))
+    z = box[2] + 2 * amplitude + ground + height + rng.normal(0, 0.05, count)
+
+    shade = (z - box[2]) / max(box[5] - box[2], 1.0)
+    red = (shade * 65535).astype(np.uint16)
+    green = np.where(classification == 5, 40000, red // 2)
+    blue = 65535 - red
+    intensity = rng.randint(0, 4096, count)
+
+    return [x, y, z, intensity, classification, red, green, blue]
+
+
+def copy_points(cur, staging, args, box):
+    """
+    Generates the points by chunks and copies them in the staging table
+    with the cell of the grid of patchs they belong to
+    """
+    rng = np.random.RandomState(args.seed)
+    cell_side = math.sqrt(args.patch_size / args.density)
+    ncols = int(math.ceil((box[3] - box[0]) / cell_side))
+
+    for first in range(0, args.points, CHUNK_SIZE):
+        count = min(CHUNK_SIZE, args.points - first)
+        points = generate_points(rng, count, box, args.amplitude)
+
+        col = ((points[0] - box[0]) // cell_side).astype(np.int64)
+        row = ((points[1] - box[1]) // cell_side).astype(np.int64)
+        cell = row * ncols + col
+        # points are drawn in a random order, so that the first points of
+        # a patch are a coarse sample of it as expected by the lods
+        n = np.arange(first, first + count)
+
+        data = io.StringIO()
+        np.savetxt(data, np.column_stack([cell, n] + points),
+                   fmt=['%d', '%d', '%.3f', '%.3f', '%.3f', '%d', '%d', '%d',
+                        '%d', '%d'], delimiter='\t')
+        data.seek(0)
+        cur.copy_from(data, staging, columns=STAGING_COLUMNS)
+
+        print("{0}/{1} points\r".format(first + count, args.points), end='')
+    print()
+
+
+def schema_sql(filename, args, box, pcid=None, compression=None):
+    """
+    Returns the sql of a schema of tools/dbbuilder with its placeholders
+    replaced, optionally with another pcid and compression
+    """
+    with open(os.path.join(DBBUILDER, filename), 'r') as f:
+        sql = f.read()
+
+    offsets = [(box[i] + box[i + 3]) / 2 for i in range(3)]
+    sql = (sql.replace('!SRID!', str(args.srid))
+           .replace('!XOFFSET!', str(offsets[0]))
+           .replace('!YOFFSET!', str(offsets[1]))
+           .replace('!ZOFFSET!', str(offsets[2])))
+
+    if pcid is not None:
+        sql = re.sub(r'VALUES \(\d+,', 'VALUES ({0},'.format(pcid), sql)
+    if compression is not None:
+        sql = sql.replace('"string"/>none<',
+                          '"string"/>{0}<'.format(compression))
+    return sql
+
+
+def init_database(args, box):
+    if args.createdb:
+        conn = connect(args, 'postgres')
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("drop database if exists {0}".format(args.db))
+            cur.execute("create database {0}".format(args.db))
+        conn.close()
+
+    conn = connect(args)
+    with conn, conn.cursor() as cur:
+        with open(os.path.join(DBBUILDER, 'extensions.sql'), 'r') as f:
+            cur.execute(f.read())
+
+        for [pcid, filename] in [
+                (POTREE_SCH_PCID_SCALE_01, 'potree_schema_scale_01.sql'),
+                (POTREE_SCH_PCID_SCALE_001, 'potree_schema_scale_001.sql')]:
+            cur.execute("select count(*) from pointcloud_formats "
+                        "where pcid = %s", [pcid])
+            if cur.fetchone()[0]:
+                print("schema {0} already defined, kept".format(pcid))
+            else:
+                cur.execute(schema_sql(filename, args, box))
+
+        # patchs are stored with the dimensions of the output schemas and
+        # the compression of the table
+        cur.execute("select greatest(max(pcid), {0}) + 1 "
+                    "from pointcloud_formats"
+                    .format(POTREE_SCH_PCID_SCALE_001))
+        pcid = cur.fetchone()[0]
+        cur.execute(schema_sql('potree_schema_scale_001.sql', args, box,
+                               pcid, args.compression))
+    conn.close()
+
+    return pcid
+
+
+def fill_table(args, box, pcid):
+    staging = "{0}_staging".format(args.table)
+    conn = connect(args)
+    with conn, conn.cursor() as cur:
+        cur.execute("drop table if exists {0}".format(args.table))
+        cur.execute("create table {0} (id serial primary key, "
+                    "{0} pcpatch({1}))".format(args.table, pcid))
+
+        cur.execute("drop table if exists {0}".format(staging))
+        cur.execute("create unlogged table {0} (cell bigint, n bigint, "
+                    "x float8, y float8, z float8, intensity integer, "
+                    "classification integer, red integer, green integer, "
+                    "blue integer)".format(staging))
+        copy_points(cur, staging, args, box)
+
+        cur.execute(
+            "insert into {0}({0}) select pc_patch(pc_makepoint({1}, "
+            "array[x, y, z, intensity, classification, red, green, blue]) "
+            "order by n) from {2} group by cell"
+            .format(args.table, pcid, staging))
+        cur.execute("drop table {0}".format(staging))
+
+        cur.execute("create index on {0} using gist(geometry({0}))"
+                    .format(args.table))
+        cur.execute("select count(*) from {0}".format(args.table))
+        npatchs = cur.fetchone()[0]
+    conn.close()
+
+    # statistics for the planner and the metadata
+    conn = connect(args)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("vacuum analyze {0}".format(args.table))
+    conn.close()
+
+    return npatchs
+
+
+def write_config(args, box, path):
+    with open(os.path.join(DBBUILDER, 'lopocs.yml.tpl'), 'r') as f:
+        tpl = f.read()
+
+    for [name, value] in [
+            ('!TABLE!', args.table), ('!PWD!', args.password or ''),
+            ('!HOST!', args.host), ('!DB!', args.db),
+            ('!UWSGIUSER!', args.user), ('!USER!', args.user),
+            ('!XMIN!', box[0]), ('!YMIN!', box[1]), ('!ZMIN!', box[2]),
+            ('!XMAX!', box[3]), ('!YMAX!', box[4]), ('!ZMAX!', box[5]),
+            ('!LODMAX!', lod_max(args.patch_size))]:
+        tpl = tpl.replace(name, str(value))
+
+    config = yaml.safe_load(tpl)
+    flask = config['flask']
+    flask['DEBUG'] = False
+    flask['LOG_LEVEL'] = 'info'
+    flask['PG_PORT'] = args.port
+    flask['PG_PASSWORD'] = args.password or ''
+    flask['CACHE_DIR'] = os.path.join(args.wdir, 'cache')
+    flask['USE_MORTON'] = not args.no_morton
+    if not args.cache:
+        # every request goes down to the database
+        flask['GREYHOUND_CACHE_SIZE'] = 0
+        flask['THREEDTILES_CACHE_SIZE'] = 0
+        flask['TILE_STORE_SIZE'] = 0
+
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+
+
+if __name__ == '__main__':
+
+    # arg parse
+    descr = ('Generate a synthetic point cloud, load it in a pgpointcloud '
+             'database and write a configuration file for lopocs')
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument('--db', type=str, default='lopocs_bench')
+    parser.add_argument('--user', type=str, default=os.environ.get('USER'))
+    parser.add_argument('--password', type=str, default=None)
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--table', type=str, default='bench')
+    parser.add_argument('--createdb', action='store_true',
+                        help='drop and create the database')
+    parser.add_argument('--points', type=int, default=1000000,
+                        help='number of points')
+    parser.add_argument('--density', type=float, default=10.0,
+                        help='number of points per square meter')
+    parser.add_argument('--patch-size', type=int, default=400,
+                        help='number of points per patch')
+    parser.add_argument('--height', type=float, default=50.0,
+                        help='height of the cloud')
+    parser.add_argument('--amplitude', type=float, default=5.0,
+                        help='amplitude of the waves of the ground')
+    parser.add_argument('--origin', type=float, nargs=3,
+                        default=[650000.0, 6860000.0, 0.0],
+                        help='lower corner of the cloud')
+    parser.add_argument('--srid', type=int, default=2154)
+    parser.add_argument('--compression', type=str, default='laz',
+                        choices=['none', 'dimensional', 'laz'],
+                        help='compression of the patchs in the table')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the caches of lopocs enabled')
+    parser.add_argument('--no-morton', action='store_true',
+                        help='do not compute morton codes')
+    parser.add_argument('--wdir', type=str, default='/tmp/lopocs_bench',
+                        help='directory of the configuration and metadata')
+
+    args = parser.parse_args()
+
+    os.makedirs(args.wdir, exist_ok=True)
+    box = bounds(args)
+
+    print("Init the database...")
+    pcid = init_database(args, box)
+
+    print("Fill the database...")
+    npatchs = fill_table(args, box, pcid)
+    print("  => {0} patchs".format(npatchs))
+
+    print("Build configuration file for lopocs...")
+    cfg = os.path.join(args.wdir, 'lopocs.yml')
+    write_config(args, box, cfg)
+    if not args.no_morton:
+        print("Compute morton codes...")
+        subprocess.check_call([sys.executable, os.path.join(
+            ROOT, 'tools', 'build_grid.py'), cfg])
+
+    # description of the dataset, added to the results of run.py
+    dataset = {
+        "db": args.db,
+        "table": args.table,
+        "points": args.points,
+        "density": args.density,
+        "patch_size": args.patch_size,
+        "patchs": npatchs,
+        "compression": args.compression,
+        "bounds": box,
+        "depth": lod_max(args.patch_size),
+        "seed": args.seed,
+        "cache": args.cache}
+    with open(os.path.join(args.wdir, 'dataset.json'), 'w') as f:
+        json.dump(dataset, f, indent=2)
+
+    print("  => {0}".format(cfg))
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the work done in python on each tile, without
+database: parsing of pcpatchs, laz decompression, building of greyhound
+and pnts tiles, hierarchy assembly and serialization, see README.md.
+"""
+import argparse
+import datetime
+import gc
+import json
+import math
+import os
+import platform
+import struct
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from lazperf import Compressor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lopocs import greyhound, threedtiles, utils  # noqa: E402
+from lopocs.conf import Config  # noqa: E402
+
+from generate import generate_points, lod_max  # noqa: E402
+from run import git_describe  # noqa: E402
+
+SCALE = 0.01
+
+# endianness, pcid, compression (laz) and number of points, then the size
+# of the laz data
+LAZ_PCPATCH_HEADER = struct.Struct('<BIIII')
+
+
+# -----------------------------------------------------------------------------
+# fixtures
+# -----------------------------------------------------------------------------
+class Fixture(object):
+    """
+    Points of a synthetic cloud, as read by lopocs for a tile
+    """
+
+    def __init__(self, npoints, density, seed):
+        rng = np.random.RandomState(seed)
+        side = math.sqrt(npoints / density)
+        self.bbox = [0.0, 0.0, 0.0, side, side, side]
+        self.offset = threedtiles.bbox_center(self.bbox)
+
+        [x, y, z, intensity, classification, red, green, blue] = \
+            generate_points(rng, npoints, self.bbox, 5.0)
+
+        self.points = np.empty(npoints, dtype=greyhound.READ_DTYPE)
+        for [name, values, offset] in [('X', x, self.offset[0]),
+                                       ('Y', y, self.offset[1]),
+                                       ('Z', z, self.offset[2])]:
+            self.points[name] = np.round((values - offset) / SCALE)
+        self.points['Intensity'] = intensity
+        self.points['Classification'] = classification
+        self.points['Red'] = red
+        self.points['Green'] = green
+        self.points['Blue'] = blue
+
+        self.pcpatch_wkb = self.laz_pcpatch(self.points)
+        self.index = self.node_index(x, y, z)
+
+    @staticmethod
+    def laz_pcpatch(points):
+        """
+        Returns points in a laz pcpatch in binary wkb, as read with
+        greyhound.READ_POINTS_SQL
+        """
+        schema = json.dumps(greyhound.GreyhoundReadSchema().json())
+        lazdata = Compressor(schema).compress(points).tobytes()
+        header = LAZ_PCPATCH_HEADER.pack(1, Config.POTREE_SCH_PCID_SCALE_001,
+                                         2, len(points), len(lazdata))
+        return header + lazdata
+
+    def node_index(self, x, y, z):
+        """
+        Returns a greyhound.NodeIndex with the number of points of each node
+        of the octree of the cloud, down to the depth of Config.DEPTH
+        """
+        counts = []
+        for lod in range(0, Config.DEPTH):
+            ncells = pow(2, lod)
+            cells = np.column_stack([
+                np.clip(((values - self.bbox[axis]) * ncells /
+                         (self.bbox[axis + 3] - self.bbox[axis]))
+                        .astype(np.int64), 0, ncells - 1)
+                for [axis, values] in enumerate([x, y, z])])
+            [keys, n] = np.unique(cells, axis=0, return_counts=True)
+            counts.append({tuple(k): int(c)
+                           for [k, c] in zip(keys.tolist(), n.tolist())})
+        return greyhound.NodeIndex(self.bbox, counts)
+
+
+# -----------------------------------------------------------------------------
+# cases
+# -----------------------------------------------------------------------------
+def case_wkb_header(fixture):
+    wkb = fixture.pcpatch_wkb
+
+    def run():
+        utils.npoints_from_wkb_pcpatch(wkb)
+        utils.lazdata_from_wkb_pcpatch(wkb)
+    return [run, len(fixture.points), 'point']
+
+
+def case_greyhound_read(fixture):
+    wkb = fixture.pcpatch_wkb
+    return [lambda: greyhound.encode_points(wkb, 0), len(fixture.points),
+            'point']
+
+
+def case_decompress(fixture):
+    wkb = fixture.pcpatch_wkb
+    return [lambda: greyhound.decompress(wkb), len(fixture.points), 'point']
+
+
+def case_pnts_arrays(fixture):
+    points = fixture.points
+    positions = np.empty((len(points), 3), dtype=np.float32)
+    for [axis, name] in enumerate(['X', 'Y', 'Z']):
+        positions[:, axis] = points[name] * SCALE
+    colors = np.zeros((len(points), 3), dtype=np.uint8)
+    offset = fixture.offset
+    return [lambda: threedtiles.pnts_from_arrays(positions, colors, offset),
+            len(points), 'point']
+
+
+def case_pnts_read(fixture):
+    wkb = fixture.pcpatch_wkb
+    offset = fixture.offset
+    return [lambda: threedtiles.pnts_from_pcpatch(wkb, offset, SCALE),
+            len(fixture.points), 'point']
+
+
+def case_hierarchy(fixture):
+    index = fixture.index
+    nodes = sum(len(counts) for counts in index.counts)
+    return [lambda: index.hierarchy(0, Config.DEPTH - 1, index.bbox),
+            nodes, 'node']
+
+
+def case_hierarchy_json(fixture):
+    index = fixture.index
+    nodes = sum(len(counts) for counts in index.counts)
+    hcy = index.hierarchy(0, Config.DEPTH - 1, index.bbox)
+    return [lambda: json.dumps(hcy), nodes, 'node']
+
+
+CASES = [
+    ('wkb_header', case_wkb_header),
+    ('greyhound_read', case_greyhound_read),
+    ('decompress', case_decompress),
+    ('pnts_arrays', case_pnts_arrays),
+    ('pnts_read', case_pnts_read),
+    ('hierarchy', case_hierarchy),
+    ('hierarchy_json', case_hierarchy_json),
+]
+
+
+# -----------------------------------------------------------------------------
+# measures
+# -----------------------------------------------------------------------------
+def timings(func, min_time, repeat):
+    """
+    Returns the times in seconds of repeat runs of func, each run calling
+    func enough times to last min_time
+    """
+    # first call outside of the measures, buffers are allocated once
+    func()
+
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    times = [elapsed / number]
+    gc.disable()
+    try:
+        for r in range(repeat - 1):
+            t0 = time.perf_counter()
+            for i in range(number):
+                func()
+            times.append((time.perf_counter() - t0) / number)
+    finally:
+        gc.enable()
+    return sorted(times)
+
+
+def allocations(func):
+    """
+    Returns the peak of memory allocated during a call of func, in bytes,
+    numpy arrays included
+    """
+    func()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(name, case, fixture, args):
+    [func, items, unit] = case(fixture)
+    times = timings(func, args.min_time, args.repeat)
+    peak = allocations(func)
+
+    best = times[0]
+    median = times[len(times) // 2]
+    return {
+        "case": name,
+        "points": len(fixture.points),
+        "items": items,
+        "unit": unit,
+        "best_ms": round(best * 1000, 6),
+        "median_ms": round(median * 1000, 6),
+        "ns_per_item": round(median * 1e9 / items, 3),
+        "peak_bytes": peak,
+        "bytes_per_item": round(peak / items, 3)}
+
+
+if __name__ == '__main__':
+
+    # arg parse
+    descr = ('Measure the time and the memory spent in python on tiles '
+             'of synthetic points, without database')
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='number of points of the tiles')
+    parser.add_argument('--cases', type=str, nargs='+',
+                        default=[name for name, case in CASES],
+                        choices=[name for name, case in CASES])
+    parser.add_argument('--density', type=float, default=10.0,
+                        help='number of points per square meter')
+    parser.add_argument('--depth', type=int, default=lod_max(400),
+                        help='depth of the hierarchies')
+    parser.add_argument('--colors', type=str, default='colors',
+                        choices=['colors', 'classif', 'none'],
+                        help='CESIUM_COLOR of pnts tiles')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration in seconds of a measure')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of measures of each case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', type=str, default=None,
+                        help='name of the version under test '
+                        '(git describe by default)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='json file of the results')
+
+    args = parser.parse_args()
+
+    Config.DEPTH = args.depth
+    Config.CESIUM_COLOR = args.colors
+    cases = dict(CASES)
+
+    results = []
+    for size in args.sizes:
+        fixture = Fixture(size, args.density, args.seed)
+        for name in args.cases:
+            result = measure(name, cases[name], fixture, args)
+            results.append(result)
+            print("{0:16} {1:>8} points {2:>12.3f} ms {3:>10.2f} ns/{4:5} "
+                  "{5:>12} bytes peak".format(
+                      name, size, result['median_ms'],
+                      result['ns_per_item'], result['unit'],
+                      result['peak_bytes']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "label": args.label or git_describe(),
+                "date": datetime.datetime.utcnow().isoformat() + 'Z',
+                "host": {"platform": platform.platform(),
+                         "python": platform.python_version(),
+                         "numpy": np.__version__,
+                         "cpus": os.cpu_count()},
+                "parameters": {"density": args.density,
+                               "depth": args.depth,
+                               "colors": args.colors,
+                               "seed": args.seed},
+                "results": results}, f, indent=2)
+        print("  => {0}".format(args.output))
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the latency and the throughput of a running lopocs server for its
+info, hierarchy and read endpoints at several depths of the octree and
+levels of concurrency, see README.md.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# same as greyhound.LOADER_GREYHOUND_MIN_DEPTH, the client only needs http
+LOADER_GREYHOUND_MIN_DEPTH = 8
+
+# levels of the hierarchy requested at once by potree
+HIERARCHY_STEP = 5
+
+# name of the children of an octree node along with their offset in the
+# grid of the next level, as in greyhound.OCTANTS
+OCTANTS = [('nwd', (0, 1, 0)), ('nwu', (0, 1, 1)),
+           ('ned', (1, 1, 0)), ('neu', (1, 1, 1)),
+           ('swd', (0, 0, 0)), ('swu', (0, 0, 1)),
+           ('sed', (1, 0, 0)), ('seu', (1, 0, 1))]
+
+GREYHOUND_SCHEMA = json.dumps([
+    {"name": "X", "size": 4, "type": "signed"},
+    {"name": "Y", "size": 4, "type": "signed"},
+    {"name": "Z", "size": 4, "type": "signed"},
+    {"name": "Intensity", "size": 2, "type": "unsigned"},
+    {"name": "Classification", "size": 1, "type": "unsigned"},
+    {"name": "Red", "size": 2, "type": "unsigned"},
+    {"name": "Green", "size": 2, "type": "unsigned"},
+    {"name": "Blue", "size": 2, "type": "unsigned"}])
+
+ENDPOINTS = ['greyhound_info', 'greyhound_hierarchy', 'greyhound_read',
+             '3dtiles_read']
+
+
+# -----------------------------------------------------------------------------
+# requests
+# -----------------------------------------------------------------------------
+def format_list(values):
+    return '[' + ','.join(str(v) for v in values) + ']'
+
+
+def center(box):
+    return [(box[i] + box[i + 3]) / 2 for i in range(3)]
+
+
+def greyhound_info_url():
+    return '/greyhound/info'
+
+
+def greyhound_hierarchy_url(box, depth, step=HIERARCHY_STEP):
+    return '/greyhound/hierarchy?' + urlencode({
+        'depthBegin': LOADER_GREYHOUND_MIN_DEPTH + depth,
+        'depthEnd': LOADER_GREYHOUND_MIN_DEPTH + depth + step,
+        'bounds': format_list(box)})
+
+
+def greyhound_read_url(box, depth, offset):
+    return '/greyhound/read?' + urlencode({
+        'depthBegin': LOADER_GREYHOUND_MIN_DEPTH + depth,
+        'depthEnd': LOADER_GREYHOUND_MIN_DEPTH + depth + 1,
+        'bounds': format_list(box),
+        'schema': GREYHOUND_SCHEMA,
+        'scale': 0.01,
+        'offset': format_list(offset),
+        'compress': 'true'})
+
+
+def threedtiles_read_url(box, depth, offset):
+    return '/3dtiles/read.pnts?' + urlencode({
+        'v': 1.0,
+        'bounds': format_list(box),
+        'lod': depth,
+        'offsets': format_list(offset),
+        'scale': 0.01})
+
+
+def greyhound_npoints(body):
+    # number of points in the footer of the laz data
+    return struct.unpack('<i', body[-4:])[0] if len(body) >= 4 else 0
+
+
+def pnts_npoints(body):
+    # POINTS_LENGTH of the json feature table following the 28 bytes header
+    if len(body) < 28:
+        return 0
+    length = struct.unpack_from('<I', body, 12)[0]
+    table = json.loads(body[28:28 + length].decode('utf-8'))
+    return table.get('POINTS_LENGTH', 0)
+
+
+def fetch(url, timeout):
+    """
+    Returns the latency in seconds and the body of a request, None for the
+    latency if it failed
+    """
+    t0 = time.perf_counter()
+    try:
+        with urlopen(url, timeout=timeout) as resp:
+            body = resp.read()
+    except (URLError, OSError):
+        return [None, b'']
+    return [time.perf_counter() - t0, body]
+
+
+# -----------------------------------------------------------------------------
+# octree
+# -----------------------------------------------------------------------------
+def child_box(box, octant):
+    half = [(box[i + 3] - box[i]) / 2 for i in range(3)]
+    mins = [box[i] + octant[i] * half[i] for i in range(3)]
+    return mins + [mins[i] + half[i] for i in range(3)]
+
+
+def nodes_at_depth(hierarchy, box, depth):
+    """
+    Returns the bounds of the non empty nodes of hierarchy at depth
+    """
+    if depth == 0:
+        return [box]
+
+    nodes = []
+    for [name, octant] in OCTANTS:
+        if name in hierarchy:
+            nodes.extend(nodes_at_depth(hierarchy[name],
+                                        child_box(box, octant), depth - 1))
+    return nodes
+
+
+def percentile(values, q):
+    # nearest-rank percentile of sorted values
+    if not values:
+        return None
+    rank = max(int(round(q / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+# -----------------------------------------------------------------------------
+# benchmark
+# -----------------------------------------------------------------------------
+def measure(urls, concurrency, timeout, count_points):
+    """
+    Runs the requests with concurrency clients and returns their statistics
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        t0 = time.perf_counter()
+        results = list(executor.map(lambda url: fetch(url, timeout), urls))
+        duration = time.perf_counter() - t0
+
+    latencies = sorted(r[0] for r in results if r[0] is not None)
+    nbytes = sum(len(r[1]) for r in results)
+    npoints = sum(count_points(r[1]) for r in results if r[0] is not None)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "requests": len(urls),
+        "errors": len(urls) - len(latencies),
+        "duration": round(duration, 3),
+        "throughput": round(len(latencies) / duration, 3),
+        "bytes": nbytes,
+        "bytes_per_sec": round(nbytes / duration),
+        "points": npoints,
+        "points_per_sec": round(npoints / duration),
+        "latency_ms": {
+            "min": ms(latencies[0] if latencies else None),
+            "mean": ms(sum(latencies) / len(latencies) if latencies
+                       else None),
+            "p50": ms(percentile(latencies, 50)),
+            "p90": ms(percentile(latencies, 90)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None)}}
+
+
+def requests_for(endpoint, nodes, depth, offset, count, rng):
+    """
+    Returns count paths of requests of endpoint on random nodes
+    """
+    if endpoint == 'greyhound_info':
+        return [greyhound_info_url()] * count
+
+    nodes = [rng.choice(nodes) for i in range(count)]
+    if endpoint == 'greyhound_hierarchy':
+        return [greyhound_hierarchy_url(box, depth) for box in nodes]
+    if endpoint == 'greyhound_read':
+        return [greyhound_read_url(box, depth, offset) for box in nodes]
+    return [threedtiles_read_url(box, depth, offset) for box in nodes]
+
+
+def counter(endpoint):
+    if endpoint == 'greyhound_read':
+        return greyhound_npoints
+    if endpoint == '3dtiles_read':
+        return pnts_npoints
+    return lambda body: 0
+
+
+def git_describe():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).strip().decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+
+    info = json.loads(urlopen(args.url + '/greyhound/info',
+                              timeout=args.timeout).read().decode('utf-8'))
+    bounds = info['bounds']
+    offset = center(bounds)
+
+    # nodes are picked among the non empty ones, as a viewer would do
+    depth_max = max(args.depths)
+    hierarchy = json.loads(urlopen(
+        args.url + greyhound_hierarchy_url(bounds, 0, depth_max + 1),
+        timeout=args.timeout).read().decode('utf-8'))
+
+    results = []
+    for endpoint in args.endpoints:
+        for depth in ([None] if endpoint == 'greyhound_info'
+                      else sorted(args.depths)):
+            nodes = None
+            if depth is not None:
+                nodes = nodes_at_depth(hierarchy, bounds, depth)
+                if not nodes:
+                    print("{0} depth {1}: no node".format(endpoint, depth))
+                    continue
+
+            for concurrency in args.concurrency:
+                paths = requests_for(endpoint, nodes, depth, offset,
+                                     args.warmup + args.requests, rng)
+                urls = [args.url + path for path in paths]
+
+                # warm up the connections and prepared statements
+                measure(urls[:args.warmup], concurrency, args.timeout,
+                        counter(endpoint))
+                stats = measure(urls[args.warmup:], concurrency,
+                                args.timeout, counter(endpoint))
+                stats.update({"endpoint": endpoint, "depth": depth,
+                              "concurrency": concurrency,
+                              "nodes": len(nodes) if nodes else None})
+                results.append(stats)
+
+                print("{0:20} depth {1!s:4} x{2:<3} {3:8.1f} req/s  "
+                      "p50 {4!s:>9} ms  p99 {5!s:>9} ms  {6} errors".format(
+                          endpoint, depth, concurrency, stats['throughput'],
+                          stats['latency_ms']['p50'],
+                          stats['latency_ms']['p99'], stats['errors']))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    # arg parse
+    descr = ('Measure throughput and latency of a running lopocs server '
+             'and write them in a json file')
+    parser = argparse.ArgumentParser(description=descr)
+
+    parser.add_argument('--url', type=str, default='http://localhost:5000',
+                        help='url of lopocs (with the dataset if any)')
+    parser.add_argument('--endpoints', type=str, nargs='+',
+                        default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument('--depths', type=int, nargs='+', default=[0, 2, 4],
+                        help='depths of the octree of the requested nodes')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16], help='number of parallel clients')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='number of measured requests of each run')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='number of requests sent before each run')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', type=str, default=None,
+                        help='name of the version under test '
+                        '(git describe by default)')
+    parser.add_argument('--dataset', type=str, default=None,
+                        help='dataset.json written by generate.py')
+    parser.add_argument('--output', type=str, default='results.json')
+
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+
+    dataset = None
+    if args.dataset:
+        with open(args.dataset, 'r') as f:
+            dataset = json.load(f)
+
+    results = run(args)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "label": args.label or git_describe(),
+            "date": datetime.datetime.utcnow().isoformat() + 'Z',
+            "url": args.url,
+            "host": {"platform": platform.platform(),
+                     "python": platform.python_version(),
+                     "cpus": os.cpu_count()},
+            "parameters": {"requests": args.requests,
+                           "warmup": args.warmup,
+                           "seed": args.seed},
+            "dataset": dataset,
+            "results": results}, f, indent=2)
+
+    print("  => {0}".format(args.output))
@@ -10,8 +10,14 @@ from yaml import load as yload
 
 from lopocs.app import api
 from lopocs.database import Session
-from lopocs.stats import Stats
+from lopocs.cache import Cache
+from lopocs.store import TileStore
+from lopocs.metadata import Metadata
+from lopocs.metrics import Metrics
+from lopocs.datasets import Datasets, DatasetDispatcher
 from lopocs.conf import Config
+from lopocs.octree import OctreeKey
+from lopocs.scope import activate
 
 # lopocs version
 __version__ = '0.1.dev0'
@@ -94,23 +100,51 @@ def load_yaml_config(filename):
     return yload(content).get('flask', {})
 
 
-def create_app(env='Defaults'):
+def find_config():
     """
-    Creates application.
-    :returns: flask application instance
+    Returns the path of the configuration file
     """
-    app = Flask(__name__)
     cfgfile = os.environ.get('LOPOCS_SETTINGS')
-    if cfgfile:
-        app.config.update(load_yaml_config(cfgfile))
-    else:
+    if not cfgfile:
         try:
             cfgfile = (Path(__file__).parent / '..' / 'conf' / 'lopocs.yml').resolve()
         except FileNotFoundError:
             logger.warning('no config file found !!')
             sys.exit(1)
-    app.config.update(load_yaml_config(str(cfgfile)))
-    print(str(cfgfile))
+    return str(cfgfile)
+
+
+def init_services(app):
+    """
+    Initializes the database session, the caches and the metrics from the
+    configuration of app and checks that the octrees used by the datasets
+    were built
+    """
+    Session.init_app(app)
+    Config.init(app.config)
+    Cache.init()
+    TileStore.init()
+    Metadata.init()
+    Metrics.init()
+
+    Datasets.init(app.config)
+
+    # reads would all fail without the octree
+    for dataset in [None] + list(Datasets.registry.values()):
+        with activate(dataset):
+            if Config.USE_OCTREE_KEY:
+                OctreeKey.check(Session.dsn)
+
+
+def create_app(env='Defaults'):
+    """
+    Creates application.
+    :returns: flask application instance
+    """
+    app = Flask(__name__)
+    cfgfile = find_config()
+    app.config.update(load_yaml_config(cfgfile))
+    print(cfgfile)
     set_level(app.config['LOG_LEVEL'])
     logger.debug('loading config from {}'.format(cfgfile))
 
@@ -122,10 +156,10 @@ def create_app(env='Defaults'):
 
     api.init_app(blueprint)
     app.register_blueprint(blueprint)
-    Session.init_app(app)
-    Config.init(app.config)
+    init_services(app)
 
-    if Config.STATS:
-        Stats.init()
+    # /<dataset>/... routes
+    app.wsgi_app = DatasetDispatcher(app.wsgi_app,
+                                     app.config.get('URL_PREFIX', ''))
 
     return app
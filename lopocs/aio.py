@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio entry point serving the same api as lopocs.wsgi with aiohttp and
+aiopg. Tiles are read with an asynchronous pool of connections so that a
+single process keeps many queries in flight, decoding and encoding of
+points are done in a pool of threads.
+
+    gunicorn lopocs.aio:create_app --worker-class aiohttp.GunicornWebWorker
+
+or, for development:
+
+    python -m lopocs.aio --port 5000
+
+It requires python >= 3.7, the wsgi application runs on older ones.
+"""
+import argparse
+import asyncio
+try:
+    import contextvars
+except ImportError:
+    # the dataset and the timings of a request follow its task and its
+    # calls in the executor through context variables only
+    raise ImportError("lopocs.aio requires python >= 3.7")
+import json
+import time
+import weakref
+from functools import partial, wraps
+from itertools import chain
+
+import aiopg
+from aiohttp import web
+from psycopg2 import OperationalError, InterfaceError
+
+from . import find_config, init_services, load_yaml_config, set_level
+from . import greyhound
+from . import threedtiles
+from . import timing
+from . import utils
+from .cache import Cache, tile_key
+from .conf import Config
+from .database import Session, SlowQueryLog, Statement
+from .datasets import Datasets
+from .metrics import Metrics
+from .octree import OctreeKey
+from .scope import activate, set_current
+from .store import TileStore
+
+
+class AsyncSession():
+    """
+    Asynchronous counterpart of Session for the queries reading tiles.
+    Other queries (infos, hierarchies) go through Session in the executor.
+    """
+    pool = None
+    # statements already prepared on each connection
+    _prepared = weakref.WeakKeyDictionary()
+
+    @classmethod
+    async def init(cls, config):
+        dsn = ("postgresql://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:"
+               "{PG_PORT}/{PG_NAME}".format(**config))
+        cls.pool = await aiopg.create_pool(
+            dsn, minsize=config.get('PG_POOL_MINCONN', 1),
+            maxsize=config.get('PG_POOL_MAXCONN', 4))
+
+    @classmethod
+    async def close(cls):
+        cls.pool.close()
+        await cls.pool.wait_closed()
+
+    @classmethod
+    async def query_aslist(cls, query, parameters=None, context=None):
+        """Performs a query and returns values in a flat list. The query
+        is either a sql string or a Statement, context describes it in the
+        slow query log.
+        """
+        # same replay as Session._run when connections went stale
+        attempts = cls.pool.maxsize + 1
+        for attempt in range(attempts):
+            start = time.perf_counter()
+            async with cls.pool.acquire() as conn:
+                wait = time.perf_counter() - start
+                Metrics.pool_wait(wait)
+                timings = timing.current()
+                if timings is not None:
+                    timings.add('pool', wait)
+                start = time.perf_counter()
+                try:
+                    async with conn.cursor() as cur:
+                        with timing.span('database'):
+                            if isinstance(query, Statement):
+                                prepared = cls._prepared.setdefault(conn,
+                                                                    set())
+                                name = query.prepared_name()
+                                if name not in prepared:
+                                    await cur.execute(query.prepare_sql())
+                                    prepared.add(name)
+                                await cur.execute(query.execute_sql(),
+                                                  parameters)
+                            else:
+                                await cur.execute(query, parameters)
+                        with timing.span('fetch'):
+                            rows = await cur.fetchall()
+                        SlowQueryLog.check(query, parameters,
+                                           time.perf_counter() - start,
+                                           context)
+                        return list(chain(*rows))
+                except (OperationalError, InterfaceError):
+                    if not conn.closed or attempt == attempts - 1:
+                        raise
+
+
+# -----------------------------------------------------------------------------
+# utility functions
+# -----------------------------------------------------------------------------
+def run_in_executor(func, *args):
+    # the active dataset follows in the thread of the executor
+    context = contextvars.copy_context()
+    return asyncio.get_event_loop().run_in_executor(
+        None, partial(context.run, func, *args))
+
+
+@web.middleware
+async def dataset_middleware(request, handler):
+    """
+    Activates the dataset of /{dataset}/... routes for the task of the
+    request
+    """
+    name = request.match_info.get('dataset')
+    dataset = None
+    if name is not None:
+        dataset = Datasets.get(name)
+        if dataset is None:
+            raise web.HTTPNotFound()
+    set_current(dataset)
+    return await handler(request)
+
+
+def timed(endpoint):
+    """
+    Decorates a handler so that the stages of its requests are sent in the
+    Server-Timing header of the response, as lopocs.timing.timed does.
+    Requests aren't profiled: other tasks run in the loop meanwhile.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request):
+            timings = timing.begin(endpoint)
+            try:
+                resp = await handler(request)
+            except Exception:
+                timing.end(timings)
+                raise
+            # headers of streamed responses are already sent
+            timing.end(timings, None if resp.prepared else resp.headers)
+            return resp
+        return wrapper
+    return decorator
+
+
+def boolean(value):
+    """
+    Converts a query argument to a boolean as flask_restplus inputs.boolean
+    """
+    value = value.lower()
+    if value in ('true', '1'):
+        return True
+    if value in ('false', '0'):
+        return False
+    raise ValueError(value)
+
+
+def parse_args(request, arguments):
+    """
+    Returns the query arguments of a request converted with their type,
+    all of them are required
+    """
+    args = {}
+    for name, type_ in arguments:
+        try:
+            args[name] = type_(request.query[name])
+        except (KeyError, ValueError):
+            raise web.HTTPBadRequest(
+                text="invalid or missing argument: {0}".format(name))
+    return args
+
+
+def response(body, content_type):
+    resp = web.Response(body=body)
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Content-Type'] = content_type
+    return resp
+
+
+async def store_response(namespace, key):
+    """
+    Returns a response serving a tile of the TileStore or None. The
+    lookup is done in the executor: the path of a tile depends on the
+    version of the table, which may be checked in database.
+    """
+    path = await run_in_executor(TileStore.lookup, namespace, key)
+    if path is None:
+        return None
+
+    headers = TileStore.sendfile_headers(path)
+    if headers:
+        resp = web.Response(headers=headers)
+    else:
+        resp = web.FileResponse(path)
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Content-Type'] = 'application/octet-stream'
+    return resp
+
+
+async def stream_response(request, chunks):
+    """
+    Sends the chunks of a generator, iterated in the executor
+    """
+    resp = web.StreamResponse()
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Content-Type'] = 'application/octet-stream'
+    try:
+        await resp.prepare(request)
+        chunk = await run_in_executor(next, chunks, None)
+        while chunk is not None:
+            await resp.write(chunk)
+            chunk = await run_in_executor(next, chunks, None)
+        await resp.write_eof()
+    finally:
+        # releases the connection if the client went away
+        await run_in_executor(chunks.close)
+    return resp
+
+
+async def read_tile(endpoint, cache, namespace, key, sql, parameters,
+                    context, encode):
+    """
+    Returns the tile of key from the caches or reads it in database and
+    encodes it in the executor, along with the tile (None if served from
+    the store)
+    """
+    tile = cache.get(key)
+    if tile is not None:
+        Metrics.tile(endpoint, 'cache')
+    else:
+        resp = await store_response(namespace, key)
+        if resp is not None:
+            Metrics.tile(endpoint, 'store')
+            return [resp, None]
+
+        Metrics.tile(endpoint, 'database')
+        pcpatch_wkb = (await AsyncSession.query_aslist(
+            sql, parameters, context))[0]
+        tile = await run_in_executor(encode, pcpatch_wkb)
+
+        cache.put(key, tile)
+        await run_in_executor(TileStore.put, namespace, key, tile)
+
+    return [response(tile, 'application/octet-stream'), tile]
+
+
+# -----------------------------------------------------------------------------
+# basic api
+# -----------------------------------------------------------------------------
+async def infos_global(request):
+    return web.json_response("Light OpenSource PointCloud Server / Oslandia")
+
+
+async def infos_contact(request):
+    return web.json_response("infos+li3ds@oslandia.com")
+
+
+async def infos_online(request):
+    return web.json_response("Congratulation, LOPoCS is online!!!")
+
+
+async def infos_cache(request):
+    stats = Cache.stats()
+    stats['store'] = TileStore.stats()
+    return web.json_response(stats)
+
+
+async def infos_metrics(request):
+    metrics = await run_in_executor(Metrics.render)
+    resp = web.Response(text=metrics)
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return resp
+
+
+# -----------------------------------------------------------------------------
+# greyhound api
+# -----------------------------------------------------------------------------
+GREYHOUND_READ_ARGS = [('depthBegin', int), ('depthEnd', int),
+                       ('bounds', str), ('schema', str), ('scale', float),
+                       ('offset', str), ('compress', boolean)]
+
+GREYHOUND_HIERARCHY_ARGS = [('depthBegin', int), ('depthEnd', int),
+                            ('bounds', str)]
+
+
+@timed('greyhound_info')
+async def greyhound_info(request):
+    start = time.perf_counter()
+    info = await run_in_executor(greyhound.GreyhoundInfo().info)
+    Metrics.request('greyhound_info', start, len(info))
+    return response(info, 'text/plain')
+
+
+@timed('greyhound_read')
+async def greyhound_read(request):
+    start = time.perf_counter()
+    args = parse_args(request, GREYHOUND_READ_ARGS)
+    [box, offset, schema_pcid, lod] = greyhound.GreyhoundRead.parameters(args)
+    # the version of the table may be checked in database
+    key = await run_in_executor(tile_key, box, lod, args['scale'],
+                                schema_pcid, offset)
+    [sql, parameters] = greyhound.sql_query(box, schema_pcid, lod)
+
+    if not args['compress'] and Config.GREYHOUND_STREAM_BATCH:
+        # same as the flask api: uncompressed points aren't cached
+        Metrics.tile('greyhound_read', 'database')
+        return await stream_response(request, Metrics.streamed(
+            'greyhound_read', start,
+            greyhound.stream_points(box, schema_pcid, lod)))
+
+    def encode(pcpatch_wkb):
+        with timing.span('encode'):
+            return greyhound.encode_points(pcpatch_wkb, lod)[0]
+
+    [resp, read] = await read_tile('greyhound_read', Cache.greyhound,
+                                   'greyhound', key, sql, parameters,
+                                   {'bounds': box, 'lod': lod}, encode)
+    if read is not None:
+        Metrics.request('greyhound_read', start, len(read),
+                        utils.npoints_from_greyhound_read(read))
+    else:
+        Metrics.request('greyhound_read', start)
+    return resp
+
+
+@timed('greyhound_hierarchy')
+async def greyhound_hierarchy(request):
+    start = time.perf_counter()
+    args = parse_args(request, GREYHOUND_HIERARCHY_ARGS)
+    hcy = await run_in_executor(greyhound.GreyhoundHierarchy().hierarchy,
+                                args)
+    with timing.span('serialize'):
+        body = json.dumps(hcy)
+    Metrics.request('greyhound_hierarchy', start, len(body))
+    return response(body, 'text/plain')
+
+
+# -----------------------------------------------------------------------------
+# threedtiles api
+# -----------------------------------------------------------------------------
+THREEDTILES_READ_ARGS = [('v', float), ('bounds', str), ('lod', int),
+                         ('offsets', str), ('scale', float)]
+
+
+@timed('3dtiles_info')
+async def threedtiles_info(request):
+    start = time.perf_counter()
+    info = await run_in_executor(threedtiles.ThreeDTilesInfo().info)
+    Metrics.request('3dtiles_info', start, len(info))
+    return response(info, 'text/plain')
+
+
+@timed('3dtiles_read')
+async def threedtiles_read(request):
+    start = time.perf_counter()
+    args = parse_args(request, THREEDTILES_READ_ARGS)
+    [box, offset, schema_pcid, lod] = \
+        threedtiles.ThreeDTilesRead.parameters(args)
+    # the version of the table may be checked in database
+    key = await run_in_executor(tile_key, box, lod, args['scale'],
+                                schema_pcid, offset)
+    [sql, parameters] = threedtiles.sql_query(box, schema_pcid, lod)
+
+    def encode(pcpatch_wkb):
+        return threedtiles.pnts_from_pcpatch(pcpatch_wkb, offset,
+                                             args['scale'])[0]
+
+    [resp, tile] = await read_tile('3dtiles_read', Cache.threedtiles,
+                                   '3dtiles', key, sql, parameters,
+                                   {'bounds': box, 'lod': lod}, encode)
+    if tile is not None:
+        Metrics.request('3dtiles_read', start, len(tile),
+                        threedtiles.pnts_npoints(tile))
+    else:
+        Metrics.request('3dtiles_read', start)
+    return resp
+
+
+@timed('3dtiles_tileset')
+async def threedtiles_tileset(request):
+    start = time.perf_counter()
+    # both arguments are optional, the root page is returned by default
+    args = {'lod': None, 'bounds': request.query.get('bounds')}
+    if 'lod' in request.query:
+        args['lod'] = parse_args(request, [('lod', int)])['lod']
+
+    tileset = await run_in_executor(
+        threedtiles.ThreeDTilesTileset().tileset, args)
+    if tileset is None:
+        raise web.HTTPNotFound(text="bounds are not a node of the octree")
+
+    Metrics.request('3dtiles_tileset', start, len(tileset))
+    return response(tileset, 'application/json')
+
+
+# -----------------------------------------------------------------------------
+# application
+# -----------------------------------------------------------------------------
+ROUTES = [
+    ('/infos/global', infos_global),
+    ('/infos/contact', infos_contact),
+    ('/infos/online', infos_online),
+    ('/infos/cache', infos_cache),
+    ('/infos/metrics', infos_metrics),
+    ('/greyhound/info', greyhound_info),
+    ('/greyhound/read', greyhound_read),
+    ('/greyhound/hierarchy', greyhound_hierarchy),
+    ('/3dtiles/info', threedtiles_info),
+    ('/3dtiles/read.pnts', threedtiles_read),
+    ('/3dtiles/tileset.json', threedtiles_tileset),
+]
+
+
+async def on_startup(app):
+    await AsyncSession.init(app['config'])
+
+    # parameters of read queries computed with Session are loaded once
+    # here rather than blocking the loop on the first request
+    for dataset in [None] + list(Datasets.registry.values()):
+        with activate(dataset):
+            await run_in_executor(Session.srsid)
+            if Config.USE_OCTREE_KEY:
+                await run_in_executor(OctreeKey.load)
+
+
+async def on_cleanup(app):
+    await AsyncSession.close()
+
+
+def create_app():
+    """
+    Creates the aiohttp application
+    """
+    cfgfile = find_config()
+    config = load_yaml_config(cfgfile)
+    set_level(config['LOG_LEVEL'])
+
+    # Session is still used for queries other than tile reads
+    settings = type('', (), {})()
+    settings.config = config
+    init_services(settings)
+
+    app = web.Application(middlewares=[dataset_middleware])
+    app['config'] = config
+    prefix = config.get('URL_PREFIX', '').rstrip('/')
+    for path, handler in ROUTES:
+        app.router.add_get(prefix + path, handler)
+        app.router.add_get(prefix + '/{dataset}' + path, handler)
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LOPoCS asyncio server')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
-from flask_restplus import Api, Resource, reqparse
+from flask import Response
+from flask_restplus import Api, Resource, inputs, reqparse
 
 from . import greyhound
 from . import threedtiles
+from .cache import Cache
+from .metrics import Metrics
+from .store import TileStore
 
 api = Api(version='0.1', title='LOPoCS API',
           description='API for accessing LOPoCS',)
@@ -35,6 +39,24 @@ class InfosOnline(Resource):
     def get(self):
         return "Congratulation, LOPoCS is online!!!"
 
+
+@infos_ns.route("/cache")
+class InfosCache(Resource):
+
+    def get(self):
+        stats = Cache.stats()
+        stats['store'] = TileStore.stats()
+        return stats
+
+
+@infos_ns.route("/metrics")
+class InfosMetrics(Resource):
+
+    def get(self):
+        # prometheus text format
+        return Response(Metrics.render(),
+                        content_type='text/plain; version=0.0.4')
+
 # -----------------------------------------------------------------------------
 # greyhound api
 # -----------------------------------------------------------------------------
@@ -57,7 +79,8 @@ greyhound_read_parser.add_argument('bounds', type=str, required=True)
 greyhound_read_parser.add_argument('schema', type=str, required=True)
 greyhound_read_parser.add_argument('scale', type=float, required=True)
 greyhound_read_parser.add_argument('offset', type=str, required=True)
-greyhound_read_parser.add_argument('compress', type=bool, required=True)
+greyhound_read_parser.add_argument('compress', type=inputs.boolean,
+                                   required=True)
 
 
 @greyhound_ns.route("/read")
@@ -113,3 +136,18 @@ class ThreeDTilesRead(Resource):
     def get(self):
         args = threedtiles_read_parser.parse_args()
         return threedtiles.ThreeDTilesRead().run(args)
+
+
+# tileset
+threedtiles_tileset_parser = reqparse.RequestParser()
+threedtiles_tileset_parser.add_argument('lod', type=int, required=False)
+threedtiles_tileset_parser.add_argument('bounds', type=str, required=False)
+
+
+@threedtiles_ns.route("/tileset.json")
+class ThreeDTilesTileset(Resource):
+
+    @api.expect(threedtiles_tileset_parser, validate=True)
+    def get(self):
+        args = threedtiles_tileset_parser.parse_args()
+        return threedtiles.ThreeDTilesTileset().run(args)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from threading import Lock
+
+from .conf import Config
+from .metadata import Metadata
+from .scope import Scoped
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache of bytes bounded by the total size of its values.
+    The least recently used values are evicted first.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        if not self.maxsize:
+            return None
+
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.maxsize:
+            return
+
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._data[key] = value
+            self.size += len(value)
+
+            while self.size > self.maxsize:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "maxsize": self.maxsize,
+                "size": self.size,
+                "entries": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class Cache(metaclass=Scoped):
+    """
+    In-process caches of tiles, one per endpoint and per dataset. A cache
+    with a size of 0 is disabled.
+    """
+
+    _scoped = frozenset(['greyhound', 'threedtiles'])
+
+    greyhound = LRUCache(0)
+    threedtiles = LRUCache(0)
+
+    @classmethod
+    def init(cls):
+        cls.greyhound = LRUCache(Config.GREYHOUND_CACHE_SIZE)
+        cls.threedtiles = LRUCache(Config.THREEDTILES_CACHE_SIZE)
+
+    @classmethod
+    def stats(cls):
+        return {
+            "greyhound": cls.greyhound.stats(),
+            "3dtiles": cls.threedtiles.stats()}
+
+
+def tile_key(box, lod, scale, schema_pcid, offset):
+    """
+    Normalized key of a tile. Coordinates are rounded so that a same tile
+    requested with slightly different float representations is a hit.
+    Tiles of a previous version of the table are never hit again.
+    """
+    return (tuple(round(v, 6) for v in box), lod, round(scale, 6),
+            schema_pcid, tuple(round(v, 6) for v in offset),
+            repr(Metadata.version()))
@@ -2,8 +2,12 @@
 
 import os
 
+from .scope import Scoped
 
-class Config(object):
+
+class Config(object, metaclass=Scoped):
+
+    _scoped = frozenset()
 
     BB = None
     DEPTH = 6
@@ -13,12 +17,49 @@ class Config(object):
     POTREE_SCH_PCID_SCALE_01 = 2  # scale 0.1
     POTREE_SCH_PCID_SCALE_001 = 2  # scale 0.01
     USE_MORTON = True
+    USE_OCTREE_KEY = False
+    USE_LOD_TABLES = False
     DEBUG = False
-    STATS = True
-    STATS_SERVER_PORT = 6379
 
     CESIUM_COLOR = "colors"
 
+    # levels of the octree in each page of /3dtiles/tileset.json
+    TILESET_LEVELS = 3
+
+    # size in bytes of the in-process tile caches (0 to disable)
+    GREYHOUND_CACHE_SIZE = 64 * 1024 * 1024
+    THREEDTILES_CACHE_SIZE = 64 * 1024 * 1024
+
+    # number of patchs fetched at once by uncompressed greyhound reads,
+    # which are streamed as patchs are read (0 to disable streaming)
+    GREYHOUND_STREAM_BATCH = 100
+
+    # size in bytes of the on-disk tile store (0 to disable) and the way
+    # stored tiles are served: 'send_file', 'x-sendfile' or
+    # 'x-accel-redirect' (with the internal location mapped to the store)
+    TILE_STORE_SIZE = 0
+    TILE_STORE_SENDFILE = 'send_file'
+    TILE_STORE_ACCEL_PREFIX = '/lopocs-tiles/'
+
+    # metrics exported by /infos/metrics, each worker writes its own ones
+    # in METRICS_DIR (CACHE_DIR/metrics by default) every
+    # METRICS_FLUSH_INTERVAL seconds at most
+    METRICS = True
+    METRICS_DIR = None
+    METRICS_FLUSH_INTERVAL = 5
+
+    # durations of the stages of the requests sent in their Server-Timing
+    # header, and ratio of the requests profiled with cProfile (0 to
+    # disable) in PROFILE_DIR (CACHE_DIR/profiles by default)
+    SERVER_TIMING = True
+    PROFILE_RATE = 0
+    PROFILE_DIR = None
+
+    # queries lasting more than SLOW_QUERY_THRESHOLD seconds are logged (0
+    # to disable), with the plan of SLOW_QUERY_EXPLAIN_RATE of them
+    SLOW_QUERY_THRESHOLD = 0
+    SLOW_QUERY_EXPLAIN_RATE = 0
+
     @classmethod
     def init(cls, config):
 
@@ -55,14 +96,63 @@ class Config(object):
         if 'USE_MORTON' in config:
             cls.USE_MORTON = config['USE_MORTON']
 
-        if 'DEBUG' in config:
-            cls.DEBUG = config['DEBUG']
+        if 'USE_OCTREE_KEY' in config:
+            cls.USE_OCTREE_KEY = config['USE_OCTREE_KEY']
 
-        if 'STATS' in config:
-            cls.STATS = config['STATS']
+        if 'USE_LOD_TABLES' in config:
+            cls.USE_LOD_TABLES = config['USE_LOD_TABLES']
 
-        if 'STATS_SERVER_PORT' in config:
-            cls.STATS_SERVER_PORT = config['STATS_SERVER_PORT']
+        if 'DEBUG' in config:
+            cls.DEBUG = config['DEBUG']
 
         if 'CESIUM_COLOR' in config:
             cls.CESIUM_COLOR = config['CESIUM_COLOR']
+
+        if 'TILESET_LEVELS' in config:
+            cls.TILESET_LEVELS = config['TILESET_LEVELS']
+
+        if 'GREYHOUND_CACHE_SIZE' in config:
+            cls.GREYHOUND_CACHE_SIZE = config['GREYHOUND_CACHE_SIZE']
+
+        if 'THREEDTILES_CACHE_SIZE' in config:
+            cls.THREEDTILES_CACHE_SIZE = config['THREEDTILES_CACHE_SIZE']
+
+        if 'GREYHOUND_STREAM_BATCH' in config:
+            cls.GREYHOUND_STREAM_BATCH = config['GREYHOUND_STREAM_BATCH']
+
+        if 'TILE_STORE_SIZE' in config:
+            cls.TILE_STORE_SIZE = config['TILE_STORE_SIZE']
+
+        if 'TILE_STORE_SENDFILE' in config:
+            cls.TILE_STORE_SENDFILE = config['TILE_STORE_SENDFILE']
+
+        if 'TILE_STORE_ACCEL_PREFIX' in config:
+            cls.TILE_STORE_ACCEL_PREFIX = config['TILE_STORE_ACCEL_PREFIX']
+
+        if 'METRICS' in config:
+            cls.METRICS = config['METRICS']
+
+        if 'METRICS_DIR' in config:
+            cls.METRICS_DIR = config['METRICS_DIR']
+
+        if 'METRICS_FLUSH_INTERVAL' in config:
+            cls.METRICS_FLUSH_INTERVAL = config['METRICS_FLUSH_INTERVAL']
+
+        if 'SERVER_TIMING' in config:
+            cls.SERVER_TIMING = config['SERVER_TIMING']
+
+        if 'PROFILE_RATE' in config:
+            cls.PROFILE_RATE = config['PROFILE_RATE']
+
+        if 'PROFILE_DIR' in config:
+            cls.PROFILE_DIR = config['PROFILE_DIR']
+
+        if 'SLOW_QUERY_THRESHOLD' in config:
+            cls.SLOW_QUERY_THRESHOLD = config['SLOW_QUERY_THRESHOLD']
+
+        if 'SLOW_QUERY_EXPLAIN_RATE' in config:
+            cls.SLOW_QUERY_EXPLAIN_RATE = config['SLOW_QUERY_EXPLAIN_RATE']
+
+
+# every setting can be overridden by a dataset
+Config._scoped = frozenset(name for name in vars(Config) if name.isupper())
@@ -1,20 +1,218 @@
 # -*- coding: utf-8 -*-
-
+import logging
+import random
+import re
+import time
+from contextlib import contextmanager
 from itertools import chain
-from psycopg2 import connect
+from queue import Queue, Full
+from threading import BoundedSemaphore, Lock, Thread
+from psycopg2 import connect, Error, OperationalError, InterfaceError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection
 from psycopg2.extras import NamedTupleCursor
+from psycopg2.pool import ThreadedConnectionPool
 from osgeo.osr import SpatialReference
 
 from . import utils
+from .conf import Config
+from .metrics import Metrics
+from .scope import Scoped
+from .timing import span
+
+logger = logging.getLogger(__name__)
 
 
-class Session():
+class Connection(connection):
+    """
+    Connection keeping track of the statements already prepared on it
     """
-    Session object used as a global connection object to the db
 
-    # FIXME: handle disconnection
+    def __init__(self, *args, **kwargs):
+        connection.__init__(self, *args, **kwargs)
+        self.prepared = set()
+
+
+class Statement(object):
     """
-    db = None
+    Named statement prepared once per connection and then executed with
+    bound parameters. The '{column}' and '{table}' fields of the sql are
+    replaced by the ones of the session when preparing.
+    """
+
+    def __init__(self, name, sql, types):
+        self.name = name
+        self.sql = sql
+        self.types = types
+
+    def prepare(self, conn):
+        """
+        Prepares the statement on the connection if not done yet and
+        returns the query executing it
+        """
+        if self.prepared_name() not in conn.prepared:
+            conn.cursor().execute(self.prepare_sql())
+            conn.prepared.add(self.prepared_name())
+
+        return self.execute_sql()
+
+    def prepared_name(self):
+        # connections are shared by datasets, each one prepares its own
+        return self.name + Session.suffix
+
+    def prepare_sql(self):
+        return ("prepare {0} ({1}) as {2}"
+                .format(self.prepared_name(), ', '.join(self.types),
+                        self.sql.format(column=Session.column,
+                                        table=Session.table)))
+
+    def execute_sql(self):
+        return ("execute {0} ({1})"
+                .format(self.prepared_name(),
+                        ', '.join(['%s'] * len(self.types))))
+
+    def inline_sql(self):
+        """
+        Returns the sql with %(pN)s placeholders instead of $N ones for
+        queries which can't be prepared, such as server-side cursors
+        """
+        return re.sub(r'\$(\d+)', r'%(p\1)s',
+                      self.sql.format(column=Session.column,
+                                      table=Session.table))
+
+    def __str__(self):
+        return self.sql
+
+
+class ConnectionPool(ThreadedConnectionPool):
+    """
+    Thread-safe pool of connections. Contrary to ThreadedConnectionPool,
+    getconn waits for a connection to be released when maxconn
+    connections are already in use instead of raising a PoolError.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self._slots = BoundedSemaphore(maxconn)
+        ThreadedConnectionPool.__init__(self, minconn, maxconn,
+                                        *args, **kwargs)
+
+    def _connect(self, key=None):
+        conn = ThreadedConnectionPool._connect(self, key)
+        # autocommit mode for performance (we don't need transaction)
+        conn.autocommit = True
+        return conn
+
+    def getconn(self, key=None):
+        self._slots.acquire()
+        try:
+            conn = ThreadedConnectionPool.getconn(self, key)
+            while not self.healthy(conn):
+                ThreadedConnectionPool.putconn(self, conn, close=True)
+                conn = ThreadedConnectionPool.getconn(self, key)
+        except:
+            self._slots.release()
+            raise
+        return conn
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            ThreadedConnectionPool.putconn(self, conn, key, close)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def healthy(conn):
+        """
+        A connection is reusable if it's open and not stuck in a
+        transaction or in an unknown state after a server failure
+        """
+        return (not conn.closed and
+                conn.get_transaction_status() == TRANSACTION_STATUS_IDLE)
+
+
+class SlowQueryLog(object):
+    """
+    Logs the queries lasting more than SLOW_QUERY_THRESHOLD seconds along
+    with their context (bounds and lod of tile reads). The plans of a
+    sample of them (SLOW_QUERY_EXPLAIN_RATE) are captured with EXPLAIN
+    (ANALYZE, BUFFERS): queries are run again by a thread on a side
+    connection, so that neither requests nor the pool wait for it.
+    """
+
+    dsn = None
+    # slow queries waiting for their plan, others are dropped when full
+    _queue = Queue(maxsize=16)
+    _thread = None
+    _lock = Lock()
+
+    @classmethod
+    def check(cls, query, parameters, duration, context=None):
+        threshold = Config.SLOW_QUERY_THRESHOLD
+        if not threshold or duration < threshold:
+            return
+
+        name = query.prepared_name() if isinstance(query, Statement) \
+            else 'query'
+        description = ' '.join([name] + [
+            "{0}={1}".format(k, v) for k, v in sorted((context or {}).items())])
+        logger.warning("slow query: %.1f ms %s parameters=%s",
+                       duration * 1000, description, parameters)
+
+        rate = Config.SLOW_QUERY_EXPLAIN_RATE
+        if rate and random.random() < rate:
+            cls.explain(query, parameters, description)
+
+    @classmethod
+    def explain(cls, query, parameters, description):
+        # statements are prepared on pooled connections only, and the sql
+        # depends on the active dataset: it's inlined here
+        if isinstance(query, Statement):
+            parameters = {'p{0}'.format(i + 1): value
+                          for i, value in enumerate(parameters)}
+            query = query.inline_sql()
+
+        with cls._lock:
+            if cls._thread is None or not cls._thread.is_alive():
+                # started lazily, after workers are forked
+                cls._thread = Thread(target=cls.run, daemon=True,
+                                     name='lopocs-explain')
+                cls._thread.start()
+        try:
+            cls._queue.put_nowait([query, parameters, description])
+        except Full:
+            pass
+
+    @classmethod
+    def run(cls):
+        conn = None
+        while True:
+            [query, parameters, description] = cls._queue.get()
+            try:
+                if conn is None or conn.closed:
+                    conn = connect(cls.dsn)
+                    conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute("explain (analyze, buffers) " + query,
+                            parameters)
+                plan = '\n'.join(row[0] for row in cur.fetchall())
+                logger.warning("slow query plan: %s\n%s", description, plan)
+            except Error as e:
+                logger.error("slow query plan: %s failed: %s", description, e)
+
+
+class Session(metaclass=Scoped):
+    """
+    Session object used as a global access point to the db. Each query
+    borrows a connection from a pool so that several queries can run
+    concurrently within a worker.
+    """
+    _scoped = frozenset(['table', 'column', 'suffix', '_srsid'])
+    pool = None
+    dsn = None
+    streams = None
+    table = None
+    column = None
+    suffix = ''
+    _srsid = None
 
     @classmethod
     def approx_row_count(cls):
@@ -83,10 +281,12 @@ class Session():
 
     @classmethod
     def srsid(cls):
-        sql = ("select pc_summary({0})::json->'srid' as srsid from {1} "
-               "where id = 1"
-               .format(cls.column, cls.table))
-        return cls.query_aslist(sql)[0]
+        if cls._srsid is None:
+            sql = ("select pc_summary({0})::json->'srid' as srsid from {1} "
+                   "where id = 1"
+                   .format(cls.column, cls.table))
+            cls._srsid = cls.query_aslist(sql)[0]
+        return cls._srsid
 
     @classmethod
     def srs(cls):
@@ -103,15 +303,93 @@ class Session():
         return schema
 
     @classmethod
-    def query(cls, query, parameters=None):
-        """Performs a query and yield results
+    @contextmanager
+    def connection(cls):
+        """Borrows a connection from the pool for the duration of a block.
+        The connection is discarded if the server went away meanwhile.
+        """
+        start = time.perf_counter()
+        with span('pool'):
+            conn = cls.pool.getconn()
+        Metrics.pool_wait(time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            cls.pool.putconn(conn, close=bool(conn.closed))
+
+    @classmethod
+    def execute(cls, query, parameters=None):
+        """Performs a query which doesn't return any result
+        """
+        cls._run(query, parameters, fetch=False)
+
+    @classmethod
+    def query(cls, query, parameters=None, context=None):
+        """Performs a query and returns results. The query is either a sql
+        string or a Statement, context describes it in the slow query log
+        (bounds, lod...).
         """
-        cur = cls.db.cursor()
-        cur.execute(query, parameters)
-        if not cur.rowcount:
-            return None
-        for row in cur:
-            yield row
+        return cls._run(query, parameters, context=context)
+
+    @classmethod
+    def stream(cls, query, parameters=None, size=100):
+        """Iterates over the results of a query by lists of size rows
+        fetched through a server-side cursor. The connection is borrowed
+        until the iteration ends, which lasts as long as the client reads:
+        at most PG_POOL_STREAMS connections of the pool are borrowed by
+        iterations at once, the other ones wait.
+        """
+        if isinstance(query, Statement):
+            parameters = {'p{0}'.format(i + 1): value
+                          for i, value in enumerate(parameters)}
+            query = query.inline_sql()
+
+        with cls.streams, cls.connection() as conn:
+            # server-side cursors live in a transaction
+            conn.autocommit = False
+            try:
+                cur = conn.cursor(name='lopocs_stream')
+                cur.execute(query, parameters)
+                rows = cur.fetchmany(size)
+                while rows:
+                    yield rows
+                    rows = cur.fetchmany(size)
+                cur.close()
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+
+    @classmethod
+    def _run(cls, query, parameters=None, fetch=True, context=None):
+        # a query failing because of a lost connection is replayed on
+        # another one, pooled connections may all be stale after a restart
+        # of the server
+        attempts = cls.pool.maxconn + 1
+        for attempt in range(attempts):
+            with cls.connection() as conn:
+                cur = conn.cursor()
+                start = time.perf_counter()
+                try:
+                    with span('database'):
+                        if isinstance(query, Statement):
+                            cur.execute(query.prepare(conn), parameters)
+                        else:
+                            cur.execute(query, parameters)
+                except (OperationalError, InterfaceError):
+                    if not conn.closed or attempt == attempts - 1:
+                        raise
+                    continue
+                if not fetch:
+                    return []
+                rows = []
+                if cur.rowcount:
+                    # rows are converted (bytea decoding...) when fetched
+                    with span('fetch'):
+                        rows = cur.fetchall()
+                SlowQueryLog.check(query, parameters,
+                                   time.perf_counter() - start, context)
+                return rows
 
     @classmethod
     def query_asdict(cls, query, parameters=None):
@@ -123,11 +401,12 @@ class Session():
         ]
 
     @classmethod
-    def query_aslist(cls, query, parameters=None):
+    def query_aslist(cls, query, parameters=None, context=None):
         """Iterates over results and returns values in a flat list
         (usefull if one column only)
         """
-        return list(chain(*cls.query(query, parameters=parameters)))
+        return list(chain(*cls.query(query, parameters=parameters,
+                                     context=context)))
 
     @classmethod
     def init_app(cls, app):
@@ -138,12 +417,31 @@ class Session():
         query_con = ("postgresql://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:"
                      "{PG_PORT}/{PG_NAME}"
                      .format(**app.config))
-        cls.db = connect(query_con, cursor_factory=NamedTupleCursor,)
-
-        # autocommit mode for performance (we don't need transaction)
-        cls.db.autocommit = True
+        cls.pool = ConnectionPool(app.config.get('PG_POOL_MINCONN', 1),
+                                  app.config.get('PG_POOL_MAXCONN', 4),
+                                  query_con,
+                                  connection_factory=Connection,
+                                  cursor_factory=NamedTupleCursor)
+        # slow clients of streamed reads don't hold all the connections
+        maxconn = app.config.get('PG_POOL_MAXCONN', 4)
+        cls.streams = BoundedSemaphore(max(1, min(
+            app.config.get('PG_POOL_STREAMS', 1), maxconn - 1)))
+        cls._srsid = None
+        cls.dsn = query_con
+        SlowQueryLog.dsn = query_con
 
         # keep some configuration element
         cls.dbname = app.config["PG_NAME"]
         cls.column = app.config["PG_COLUMN"]
         cls.table = app.config["PG_TABLE"]
+
+    @classmethod
+    def init_dataset(cls, settings, index):
+        """
+        Initializes the table and the column of the active dataset, which
+        uses the pool of the default one
+        """
+        cls.table = settings['PG_TABLE']
+        cls.column = settings.get('PG_COLUMN', cls.column)
+        cls.suffix = '_{0}'.format(index)
+        cls._srsid = None
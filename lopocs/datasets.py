@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from .cache import Cache
+from .conf import Config
+from .database import Session
+from .metadata import Metadata
+from .scope import activate, set_current
+
+
+# first segments of the paths of the api, which can't name a dataset
+RESERVED_NAMES = frozenset(['infos', 'greyhound', '3dtiles', 'swagger.json',
+                            'swaggerui'])
+
+
+class Dataset(object):
+    """
+    Point cloud served under /<name>/ with its own table, settings and
+    caches, see scope.Scoped
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = {}
+
+
+class Datasets():
+    """
+    Registry of the datasets listed in the DATASETS setting. Each dataset
+    is a dict with a NAME, a PG_TABLE and any setting of the configuration
+    overriding the global one. Datasets share the connection pool and the
+    tile store of the default dataset but have their own in-process
+    caches.
+    """
+
+    registry = {}
+
+    @classmethod
+    def init(cls, config):
+        cls.registry = {}
+        for index, settings in enumerate(config.get('DATASETS') or []):
+            cls.validate(settings, index)
+            dataset = Dataset(settings['NAME'])
+            with activate(dataset):
+                Session.init_dataset(settings, index)
+                Config.init(settings)
+                Cache.init()
+                Metadata.init()
+            cls.registry[dataset.name] = dataset
+
+    @classmethod
+    def validate(cls, settings, index):
+        """
+        Raises a ValueError if the settings of the dataset index don't
+        define a NAME usable in the paths or a PG_TABLE
+        """
+        for key in ('NAME', 'PG_TABLE'):
+            if not settings.get(key):
+                raise ValueError("DATASETS[{0}]: missing {1}"
+                                 .format(index, key))
+
+        name = settings['NAME']
+        if name in RESERVED_NAMES or '/' in name:
+            raise ValueError("DATASETS[{0}]: invalid NAME '{1}'"
+                             .format(index, name))
+        if name in cls.registry:
+            raise ValueError("DATASETS[{0}]: duplicate NAME '{1}'"
+                             .format(index, name))
+
+    @classmethod
+    def get(cls, name):
+        return cls.registry.get(name)
+
+
+class DatasetDispatcher(object):
+    """
+    WSGI middleware activating the dataset named by the first segment of
+    the path (after prefix) and removing it from the path, so that
+    /<dataset>/greyhound/read is routed to /greyhound/read
+    """
+
+    def __init__(self, app, prefix=''):
+        self.app = app
+        self.prefix = prefix.rstrip('/')
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        dataset = None
+
+        if path.startswith(self.prefix + '/'):
+            [name, _, rest] = path[len(self.prefix) + 1:].partition('/')
+            dataset = Datasets.get(name)
+            if dataset is not None:
+                environ['PATH_INFO'] = self.prefix + '/' + rest
+
+        # set for the whole request, including streamed bodies, until the
+        # next request of the thread
+        set_current(dataset)
+
+        return self.app(environ, start_response)
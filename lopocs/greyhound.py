@@ -1,63 +1,259 @@
 # -*- coding: utf-8 -*-
+import fcntl
+import io
+import os
 import json
+from threading import Lock, local
 from flask import Response
 import numpy
 import time
-from lazperf import buildNumpyDescription, Decompressor
+from lazperf import Decompressor
 
-from .database import Session
+from .database import Session, Statement
 from . import utils
 from .conf import Config
-from .stats import Stats
+from .cache import Cache, tile_key
+from .store import TileStore
+from .octree import OctreeKey
+from .metadata import Metadata
+from .metrics import Metrics
+from .scope import Scoped
+from .timing import span, timed
 
 LOADER_GREYHOUND_MIN_DEPTH = 8
 
+# layout of a point decompressed with the GreyhoundReadSchema
+READ_DTYPE = numpy.dtype([('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'),
+                          ('Intensity', '<u2'), ('Classification', 'u1'),
+                          ('Red', '<u2'), ('Green', '<u2'), ('Blue', '<u2')])
+
+# parameters: xmin, ymin, xmax, ymax, first point, number of points,
+# zmin, zmax, output pcid, srid, max number of patchs (null for all)
+READ_POINTS_SQL = (
+    "select decode(pc_compress(pc_patchtransform(pc_union("
+    "pc_filterbetween("
+    "pc_range({{column}}, $5, $6), 'Z', $7, $8)), $9), 'laz')::text, "
+    "'hex') from "
+    "(select {{column}} from {{table}} {0} limit $11)_")
+READ_POINTS_TYPES = ['float8', 'float8', 'float8', 'float8', 'integer',
+                     'integer', 'float8', 'float8', 'integer', 'integer',
+                     'bigint']
+
+# selection of the patchs intersecting the box
+PATCHS_INTERSECTING = (
+    "where pc_intersects({column}, st_makeenvelope($1, $2, $3, $4, $10))")
+
+# selection of the patchs with the octree keys of OctreeKey.parameters in
+# $12 to $15 (see lopocs.octree) and an extent intersecting the box
+PATCHS_IN_OCTREE = (
+    "where (octree_key >= $12 and octree_key < $13 and octree_level >= $14 "
+    "or octree_level < $14 and octree_key = any($15)) "
+    "and octree_xmin <= $3 and octree_xmax >= $1 "
+    "and octree_ymin <= $4 and octree_ymax >= $2 "
+    "and octree_zmin <= $8 and octree_zmax >= $7 "
+    "order by octree_key")
+OCTREE_TYPES = READ_POINTS_TYPES + ['bigint', 'bigint', 'integer', 'bigint[]']
+
+READ_POINTS = Statement('lopocs_read_points',
+                        READ_POINTS_SQL.format(PATCHS_INTERSECTING),
+                        READ_POINTS_TYPES)
+READ_POINTS_MORTON = Statement('lopocs_read_points_morton',
+                               READ_POINTS_SQL.format(
+                                   PATCHS_INTERSECTING + ' order by morton'),
+                               READ_POINTS_TYPES)
+READ_POINTS_OCTREE = Statement('lopocs_read_points_octree',
+                               READ_POINTS_SQL.format(PATCHS_IN_OCTREE),
+                               OCTREE_TYPES)
+
+# parameters: same as READ_POINTS. A patch whose z extent lies within the
+# z limits contributes all the points of its range, which are known from
+# its header without decompressing it.
+COUNT_POINTS_SQL = (
+    "select sum(case "
+    "when pc_patchmin({{column}}, 'z') > $7 "
+    "and pc_patchmax({{column}}, 'z') < $8 "
+    "then least(greatest(pc_numpoints({{column}}) - $5, 0), $6) "
+    "else pc_numpoints(pc_filterbetween("
+    "pc_range({{column}}, $5, $6), 'Z', $7, $8)) end) from "
+    "(select {{column}} from {{table}} {0} limit $11)_")
+
+COUNT_POINTS = Statement('lopocs_count_points',
+                         COUNT_POINTS_SQL.format(PATCHS_INTERSECTING),
+                         READ_POINTS_TYPES)
+COUNT_POINTS_MORTON = Statement('lopocs_count_points_morton',
+                                COUNT_POINTS_SQL.format(
+                                    PATCHS_INTERSECTING + ' order by morton'),
+                                READ_POINTS_TYPES)
+COUNT_POINTS_OCTREE = Statement('lopocs_count_points_octree',
+                                COUNT_POINTS_SQL.format(PATCHS_IN_OCTREE),
+                                OCTREE_TYPES)
+
+# reading from the tables of points materialized for each lod by
+# tools/build_lod_tables.py (already transformed to the output pcid),
+# parameters: same as READ_POINTS
+READ_LOD_POINTS_SQL = (
+    "select decode(pc_compress(pc_union("
+    "pc_filterbetween(points, 'Z', $7, $8)), 'laz')::text, 'hex') from "
+    "(select points from {0} join {{table}} using (id) {1} limit $11)_")
+
+COUNT_LOD_POINTS_SQL = (
+    "select sum(case "
+    "when pc_patchmin(points, 'z') > $7 and pc_patchmax(points, 'z') < $8 "
+    "then pc_numpoints(points) "
+    "else pc_numpoints(pc_filterbetween(points, 'Z', $7, $8)) end) from "
+    "(select points from {0} join {{table}} using (id) {1} limit $11)_")
+
+# statements on lod tables, created when first used
+LOD_STATEMENTS = {}
+
+# uncompressed points of each patch for streaming reads, parameters: same
+# as READ_POINTS
+STREAM_POINTS_SQL = (
+    "select decode(pc_uncompress(pc_patchtransform(pc_filterbetween("
+    "pc_range({{column}}, $5, $6), 'Z', $7, $8), $9))::text, 'hex') from "
+    "(select {{column}} from {{table}} {0} limit $11)_")
+
+STREAM_LOD_POINTS_SQL = (
+    "select decode(pc_uncompress("
+    "pc_filterbetween(points, 'Z', $7, $8))::text, 'hex') from "
+    "(select points from {0} join {{table}} using (id) {1} limit $11)_")
+
+# statements of streaming reads, created when first used
+STREAM_STATEMENTS = {}
+
+# parameters: xmin, ymin, zmin, width, length and height of a cell, number
+# of cells along each axis, first point, number of points, srid
+COUNT_POINTS_BY_CELL = Statement(
+    'lopocs_count_points_by_cell',
+    "select ix, iy, iz, sum(n) as n from "
+    "(select ixmin, ixmax, iymin, iymax, iz, case "
+    "when zmin > $3 + iz * $6 and zmax < $3 + (iz + 1) * $6 "
+    "then least(greatest(pc_numpoints(pa) - $8, 0), $9) "
+    "else pc_numpoints(pc_filterbetween(pc_range(pa, $8, $9), 'Z', "
+    "$3 + iz * $6, $3 + (iz + 1) * $6)) end as n from "
+    "(select {column} as pa, "
+    "pc_patchmin({column}, 'z') as zmin, "
+    "pc_patchmax({column}, 'z') as zmax, "
+    "greatest(floor((pc_patchmin({column}, 'x') - $1) / $4)::integer, 0) "
+    "as ixmin, "
+    "least(floor((pc_patchmax({column}, 'x') - $1) / $4)::integer, $7 - 1) "
+    "as ixmax, "
+    "greatest(floor((pc_patchmin({column}, 'y') - $2) / $5)::integer, 0) "
+    "as iymin, "
+    "least(floor((pc_patchmax({column}, 'y') - $2) / $5)::integer, $7 - 1) "
+    "as iymax "
+    "from {table} where pc_intersects({column}, "
+    "st_makeenvelope($1, $2, $1 + $4 * $7, $2 + $5 * $7, $10)))_p "
+    "cross join lateral generate_series("
+    "greatest(floor((zmin - $3) / $6)::integer, 0), "
+    "least(floor((zmax - $3) / $6)::integer, $7 - 1)) as iz)_c "
+    "cross join lateral generate_series(ixmin, ixmax) as ix "
+    "cross join lateral generate_series(iymin, iymax) as iy "
+    "where n > 0 "
+    "group by 1, 2, 3",
+    ['float8', 'float8', 'float8', 'float8', 'float8', 'float8', 'integer',
+     'integer', 'integer', 'integer'])
+
+# name of the children of an octree node along with their offset in the
+# grid of the next level (west/east, south/north, down/up)
+OCTANTS = [('nwd', (0, 1, 0)), ('nwu', (0, 1, 1)),
+           ('ned', (1, 1, 0)), ('neu', (1, 1, 1)),
+           ('swd', (0, 0, 0)), ('swu', (0, 0, 1)),
+           ('sed', (1, 0, 0)), ('seu', (1, 0, 1))]
+
 
 # -----------------------------------------------------------------------------
 # classes
 # -----------------------------------------------------------------------------
 class GreyhoundInfo(object):
 
+    @timed('greyhound_info')
     def run(self):
-        # bounding box
-        if (Config.BB):
-            box = Config.BB
-        else:
-            box = Session.boundingbox()
+        start = time.perf_counter()
+        info = self.info()
+
+        # build the flask response
+        resp = Response(info)
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        resp.headers['Content-Type'] = 'text/plain'
 
-        # number of points for the first patch
-        npoints = Session.approx_row_count() * Session.patch_size()
+        Metrics.request('greyhound_info', start, len(info))
+        return resp
 
-        # srs
-        srs = Session.srs()
+    def info(self):
+        return Metadata.body('greyhound', self.build)
 
+    @staticmethod
+    def build(metadata):
         # build the greyhound schema
         schema_json = GreyhoundInfoSchema().json()
 
-        info = json.dumps({
+        return json.dumps({
             "baseDepth": 0,
-            "bounds": [box['xmin'], box['ymin'], box['zmin'],
-                       box['xmax'], box['ymax'], box['zmax']],
-            "boundsConforming": [box['xmin'], box['ymin'], box['zmin'],
-                                 box['xmax'], box['ymax'], box['zmax']],
-            "numPoints": npoints,
+            "bounds": metadata['bounds'],
+            "boundsConforming": metadata['bounds'],
+            "numPoints": metadata['numPoints'],
             "schema": schema_json,
-            "srs": srs,
+            "srs": metadata['srs'],
             "type": "octree"}, default=utils.decimal_default)
 
-        # build the flask response
-        resp = Response(info)
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        resp.headers['Content-Type'] = 'text/plain'
-
-        return resp
-
 
 class GreyhoundRead(object):
 
+    @timed('greyhound_read')
     def run(self, args):
+        start = time.perf_counter()
+        [box, offset, schema_pcid, lod] = self.parameters(args)
+
+        # uncompressed points are sent as they are read, a laz stream
+        # can't be built from several compressed patchs. The caches only
+        # hold laz reads.
+        streamed = not args['compress'] and bool(Config.GREYHOUND_STREAM_BATCH)
+
+        # get points from the caches or in database
+        key = tile_key(box, lod, args['scale'], schema_pcid, offset)
+        read = None
+        resp = None
+        if not streamed:
+            read = Cache.greyhound.get(key)
+            if read is not None:
+                Metrics.tile('greyhound_read', 'cache')
+                resp = Response(read)
+            else:
+                resp = TileStore.response('greyhound', key)
+                if resp is not None:
+                    Metrics.tile('greyhound_read', 'store')
+
+        if streamed:
+            Metrics.tile('greyhound_read', 'database')
+            resp = Response(Metrics.streamed(
+                'greyhound_read', start, stream_points(box, schema_pcid, lod)))
+        elif resp is None:
+            Metrics.tile('greyhound_read', 'database')
+            read = self.read_points(box, offset, schema_pcid, lod)
+            Cache.greyhound.put(key, read)
+            TileStore.put('greyhound', key, read)
+            resp = Response(read)
 
-        # prepare parameters
+        # build flask response
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        resp.headers['Content-Type'] = 'application/octet-stream'
+
+        if read is not None:
+            Metrics.request('greyhound_read', start, len(read),
+                            utils.npoints_from_greyhound_read(read))
+        elif not streamed:
+            # served from the store
+            Metrics.request('greyhound_read', start,
+                            resp.content_length or 0)
+
+        return resp
+
+    @staticmethod
+    def parameters(args):
+        """
+        Returns the box, offset, output pcid and lod of a read request
+        """
         offset = utils.list_from_str(args['offset'])
         box = utils.list_from_str(args['bounds'])
         lod = args['depthEnd'] - LOADER_GREYHOUND_MIN_DEPTH - 1
@@ -66,32 +262,29 @@ class GreyhoundRead(object):
         if args['scale'] == 0.01:
             schema_pcid = Config.POTREE_SCH_PCID_SCALE_001
 
-        # get points in database
-        if Config.STATS:
-            t0 = int(round(time.time() * 1000))
-        [read, npoints] = get_points(box, offset, schema_pcid, lod)
-        if Config.STATS:
-            t1 = int(round(time.time() * 1000))
-
-        # log stats
-        if npoints > 0 and Config.STATS:
-            stats = Stats.get()
-            stats_npoints = stats['npoints'] + npoints
-            Stats.set(stats_npoints, (t1-t0)+stats['time_msec'])
-            stats = Stats.get()
-            print("Points/sec: ", stats['rate_sec'])
+        return [box, offset, schema_pcid, lod]
 
-        # build flask response
-        resp = Response(read)
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        resp.headers['Content-Type'] = 'application/octet-stream'
-
-        return resp
+    def read_points(self, box, offset, schema_pcid, lod):
+        return get_points(box, offset, schema_pcid, lod)[0]
 
 
 class GreyhoundHierarchy(object):
 
+    @timed('greyhound_hierarchy')
     def run(self, args):
+        start = time.perf_counter()
+        hcy = self.hierarchy(args)
+        with span('serialize'):
+            hcy = json.dumps(hcy)
+        resp = Response(hcy)
+
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        resp.headers['Content-Type'] = 'text/plain'
+
+        Metrics.request('greyhound_hierarchy', start, len(hcy))
+        return resp
+
+    def hierarchy(self, args):
         lod_min = args['depthBegin'] - LOADER_GREYHOUND_MIN_DEPTH
 
         lod_max = args['depthEnd'] - LOADER_GREYHOUND_MIN_DEPTH - 1
@@ -100,27 +293,213 @@ class GreyhoundHierarchy(object):
 
         bbox = utils.list_from_str(args['bounds'])
 
-        filename = ("{0}_{1}_{2}_{3}.hcy"
-                    .format(Session.dbname, lod_min, lod_max,
-                            '_'.join(str(e) for e in bbox)))
-        cached_hcy = utils.read_in_cache(filename)
+        hcy = None
+        index = NodeIndex.get()
+        if index is not None:
+            hcy = index.hierarchy(lod_min, lod_max, bbox)
+        if hcy is None:
+            # bounds are not a node of the octree of the dataset or the
+            # index is being built
+            if Config.DEBUG:
+                print("hierarchy not indexed: {0}".format(bbox))
+            hcy = build_hierarchy_from_pg(lod_max, bbox, lod_min)
 
-        if Config.DEBUG:
-            print("hierarchy file: {0}".format(filename))
+        return hcy
 
-        if cached_hcy:
-            resp = Response(json.dumps(cached_hcy))
-        else:
-            new_hcy = build_hierarchy_from_pg(lod_max, bbox, lod_min)
-            utils.write_in_cache(new_hcy, filename)
-            resp = Response(json.dumps(new_hcy))
 
-        # resp = Response(json.dumps(fake_hierarchy(0, 6, 10000)))
+class NodeIndex(object, metaclass=Scoped):
+    """
+    Number of points of every node of the octree of the dataset, down to
+    Config.DEPTH. The index is built once by a single worker (or by
+    tools/build_hierarchy.py), stored in CACHE_DIR along with the
+    signature of the table and loaded in memory by each worker so that
+    any subtree of the octree is answered without querying the database.
+    It's built again when the table changes.
+    """
 
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        resp.headers['Content-Type'] = 'text/plain'
+    _scoped = frozenset(['_index'])
+    _index = None
+    _lock = Lock()
+
+    def __init__(self, bbox, counts, signature=None):
+        self.bbox = bbox
+        self.counts = counts
+        self.signature = signature
+        self.alive = alive_cells(counts, 0, len(counts) - 1)
+
+    @classmethod
+    def get(cls, wait=False):
+        """
+        Returns the index of the dataset. While it's built by another
+        worker or thread, None is returned unless wait.
+        """
+        signature = cls.signature_of(Metadata.version())
+        index = cls._index
+        if index is not None and index.signature == signature:
+            return index
+
+        if not cls._lock.acquire(blocking=wait):
+            return None
+        try:
+            index = cls._index
+            if index is None or index.signature != signature:
+                index = cls.load_or_build(signature, wait)
+                if index is not None:
+                    cls._index = index
+            return index
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def load_or_build(cls, signature, wait=False):
+        bbox = Metadata.get()['bounds']
+        path = cls.filename()
+
+        index = cls.load_valid(path, bbox, signature)
+        if index is not None:
+            return index
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if wait
+                            else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # being built by another worker
+                return None
+            try:
+                # the worker holding the lock may have written it
+                index = cls.load_valid(path, bbox, signature)
+                if index is None:
+                    index = cls.build(bbox, Config.DEPTH - 1)
+                    index.signature = signature
+                    index.save(path)
+                return index
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @classmethod
+    def load_valid(cls, path, bbox, signature):
+        """
+        Returns the index stored in path or None if it's missing or
+        doesn't match the bbox, the depth or the signature of the table
+        """
+        if not os.path.exists(path):
+            return None
+        index = cls.load(path)
+        if index.bbox == bbox and len(index.counts) >= Config.DEPTH \
+                and index.signature == signature:
+            return index
+        return None
+
+    @staticmethod
+    def signature_of(signature):
+        # the signature is compared with the one stored in json
+        return json.dumps(signature, sort_keys=True)
+
+    @staticmethod
+    def filename():
+        return os.path.join(Config.CACHE_DIR, "{0}_{1}_{2}.nodes.npz"
+                            .format(Session.dbname, Session.table,
+                                    Session.column))
+
+    @classmethod
+    def build(cls, bbox, lod_max):
+        counts = count_subtree(bbox, 0, (0, 0, 0), lod_max)
+        return cls(bbox, [counts[lod] for lod in range(0, lod_max + 1)])
+
+    def save(self, path):
+        arrays = {'bbox': numpy.array(self.bbox, dtype=numpy.float64)}
+        if self.signature is not None:
+            arrays['signature'] = numpy.array(self.signature)
+        for lod, counts in enumerate(self.counts):
+            arrays['lod_{0}'.format(lod)] = numpy.array(
+                [cell + (n,) for cell, n in counts.items()],
+                dtype=numpy.int64).reshape(-1, 4)
+
+        f = io.BytesIO()
+        numpy.savez_compressed(f, **arrays)
+        utils.write_atomic(path, f.getvalue())
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as arrays:
+            bbox = arrays['bbox'].tolist()
+            signature = None
+            if 'signature' in arrays:
+                signature = str(arrays['signature'])
+            counts = []
+            while 'lod_{0}'.format(len(counts)) in arrays:
+                rows = arrays['lod_{0}'.format(len(counts))].tolist()
+                counts.append({(ix, iy, iz): n for ix, iy, iz, n in rows})
+        return cls(bbox, counts, signature)
+
+    def cell(self, bbox, lod):
+        """
+        Returns the index of the cell at lod whose bounds are bbox or None
+        if bbox is not a node of the octree
+        """
+        ncells = pow(2, lod)
+        cell = []
+        for axis in range(0, 3):
+            side = (self.bbox[axis + 3] - self.bbox[axis]) / ncells
+            i = round((bbox[axis] - self.bbox[axis]) / side)
+            if not 0 <= i < ncells \
+                    or abs(self.bbox[axis] + i * side - bbox[axis]) > \
+                    side * 1e-6 \
+                    or abs(bbox[axis + 3] - bbox[axis] - side) > side * 1e-6:
+                return None
+            cell.append(i)
+        return tuple(cell)
+
+    def hierarchy(self, lod_min, lod_max, bbox):
+        """
+        Returns the hierarchy of the node bbox at lod_min down to lod_max or
+        None if it's not part of the index
+        """
+        if lod_max >= len(self.counts):
+            return None
+
+        cell = self.cell(bbox, lod_min)
+        if cell is None:
+            return None
+
+        if cell not in self.alive[lod_min]:
+            return {}
+
+        return hierarchy_from_counts(self.counts, self.alive, lod_min,
+                                     lod_max, cell)
+
+
+class PatchDecoder(object):
+    """
+    Decompresses laz pcpatchs into structured arrays of dtype. The lazperf
+    schema is serialized once and points are decompressed in a buffer
+    reused by each thread: an array returned is only valid until the next
+    call in the same thread.
+    """
 
-        return resp
+    def __init__(self, schema, dtype):
+        self.schema = json.dumps(schema.json())
+        self.dtype = dtype
+        self._local = local()
+
+    def buffer(self, nbytes):
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None or len(buf) < nbytes:
+            buf = numpy.empty(nbytes, dtype=numpy.uint8)
+            self._local.buffer = buf
+        return buf[:nbytes]
+
+    def decompress(self, pcpatch_wkb):
+        npoints = utils.npoints_from_wkb_pcpatch(pcpatch_wkb)
+        lazdata = numpy.frombuffer(
+            utils.lazdata_from_wkb_pcpatch(pcpatch_wkb), dtype=numpy.uint8)
+
+        output = self.buffer(npoints * self.dtype.itemsize)
+        Decompressor(lazdata, self.schema).decompress(output)
+
+        return output.view(self.dtype)
 
 
 # -----------------------------------------------------------------------------
@@ -156,90 +535,187 @@ class GreyhoundReadSchema(utils.Schema):
         self.dims.append(utils.Dimension("Blue", "unsigned", 2))
 
 
+READ_DECODER = PatchDecoder(GreyhoundReadSchema(), READ_DTYPE)
+
+
 # -----------------------------------------------------------------------------
 # utility functions specific greyhound
 # -----------------------------------------------------------------------------
-def sql_query(box, schema_pcid, lod):
-    poly = utils.boundingbox_to_polygon(box)
+def sql_query(box, schema_pcid, lod, count=False):
+    """
+    Returns the statement reading the points of a box at a lod, or only
+    counting them, along with its parameters
+    """
+    range_min, range_max = points_range(lod)
 
-    # retrieve the number of points to select in a pcpatch
-    range_min = 0
-    range_max = 1
-    if Config.MAX_POINTS_PER_PATCH:
-        range_min = 0
-        range_max = Config.MAX_POINTS_PER_PATCH
+    parameters = [box[0], box[1], box[3], box[4], range_min, range_max,
+                  box[2], box[5], schema_pcid, Session.srsid(),
+                  Config.MAX_PATCHS_PER_QUERY]
+
+    if Config.USE_OCTREE_KEY:
+        parameters += OctreeKey.parameters(box)
+
+    return [read_statement(lod, schema_pcid, count), parameters]
+
+
+def read_statement(lod, schema_pcid, count=False):
+    """
+    Returns the statement reading or counting points according to the way
+    patchs are selected
+    """
+    if use_lod_table(lod):
+        return lod_statement(lod, schema_pcid, count)
+    elif Config.USE_OCTREE_KEY:
+        return COUNT_POINTS_OCTREE if count else READ_POINTS_OCTREE
+    elif Config.USE_MORTON:
+        return COUNT_POINTS_MORTON if count else READ_POINTS_MORTON
     else:
-        beg = 0
-        for i in range(0, lod):
-            beg = beg + pow(4, i)
-
-        end = 0
-        for i in range(0, lod+1):
-            end = end + pow(4, i)
-
-        range_min = beg
-        range_max = end-beg
-
-    # build the sql query
-    sql_limit = ""
-    if Config.MAX_PATCHS_PER_QUERY:
-        sql_limit = " limit {0} ".format(Config.MAX_PATCHS_PER_QUERY)
-
-    if Config.USE_MORTON:
-        sql = ("select pc_compress(pc_patchtransform(pc_union("
-               "pc_filterbetween( "
-               "pc_range({0}, {4}, {5}), 'Z', {6}, {7} )), {9}), 'laz') from "
-               "(select {0} from {1} "
-               "where pc_intersects({0}, st_geomfromtext('polygon (("
-               "{2}))',{3})) order by morton {8})_;"
-               .format(Session.column, Session.table,
-                       poly, Session.srsid(), range_min, range_max,
-                       box[2], box[5], sql_limit,
-                       schema_pcid))
+        return COUNT_POINTS if count else READ_POINTS
+
+
+def use_lod_table(lod):
+    """
+    Returns True if the points of lod are read from its lod table, which
+    are only built for the lods of the octree (Config.DEPTH): deeper ones
+    are read from the table of the patchs
+    """
+    return Config.USE_LOD_TABLES and lod < Config.DEPTH
+
+
+def lod_statement(lod, schema_pcid, count=False):
+    key = (Session.table, lod, schema_pcid, count)
+    if key not in LOD_STATEMENTS:
+        [where, types] = patchs_selection()
+        sql = COUNT_LOD_POINTS_SQL if count else READ_LOD_POINTS_SQL
+        name = "lopocs_{0}_lod{1}_{2}".format(
+            'count' if count else 'read', lod, schema_pcid)
+        LOD_STATEMENTS[key] = Statement(
+            name, sql.format(lod_table(lod, schema_pcid), where), types)
+
+    return LOD_STATEMENTS[key]
+
+
+def stream_statement(lod, schema_pcid):
+    key = (Session.table, lod, schema_pcid)
+    if key not in STREAM_STATEMENTS:
+        [where, types] = patchs_selection()
+        if use_lod_table(lod):
+            sql = STREAM_LOD_POINTS_SQL.format(
+                lod_table(lod, schema_pcid), where)
+        else:
+            sql = STREAM_POINTS_SQL.format(where)
+
+        name = "lopocs_stream_lod{0}_{1}".format(lod, schema_pcid)
+        STREAM_STATEMENTS[key] = Statement(name, sql, types)
+
+    return STREAM_STATEMENTS[key]
+
+
+def patchs_selection():
+    """
+    Returns the clause selecting the patchs of a box and the types of the
+    parameters of the statement
+    """
+    if Config.USE_OCTREE_KEY:
+        return [PATCHS_IN_OCTREE, OCTREE_TYPES]
+    elif Config.USE_MORTON:
+        return [PATCHS_INTERSECTING + ' order by morton', READ_POINTS_TYPES]
     else:
-        sql = ("select pc_compress(pc_patchtransform(pc_union("
-               "pc_filterbetween( "
-               "pc_range({0}, {4}, {5}), 'Z', {6}, {7} )), {9}), 'laz') from "
-               "(select {0} from {1} where pc_intersects({0}, "
-               "st_geomfromtext('polygon (({2}))',{3})) {8})_;"
-               .format(Session.column, Session.table,
-                       poly, Session.srsid(), range_min, range_max,
-                       box[2], box[5], sql_limit,
-                       schema_pcid))
+        return [PATCHS_INTERSECTING, READ_POINTS_TYPES]
+
+
+def lod_table(lod, schema_pcid):
+    """
+    Returns the name of the table with the points of lod in schema_pcid
+    """
+    return "{0}_lod{1}_{2}".format(Session.table, lod, schema_pcid)
+
+
+def points_range(lod):
+    """
+    Returns the first point and the number of points to select in a
+    pcpatch for a lod
+    """
+    if Config.MAX_POINTS_PER_PATCH:
+        return [0, Config.MAX_POINTS_PER_PATCH]
+
+    beg = 0
+    for i in range(0, lod):
+        beg = beg + pow(4, i)
 
-    return sql
+    end = 0
+    for i in range(0, lod+1):
+        end = end + pow(4, i)
+
+    return [beg, end-beg]
 
 
 def get_points(box, offset, schema_pcid, lod):
 
-    npoints = 0
-    hexbuffer = bytearray()
-    sql = sql_query(box, schema_pcid, lod)
+    [sql, parameters] = sql_query(box, schema_pcid, lod)
 
     if Config.DEBUG:
-        print(sql)
+        print(sql, parameters)
+
+    # errors go up to the request: a tile which couldn't be read must not
+    # be cached nor stored as an empty one
+    pcpatch_wkb = Session.query_aslist(
+        sql, parameters, context={'bounds': box, 'lod': lod})[0]
+
+    with span('encode'):
+        return encode_points(pcpatch_wkb, lod)
 
-    try:
-        pcpatch_wkb = Session.query_aslist(sql)[0]
-        # to test output from pgpointcloud : decompress(points)
 
+def stream_points(box, schema_pcid, lod):
+    """
+    Yields the uncompressed points of the patchs of a box, fetched by
+    batches of GREYHOUND_STREAM_BATCH patchs, followed by their number
+    """
+    [_, parameters] = sql_query(box, schema_pcid, lod)
+    sql = stream_statement(lod, schema_pcid)
+    batch = Config.GREYHOUND_STREAM_BATCH
+
+    if Config.DEBUG:
+        print(sql, parameters)
+
+    npoints = 0
+    for rows in Session.stream(sql, parameters, batch):
+        chunk = bytearray()
+        for [pcpatch_wkb] in rows:
+            # patchs without points in the box
+            if pcpatch_wkb is None:
+                continue
+            npoints += utils.npoints_from_wkb_pcpatch(pcpatch_wkb)
+            chunk += utils.rawdata_from_wkb_pcpatch(pcpatch_wkb)
+        if chunk:
+            yield bytes(chunk)
+
+    Metrics.points('greyhound_read', npoints)
+    yield utils.hexa_signed_int32(npoints)
+
+
+def encode_points(pcpatch_wkb, lod):
+    """
+    Returns the greyhound read buffer of the points of a laz pcpatch along
+    with their number. The pcpatch is None when no patch is in the box.
+    """
+    if pcpatch_wkb is None:
+        npoints = 0
+        read = utils.hexa_signed_int32(0)
+    else:
         # retrieve number of points in wkb pgpointcloud patch
         npoints = utils.npoints_from_wkb_pcpatch(pcpatch_wkb)
 
-        # extract data
-        hexbuffer = utils.hexdata_from_wkb_pcpatch(pcpatch_wkb)
-
-        # add number of points
-        hexbuffer += utils.hexa_signed_int32(npoints)
-    except:
-        hexbuffer.extend(utils.hexa_signed_int32(0))
+        # laz data followed by the number of points, copied once
+        read = b''.join([utils.lazdata_from_wkb_pcpatch(pcpatch_wkb),
+                         utils.hexa_signed_int32(npoints)])
 
     if Config.DEBUG:
         print("LOD: ", lod)
         print("DEPTH: ", Config.DEPTH)
         print("NUM POINTS RETURNED: ", npoints)
 
-    return [hexbuffer, npoints]
+    return [read, npoints]
 
 
 def fake_hierarchy(begin, end, npatchs):
@@ -263,113 +739,107 @@ def fake_hierarchy(begin, end, npatchs):
 
 
 def build_hierarchy_from_pg(lod_max, bbox, lod):
+    """
+    Builds the hierarchy of the octree rooted at bbox with one query per
+    level counting the points of all the nodes of the level at once
+    """
+    counts = {}
+    for level in range(lod, lod_max + 1):
+        counts[level] = count_points_by_cell(bbox, level - lod, level)
 
-    # run sql
-    sql = sql_query(bbox, Config.POTREE_SCH_PCID_SCALE_01, lod)
-    pcpatch_wkb = Session.query_aslist(sql)[0]
+    alive = alive_cells(counts, lod, lod_max)
 
-    hierarchy = {}
-    if lod <= lod_max and pcpatch_wkb:
-        npoints = utils.npoints_from_wkb_pcpatch(pcpatch_wkb)
-        hierarchy['n'] = npoints
+    return hierarchy_from_counts(counts, alive, lod, lod_max, (0, 0, 0))
 
-    lod += 1
-
-    if lod <= lod_max:
-        # width / length / height
-        width = bbox[3] - bbox[0]
-        length = bbox[4] - bbox[1]
-        height = bbox[5] - bbox[2]
-
-        up = bbox[5]
-        middle = up - height/2
-        down = bbox[2]
-
-        x = bbox[0]
-        y = bbox[1]
-
-        # nwd
-        bbox_nwd = [x, y+length/2, down, x+width/2, y+length, middle]
-        h_nwd = build_hierarchy_from_pg(lod_max, bbox_nwd, lod)
-        if h_nwd:
-            hierarchy['nwd'] = h_nwd
-
-        # nwu
-        bbox_nwu = [x, y+length/2, middle, x+width/2, y+length, up]
-        h_nwu = build_hierarchy_from_pg(lod_max, bbox_nwu, lod)
-        if h_nwu:
-            hierarchy['nwu'] = h_nwu
-
-        # ned
-        bbox_ned = [x+width/2, y+length/2, down, x+width, y+length, middle]
-        h_ned = build_hierarchy_from_pg(lod_max, bbox_ned, lod)
-        if h_ned:
-            hierarchy['ned'] = h_ned
-
-        # neu
-        bbox_neu = [x+width/2, y+length/2, middle, x+width, y+length, up]
-        h_neu = build_hierarchy_from_pg(lod_max, bbox_neu, lod)
-        if h_neu:
-            hierarchy['neu'] = h_neu
-
-        # swd
-        bbox_swd = [x, y, down, x+width/2, y+length/2, middle]
-        h_swd = build_hierarchy_from_pg(lod_max, bbox_swd, lod)
-        if h_swd:
-            hierarchy['swd'] = h_swd
-
-        # swu
-        bbox_swu = [x, y, middle, x+width/2, y+length/2, up]
-        h_swu = build_hierarchy_from_pg(lod_max, bbox_swu, lod)
-        if h_swu:
-            hierarchy['swu'] = h_swu
-
-        # sed
-        bbox_sed = [x+width/2, y, down, x+width, y+length/2, middle]
-        h_sed = build_hierarchy_from_pg(lod_max, bbox_sed, lod)
-        if h_sed:
-            hierarchy['sed'] = h_sed
-
-        # seu
-        bbox_seu = [x+width/2, y, middle, x+width, y+length/2, up]
-        h_seu = build_hierarchy_from_pg(lod_max, bbox_seu, lod)
-        if h_seu:
-            hierarchy['seu'] = h_seu
 
-    return hierarchy
+def count_subtree(bbox, lod, cell, lod_max):
+    """
+    Counts the points of the nodes of the subtree rooted at the cell of
+    the octree of bbox at lod, down to lod_max. Returns a dict of counts
+    for each level with cells indexed in the octree of bbox.
+    """
+    ncells = pow(2, lod)
+    subtree_bbox = (
+        [bbox[a] + (bbox[a + 3] - bbox[a]) * cell[a] / ncells
+         for a in range(0, 3)] +
+        [bbox[a] + (bbox[a + 3] - bbox[a]) * (cell[a] + 1) / ncells
+         for a in range(0, 3)])
+
+    counts = {}
+    for level in range(lod, lod_max + 1):
+        shift = pow(2, level - lod)
+        counts[level] = {
+            (cell[0] * shift + ix, cell[1] * shift + iy,
+             cell[2] * shift + iz): n
+            for (ix, iy, iz), n in count_points_by_cell(
+                subtree_bbox, level - lod, level).items()}
+
+    return counts
+
+
+def alive_cells(counts, lod, lod_max):
+    """
+    Returns the cells of each level having points or descendants with
+    points
+    """
+    alive = {lod_max: set(counts[lod_max])}
+    for level in range(lod_max - 1, lod - 1, -1):
+        alive[level] = set(counts[level])
+        alive[level].update((ix // 2, iy // 2, iz // 2)
+                            for ix, iy, iz in alive[level + 1])
+    return alive
 
 
-def decompress(points):
+def count_points_by_cell(bbox, depth, lod):
     """
-    'points' is a pcpatch in wkb
+    Splits bbox in a regular grid of 2^depth cells along each axis and
+    returns the number of points at lod for each non empty cell as a dict
+    indexed by (ix, iy, iz). As for reads, the points of a patch are
+    counted in every cell intersecting the patch extent. Points are only
+    counted, never compressed nor sent.
     """
+    ncells = pow(2, depth)
+    range_min, range_max = points_range(lod)
+
+    parameters = [bbox[0], bbox[1], bbox[2],
+                  (bbox[3] - bbox[0]) / ncells,
+                  (bbox[4] - bbox[1]) / ncells,
+                  (bbox[5] - bbox[2]) / ncells,
+                  ncells, range_min, range_max, Session.srsid()]
+
+    if Config.DEBUG:
+        print(COUNT_POINTS_BY_CELL, parameters)
+
+    return {(row[0], row[1], row[2]): row[3]
+            for row in Session.query(COUNT_POINTS_BY_CELL, parameters,
+                                     context={'bounds': bbox, 'lod': lod,
+                                              'depth': depth})}
 
-    # retrieve number of points in wkb pgpointcloud patch
-    npoints = utils.npoints_from_wkb_pcpatch(points)
-    hexbuffer = utils.hexdata_from_wkb_pcpatch(points)
-    hexbuffer += utils.hexa_signed_int32(npoints)
 
-    # uncompress
-    s = json.dumps(GreyhoundReadSchema().json()).replace("\\", "")
-    dtype = buildNumpyDescription(json.loads(s))
+def hierarchy_from_counts(counts, alive, lod, lod_max, cell):
+    hierarchy = {}
+
+    npoints = counts[lod].get(cell)
+    if npoints:
+        hierarchy['n'] = npoints
 
-    lazdata = bytes(hexbuffer)
+    if lod < lod_max:
+        ix, iy, iz = cell
+        for name, (dx, dy, dz) in OCTANTS:
+            child = (2 * ix + dx, 2 * iy + dy, 2 * iz + dz)
+            if child in alive[lod + 1]:
+                hierarchy[name] = hierarchy_from_counts(
+                    counts, alive, lod + 1, lod_max, child)
 
-    arr = numpy.fromstring(lazdata, dtype=numpy.uint8)
-    d = Decompressor(arr, s)
-    output = numpy.zeros(npoints * dtype.itemsize, dtype=numpy.uint8)
-    decompressed = d.decompress(output)
+    if hierarchy and 'n' not in hierarchy:
+        hierarchy['n'] = 0
 
-    decompressed_str = numpy.ndarray.tostring(decompressed)
+    return hierarchy
 
-    # import struct
-    # for i in range(0, npoints):
-    #     point = decompressed_str[dtype.itemsize*i:dtype.itemsize*(i+1)]
-    #     x = point[0:4]
-    #     y = point[4:8]
-    #     z = point[8:12]
-    #     xd = struct.unpack("i", x)
-    #     yd = struct.unpack("i", y)
-    #     zd = struct.unpack("i", z)
 
-    return [decompressed_str, dtype.itemsize]
+def decompress(points):
+    """
+    Returns the points of a laz pcpatch in binary wkb as an array of
+    READ_DTYPE, see PatchDecoder
+    """
+    return READ_DECODER.decompress(points)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import json
+import os
+import time
+from threading import Lock
+
+from .conf import Config
+from .database import Session
+from . import utils
+from .scope import Scoped
+
+# minimum delay in seconds between two checks of the table and of the
+# stored metadata by a worker
+CHECK_INTERVAL = 60
+
+
+class Metadata(metaclass=Scoped):
+    """
+    Metadata of the dataset served by the info endpoints: bounds, number
+    of points and srs. They are computed once, stored in CACHE_DIR and
+    loaded by each worker at startup. They are computed again only when
+    the table changes or when another process rewrote the stored file
+    (see tools/refresh_metadata.py), by a single worker which the other
+    ones wait for. The table is checked without blocking the requests,
+    which are served with the previous metadata meanwhile. Bodies of the
+    info endpoints are serialized once for the current metadata.
+    """
+
+    _scoped = frozenset(['values', 'signature', 'mtime', 'checked', 'bodies'])
+    values = None
+    signature = None
+    mtime = None
+    checked = 0
+    bodies = {}
+    _lock = Lock()
+    _checking = Lock()
+
+    @classmethod
+    def init(cls):
+        cls.values = None
+        cls.signature = None
+        cls.mtime = None
+        cls.checked = 0
+        cls.bodies = {}
+
+        if os.path.exists(cls.filename()):
+            cls.load()
+
+    @staticmethod
+    def filename():
+        return os.path.join(Config.CACHE_DIR, "{0}_{1}_{2}.metadata.json"
+                            .format(Session.dbname, Session.table,
+                                    Session.column))
+
+    @classmethod
+    def get(cls):
+        return cls._get()[0]
+
+    @classmethod
+    def version(cls):
+        """
+        Returns the signature of the table the metadata were computed for,
+        which changes when the table is modified
+        """
+        return cls._get()[1]
+
+    @classmethod
+    def body(cls, name, build):
+        """
+        Returns the body of the info endpoint name, serialized by build
+        from the metadata when they change
+        """
+        cls._get()
+        with cls._lock:
+            if name not in cls.bodies:
+                cls.bodies[name] = build(cls.values)
+            return cls.bodies[name]
+
+    @classmethod
+    def _get(cls):
+        """
+        Returns the metadata and the signature of the table. They are
+        checked by a single thread at once, the other ones keep the
+        previous metadata meanwhile and only wait for the first ones.
+        """
+        with cls._lock:
+            [values, signature] = [cls.values, cls.signature]
+            due = time.time() - cls.checked > CHECK_INTERVAL
+        if (values is None or due) and \
+                cls._checking.acquire(blocking=values is None):
+            try:
+                with cls._lock:
+                    due = (cls.values is None or
+                           time.time() - cls.checked > CHECK_INTERVAL)
+                if due:
+                    cls.check()
+            finally:
+                cls._checking.release()
+            with cls._lock:
+                [values, signature] = [cls.values, cls.signature]
+        return [values, signature]
+
+    @classmethod
+    def check(cls):
+        with cls._lock:
+            cls.checked = time.time()
+
+        cls.reload()
+        signature = cls.table_signature()
+        if cls.values is not None and cls.signature == signature:
+            return
+
+        # a single worker computes the metadata, the other ones load them
+        path = cls.filename()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                cls.reload()
+                if cls.values is None or cls.signature != signature:
+                    cls.refresh(signature)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @classmethod
+    def reload(cls):
+        """
+        Loads the stored metadata if another process rewrote them
+        """
+        try:
+            mtime = os.stat(cls.filename()).st_mtime
+        except OSError:
+            return
+        if mtime != cls.mtime:
+            cls.load()
+
+    @classmethod
+    def refresh(cls, signature=None):
+        """
+        Computes the metadata from the table and stores them
+        """
+        if signature is None:
+            signature = cls.table_signature()
+        values = cls.compute()
+
+        path = cls.filename()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        utils.write_atomic(path, json.dumps({
+            "signature": signature,
+            "values": values}).encode('utf-8'))
+        cls.swap(signature, values, os.stat(path).st_mtime)
+
+    @classmethod
+    def load(cls):
+        path = cls.filename()
+        mtime = os.stat(path).st_mtime
+        with open(path, 'r') as f:
+            content = json.load(f)
+        cls.swap(content['signature'], content['values'], mtime)
+
+    @classmethod
+    def swap(cls, signature, values, mtime):
+        with cls._lock:
+            cls.signature = signature
+            cls.values = values
+            cls.mtime = mtime
+            cls.bodies = {}
+
+    @staticmethod
+    def compute():
+        if Config.BB:
+            box = Config.BB
+        else:
+            box = Session.boundingbox()
+
+        # number of points for the first patch
+        npoints = Session.approx_row_count() * Session.patch_size()
+
+        return {
+            "bounds": [box['xmin'], box['ymin'], box['zmin'],
+                       box['xmax'], box['ymax'], box['zmax']],
+            "numPoints": int(npoints),
+            "srs": Session.srs()}
+
+    @staticmethod
+    def table_signature():
+        """
+        Returns values changing when rows of the table are modified (or the
+        table rewritten), along with the configured bounding box
+        """
+        sql = ("select c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del "
+               "from pg_class c left join pg_stat_all_tables s "
+               "on s.relid = c.oid where c.oid = %s::regclass")
+        return Session.query_aslist(sql, [Session.table]) + [Config.BB]
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+from .conf import Config
+from .scope import current
+from . import utils
+
+# upper bounds in seconds of the buckets of the histograms of durations
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+
+# files of the spool directory besides the ones of the workers: sum of the
+# metrics of the workers which are gone, server the spool belongs to and
+# lock of the files
+AGGREGATE = 'aggregate.json'
+SERVER = 'server.json'
+LOCK = '.lock'
+
+# name: type, labels and help of the metrics
+METRICS = {
+    'lopocs_request_duration_seconds': (
+        'histogram', ('dataset', 'endpoint'),
+        'Duration of the requests'),
+    'lopocs_response_bytes_total': (
+        'counter', ('dataset', 'endpoint'),
+        'Bytes of the bodies of the responses'),
+    'lopocs_points_total': (
+        'counter', ('dataset', 'endpoint'),
+        'Points sent in the responses'),
+    'lopocs_tiles_total': (
+        'counter', ('dataset', 'endpoint', 'source'),
+        'Tiles served from the cache, the store or the database'),
+    'lopocs_stage_duration_seconds': (
+        'histogram', ('dataset', 'endpoint', 'stage'),
+        'Time spent in each stage of the requests'),
+    'lopocs_pool_wait_seconds': (
+        'histogram', (),
+        'Time spent waiting for a connection of the pool'),
+}
+
+
+class Metrics():
+    """
+    Metrics of the requests served by the worker, aggregated in memory and
+    exported in the Prometheus text format by /infos/metrics. Each worker
+    writes its metrics in a file of the spool directory (METRICS_DIR, every
+    METRICS_FLUSH_INTERVAL seconds at most) so that any worker exports the
+    metrics of all the running ones. Metrics of the workers which are gone
+    are kept in an aggregate so that counters never decrease, and the spool
+    is cleared when the server is started again.
+
+    Counters are stored as numbers and histograms as lists of the counts
+    of each bucket (and of +Inf) followed by the sum of the observations.
+    """
+
+    enabled = False
+    root = None
+    values = {}
+    flushed = 0
+    joined = None
+    _lock = Lock()
+
+    @classmethod
+    def init(cls):
+        cls.enabled = Config.METRICS
+        cls.root = Config.METRICS_DIR or os.path.join(Config.CACHE_DIR,
+                                                      'metrics')
+        cls.values = {}
+        cls.flushed = time.monotonic()
+        cls.joined = None
+        if cls.enabled:
+            os.makedirs(cls.root, exist_ok=True)
+
+    # -------------------------------------------------------------------------
+    # recording
+    # -------------------------------------------------------------------------
+    @classmethod
+    def request(cls, endpoint, start, nbytes=0, npoints=0):
+        """
+        Records a request started at start (a time.perf_counter() value)
+        """
+        if not cls.enabled:
+            return
+        labels = (dataset_name(), endpoint)
+        duration = time.perf_counter() - start
+        with cls._lock:
+            cls._observe('lopocs_request_duration_seconds', labels, duration)
+            cls._add('lopocs_response_bytes_total', labels, nbytes)
+            cls._add('lopocs_points_total', labels, npoints)
+        cls._maybe_flush()
+
+    @classmethod
+    def streamed(cls, endpoint, start, chunks):
+        """
+        Yields the chunks of a streamed response and records the request
+        once they are all sent
+        """
+        nbytes = 0
+        try:
+            for chunk in chunks:
+                nbytes += len(chunk)
+                yield chunk
+        finally:
+            cls.request(endpoint, start, nbytes)
+
+    @classmethod
+    def points(cls, endpoint, npoints):
+        if not cls.enabled:
+            return
+        with cls._lock:
+            cls._add('lopocs_points_total', (dataset_name(), endpoint),
+                     npoints)
+
+    @classmethod
+    def tile(cls, endpoint, source):
+        """
+        Records a tile served from source: 'cache', 'store' or 'database'
+        """
+        if not cls.enabled:
+            return
+        with cls._lock:
+            cls._add('lopocs_tiles_total', (dataset_name(), endpoint, source),
+                     1)
+
+    @classmethod
+    def stage(cls, endpoint, stage, duration):
+        """
+        Records the duration of a stage of a request (see lopocs.timing):
+        'pool', 'database', 'fetch', 'decompress', 'pnts', 'encode' or
+        'serialize'
+        """
+        if not cls.enabled:
+            return
+        with cls._lock:
+            cls._observe('lopocs_stage_duration_seconds',
+                         (dataset_name(), endpoint, stage), duration)
+
+    @classmethod
+    def pool_wait(cls, duration):
+        if not cls.enabled:
+            return
+        with cls._lock:
+            cls._observe('lopocs_pool_wait_seconds', (), duration)
+
+    @classmethod
+    def _add(cls, name, labels, value):
+        key = (name, labels)
+        cls.values[key] = cls.values.get(key, 0) + value
+
+    @classmethod
+    def _observe(cls, name, labels, value):
+        key = (name, labels)
+        histogram = cls.values.get(key)
+        if histogram is None:
+            histogram = [0] * (len(DURATION_BUCKETS) + 2)
+            cls.values[key] = histogram
+        histogram[bisect_left(DURATION_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    # -------------------------------------------------------------------------
+    # spool
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _maybe_flush(cls):
+        if time.monotonic() - cls.flushed > Config.METRICS_FLUSH_INTERVAL:
+            cls.flush()
+
+    @classmethod
+    def flush(cls):
+        """
+        Writes the metrics of the worker in the spool directory
+        """
+        cls.flushed = time.monotonic()
+        # the pid is read here as workers may be forked after init
+        pid = os.getpid()
+        if cls.joined != pid:
+            cls.join()
+        data = json.dumps(cls.snapshot()).encode('utf-8')
+        path = os.path.join(cls.root, '{0}.json'.format(pid))
+        utils.write_atomic(path, data)
+
+    @classmethod
+    def join(cls):
+        """
+        Clears the spool if it was written by a previous run of the server
+        and adds the file of a gone worker with the pid of this one to the
+        aggregate. Done by the worker before its first write rather than
+        in init, which may run in the master (uwsgi without lazy-apps)
+        whose parent isn't the server.
+        """
+        with cls.locked():
+            server = server_id()
+            if load(os.path.join(cls.root, SERVER)) != server:
+                cls.clear()
+                utils.write_atomic(os.path.join(cls.root, SERVER),
+                                   json.dumps(server).encode('utf-8'))
+            cls.retire(os.getpid())
+        cls.joined = os.getpid()
+
+    @classmethod
+    def snapshot(cls):
+        with cls._lock:
+            return [[name, list(labels),
+                     list(value) if isinstance(value, list) else value]
+                    for (name, labels), value in cls.values.items()]
+
+    @classmethod
+    def collect(cls):
+        """
+        Returns the sum of the metrics of the running workers and of the
+        ones which are gone, along with the number of running workers
+        """
+        if not cls.enabled:
+            return [{}, 0]
+
+        cls.flush()
+
+        total = {}
+        workers = 0
+        with cls.locked():
+            for filename in os.listdir(cls.root):
+                [pid, ext] = os.path.splitext(filename)
+                if ext == '.json' and pid.isdigit() and not alive(int(pid)):
+                    cls.retire(int(pid))
+
+            for filename in os.listdir(cls.root):
+                [pid, ext] = os.path.splitext(filename)
+                if filename != AGGREGATE and not (ext == '.json' and
+                                                  pid.isdigit()):
+                    continue
+
+                snapshot = load(os.path.join(cls.root, filename))
+                if snapshot is None:
+                    continue
+                if filename != AGGREGATE:
+                    workers += 1
+                for [name, labels, value] in snapshot:
+                    merge(total, (name, tuple(labels)), value)
+
+        return [total, workers]
+
+    @classmethod
+    def retire(cls, pid):
+        """
+        Adds the metrics of a worker which is gone to the aggregate, the
+        spool must be locked
+        """
+        path = os.path.join(cls.root, '{0}.json'.format(pid))
+        snapshot = load(path)
+        if snapshot is None:
+            return
+
+        aggregate = {}
+        for [name, labels, value] in (
+                load(os.path.join(cls.root, AGGREGATE)) or []) + snapshot:
+            merge(aggregate, (name, tuple(labels)), value)
+        utils.write_atomic(os.path.join(cls.root, AGGREGATE), json.dumps(
+            [[name, list(labels), value]
+             for (name, labels), value in aggregate.items()])
+            .encode('utf-8'))
+        os.remove(path)
+
+    @classmethod
+    def clear(cls):
+        """
+        Removes the files of the workers of a previous run of the server,
+        the spool must be locked
+        """
+        for filename in os.listdir(cls.root):
+            if filename != LOCK:
+                try:
+                    os.remove(os.path.join(cls.root, filename))
+                except OSError:
+                    pass
+
+    @classmethod
+    @contextmanager
+    def locked(cls):
+        """
+        Locks the spool against the other workers
+        """
+        with open(os.path.join(cls.root, LOCK), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # -------------------------------------------------------------------------
+    # export
+    # -------------------------------------------------------------------------
+    @classmethod
+    def render(cls):
+        """
+        Returns the metrics of all the workers in the Prometheus text format
+        """
+        [total, workers] = cls.collect()
+
+        lines = []
+        for name in sorted(METRICS):
+            [kind, labelnames, doc] = METRICS[name]
+            lines.append('# HELP {0} {1}'.format(name, doc))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for (n, labels) in sorted(k for k in total if k[0] == name):
+                value = total[(n, labels)]
+                pairs = list(zip(labelnames, labels))
+                if kind == 'counter':
+                    lines.append(sample(name, pairs, value))
+                    continue
+
+                cumulated = 0
+                for [bound, count] in zip(DURATION_BUCKETS + ('+Inf',),
+                                          value[:-1]):
+                    cumulated += count
+                    lines.append(sample(name + '_bucket',
+                                        pairs + [('le', str(bound))],
+                                        cumulated))
+                lines.append(sample(name + '_sum', pairs, value[-1]))
+                lines.append(sample(name + '_count', pairs, cumulated))
+
+        # ratio of the tiles read from the in-process cache or the store
+        tiles = {}
+        for (name, labels), value in total.items():
+            if name == 'lopocs_tiles_total':
+                counts = tiles.setdefault(labels[:2], [0, 0])
+                counts[0] += value if labels[2] != 'database' else 0
+                counts[1] += value
+        lines.append('# HELP lopocs_cache_hit_ratio Ratio of the tiles '
+                     'served without reading the database')
+        lines.append('# TYPE lopocs_cache_hit_ratio gauge')
+        for labels in sorted(tiles):
+            [hits, count] = tiles[labels]
+            lines.append(sample('lopocs_cache_hit_ratio',
+                                list(zip(('dataset', 'endpoint'), labels)),
+                                hits / count))
+
+        lines.append('# HELP lopocs_workers Workers whose metrics are '
+                     'aggregated')
+        lines.append('# TYPE lopocs_workers gauge')
+        lines.append(sample('lopocs_workers', [], workers))
+
+        return '\n'.join(lines) + '\n'
+
+
+# -----------------------------------------------------------------------------
+# utility functions
+# -----------------------------------------------------------------------------
+def dataset_name():
+    dataset = current()
+    return dataset.name if dataset is not None else ''
+
+
+def load(path):
+    """
+    Returns the json content of a file of the spool or None
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def server_id():
+    """
+    Returns the parent process of the worker (uwsgi or gunicorn master)
+    along with its start time when known, so that a new run of the server
+    is told apart from the previous one even if pids are reused
+    """
+    ppid = os.getppid()
+    try:
+        with open('/proc/{0}/stat'.format(ppid), 'r') as f:
+            stat = f.read()
+        # fields following the command, the start time is the 22nd one
+        started = int(stat[stat.rindex(')') + 2:].split()[19])
+    except (OSError, ValueError, IndexError):
+        started = None
+    return [ppid, started]
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(total, key, value):
+    if isinstance(value, list):
+        histogram = total.setdefault(key, [0] * len(value))
+        for i, v in enumerate(value):
+            histogram[i] += v
+    else:
+        total[key] = total.get(key, 0) + value
+
+
+def sample(name, pairs, value):
+    if pairs:
+        name += '{' + ','.join(
+            '{0}="{1}"'.format(k, escape(v)) for k, v in pairs) + '}'
+    return '{0} {1}'.format(name, format_value(value))
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_value(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
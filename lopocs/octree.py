@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from contextlib import closing
+from threading import Lock
+import numpy
+from psycopg2 import connect
+
+from .database import Session
+from .scope import Scoped
+
+# name of the table storing the octree used to compute the keys of patchs
+OCTREE_TABLE = 'lopocs_octree'
+
+
+class OctreeKey(metaclass=Scoped):
+    """
+    Octree keys of patchs, computed at ingestion by tools/build_octree_key.py
+
+    Each patch is attached to the deepest node of a regular octree which
+    contains its whole extent. The node is stored as its level
+    (octree_level column) and as the 3D morton code of its first cell at
+    the deepest level of the octree (octree_key column). So the nodes
+    inside a node are a range of keys and the patchs intersecting a box
+    are found with btree range scans only.
+    """
+
+    _scoped = frozenset(['bbox', 'depth'])
+    bbox = None
+    depth = None
+    _lock = Lock()
+
+    @classmethod
+    def load(cls):
+        if cls.bbox is None:
+            with cls._lock:
+                if cls.bbox is None:
+                    res = Session.query_aslist(cls.sql(), [Session.table])
+                    [cls.bbox, cls.depth] = cls.parse(res)
+
+    @classmethod
+    def check(cls, dsn):
+        """
+        Raises a RuntimeError if the octree of the table was not built,
+        the query is run on a connection of its own as the pool may be
+        shared by the workers forked afterwards
+        """
+        with closing(connect(dsn)) as conn:
+            cur = conn.cursor()
+            cur.execute(cls.sql(), [Session.table])
+            cls.parse(cur.fetchone())
+
+    @staticmethod
+    def sql():
+        return ("select xmin, ymin, zmin, xmax, ymax, zmax, depth "
+                "from {0} where tablename = %s".format(OCTREE_TABLE))
+
+    @staticmethod
+    def parse(res):
+        """
+        Returns the bbox and the depth of the octree of a row of the octree
+        table
+        """
+        if not res:
+            raise RuntimeError(
+                "no octree for the table {0} in {1} (USE_OCTREE_KEY), run "
+                "tools/build_octree_key.py".format(Session.table,
+                                                   OCTREE_TABLE))
+        return [[float(v) for v in res[0:6]], res[6]]
+
+    @classmethod
+    def parameters(cls, box):
+        """
+        Returns the parameters selecting patchs which may intersect box:
+        the range of keys of the smallest node containing box, the level of
+        this node and the keys of its ancestors
+        """
+        cls.load()
+        level, cell = node_of_box(cls.bbox, cls.depth, box)
+        code = morton_code(*cell)
+        shift = 3 * (cls.depth - level)
+
+        ancestors = [(code >> 3 * (level - lod)) << 3 * (cls.depth - lod)
+                     for lod in range(0, level)]
+
+        return [code << shift, (code + 1) << shift, level, ancestors]
+
+
+def part1by2(n):
+    """
+    Spreads the 21 lowest bits of n with 2 zeros between each bit. Works
+    with integers and numpy arrays of integers.
+    """
+    n = n & 0x1fffff
+    n = (n | n << 32) & 0x1f00000000ffff
+    n = (n | n << 16) & 0x1f0000ff0000ff
+    n = (n | n << 8) & 0x100f00f00f00f00f
+    n = (n | n << 4) & 0x10c30c30c30c30c3
+    n = (n | n << 2) & 0x1249249249249249
+    return n
+
+
+def morton_code(x, y, z):
+    return part1by2(x) | (part1by2(y) << 1) | (part1by2(z) << 2)
+
+
+def node_of_box(bbox, depth, box):
+    """
+    Returns the level and the cell indices of the smallest node of the
+    octree of bbox containing box
+    """
+    ncells = pow(2, depth)
+    imin = []
+    imax = []
+    for a in range(0, 3):
+        side = (bbox[a + 3] - bbox[a]) / ncells
+        i = min(max(int((box[a] - bbox[a]) // side), 0), ncells - 1)
+        # cells are half-open so a box ending on the boundary of a cell
+        # doesn't belong to the next one
+        j = min(max(-int(-(box[a + 3] - bbox[a]) // side) - 1, i), ncells - 1)
+        imin.append(i)
+        imax.append(j)
+
+    nbits = max((i ^ j).bit_length() for i, j in zip(imin, imax))
+    level = depth - nbits
+
+    return [level, [i >> nbits for i in imin]]
+
+
+def patch_keys(bbox, depth, pmin, pmax):
+    """
+    Vectorized computation of the octree levels and keys of patchs from
+    their (n, 3) arrays of minimum and maximum coordinates
+    """
+    bbox = numpy.array(bbox, dtype=numpy.float64)
+    ncells = pow(2, depth)
+    side = (bbox[3:] - bbox[:3]) / ncells
+
+    imin = numpy.floor((pmin - bbox[:3]) / side).astype(numpy.int64)
+    imin = numpy.clip(imin, 0, ncells - 1)
+    imax = numpy.ceil((pmax - bbox[:3]) / side).astype(numpy.int64) - 1
+    imax = numpy.clip(numpy.maximum(imax, imin), 0, ncells - 1)
+
+    nbits = numpy.frexp(numpy.bitwise_xor(imin, imax).max(axis=1))[1]
+    level = depth - nbits
+
+    cells = imin >> nbits[:, None] << nbits[:, None]
+    keys = morton_code(cells[:, 0], cells[:, 1], cells[:, 2])
+
+    return [level, keys]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # python < 3.7: the dataset is only local to the thread
+    ContextVar = None
+    from threading import local
+
+if ContextVar is not None:
+    _current = ContextVar('lopocs_dataset', default=None)
+else:
+    _local = local()
+
+
+def current():
+    """
+    Returns the dataset active in the current thread or task, None for the
+    default one
+    """
+    if ContextVar is not None:
+        return _current.get()
+    return getattr(_local, 'dataset', None)
+
+
+def set_current(dataset):
+    if ContextVar is not None:
+        _current.set(dataset)
+    else:
+        _local.dataset = dataset
+
+
+@contextmanager
+def activate(dataset):
+    previous = current()
+    set_current(dataset)
+    try:
+        yield dataset
+    finally:
+        set_current(previous)
+
+
+class Scoped(type):
+    """
+    Metaclass of the classes keeping the state of a dataset in class
+    attributes (Config, Session, caches...). While a dataset is active,
+    the attributes named in _scoped are read from and written to the state
+    of the dataset, unset ones fall back to the values of the class which
+    are the ones of the default dataset.
+    """
+
+    def __getattribute__(cls, name):
+        if name in type.__getattribute__(cls, '_scoped'):
+            dataset = current()
+            if dataset is not None:
+                try:
+                    return dataset.state[(cls, name)]
+                except KeyError:
+                    pass
+        return type.__getattribute__(cls, name)
+
+    def __setattr__(cls, name, value):
+        dataset = current()
+        if dataset is not None and name in cls._scoped:
+            dataset.state[(cls, name)] = value
+        else:
+            type.__setattr__(cls, name, value)
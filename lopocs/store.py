@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+from threading import Lock, Thread
+from flask import Response, send_file
+
+from .conf import Config
+from .database import Session
+from .metadata import Metadata
+from . import utils
+
+
+class TileStore():
+    """
+    Persistent store of encoded tiles shared by all the workers. Tiles are
+    stored under CACHE_DIR/tiles in files named after a hash of their key
+    and served as files so that their content doesn't go through python.
+
+    The total size of the store is bounded by TILE_STORE_SIZE bytes (0 to
+    disable the store), the least recently read tiles are evicted first by
+    a thread of the worker so that requests never wait for an eviction.
+    """
+
+    root = None
+    maxsize = 0
+    size = 0
+    written = 0
+    hits = 0
+    misses = 0
+    evictions = 0
+    _evictor = None
+    _lock = Lock()
+
+    @classmethod
+    def init(cls):
+        cls.maxsize = Config.TILE_STORE_SIZE
+        cls.root = os.path.join(Config.CACHE_DIR, 'tiles')
+        if cls.maxsize:
+            os.makedirs(cls.root, exist_ok=True)
+            cls.size = sum(size for _, _, size in cls._files())
+
+    @classmethod
+    def path(cls, namespace, key):
+        # tiles of a previous version of the table are never read again
+        # and end up evicted
+        digest = hashlib.sha1(
+            repr((Session.dbname, Session.table, Session.column,
+                  Metadata.version(), key))
+            .encode('utf-8')).hexdigest()
+        return os.path.join(cls.root, namespace, digest[:2], digest)
+
+    @classmethod
+    def lookup(cls, namespace, key):
+        """
+        Returns the path of the stored tile or None if the tile is not in
+        the store
+        """
+        if not cls.maxsize:
+            return None
+
+        path = cls.path(namespace, key)
+        try:
+            # mtime is used as the last access time for evictions
+            os.utime(path)
+        except OSError:
+            with cls._lock:
+                cls.misses += 1
+            return None
+
+        with cls._lock:
+            cls.hits += 1
+        return path
+
+    @classmethod
+    def response(cls, namespace, key):
+        """
+        Returns a response serving the stored tile or None if the tile is
+        not in the store
+        """
+        path = cls.lookup(namespace, key)
+        if path is None:
+            return None
+
+        headers = cls.sendfile_headers(path)
+        if headers:
+            return Response(headers=headers)
+
+        try:
+            # send_file serves the opened file so a concurrent eviction
+            # can't remove it under our feet
+            tile = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        return send_file(tile, mimetype='application/octet-stream')
+
+    @classmethod
+    def sendfile_headers(cls, path):
+        """
+        Returns the headers delegating the sending of a tile to the front
+        server according to TILE_STORE_SENDFILE, or None
+        """
+        if Config.TILE_STORE_SENDFILE == 'x-accel-redirect':
+            return {'X-Accel-Redirect': (
+                Config.TILE_STORE_ACCEL_PREFIX.rstrip('/') + '/' +
+                os.path.relpath(path, cls.root))}
+        elif Config.TILE_STORE_SENDFILE == 'x-sendfile':
+            return {'X-Sendfile': path}
+        return None
+
+    @classmethod
+    def put(cls, namespace, key, data):
+        if not cls.maxsize or len(data) > cls.maxsize:
+            return
+
+        path = cls.path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        utils.write_atomic(path, data)
+
+        with cls._lock:
+            cls.size += len(data)
+            cls.written += len(data)
+            # other workers write in the store too so the size is
+            # recomputed regularly
+            if (cls.size > cls.maxsize or cls.written > cls.maxsize / 10) \
+                    and (cls._evictor is None or not cls._evictor.is_alive()):
+                cls._evictor = Thread(target=cls.evict, daemon=True,
+                                      name='lopocs-store-eviction')
+                cls._evictor.start()
+
+    @classmethod
+    def evict(cls):
+        """
+        Recomputes the size of the store and removes the least recently
+        read tiles until the store is under 90% of its maximum size if
+        it's full. The lock is only taken to update the counters: tiles
+        are still read and written while the store is walked.
+        """
+        with cls._lock:
+            cls.written = 0
+
+        files = sorted(cls._files())
+        size = sum(s for _, _, s in files)
+
+        evictions = 0
+        if size > cls.maxsize:
+            for _, path, s in files:
+                if size <= cls.maxsize * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= s
+                evictions += 1
+
+        with cls._lock:
+            # tiles written meanwhile may not have been walked
+            cls.size = size + cls.written
+            cls.evictions += evictions
+
+    @classmethod
+    def _files(cls):
+        """
+        Yields (mtime, path, size) for each tile of the store
+        """
+        for dirpath, _, filenames in os.walk(cls.root):
+            for filename in filenames:
+                # skip files being written
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield (st.st_mtime, path, st.st_size)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                "maxsize": cls.maxsize,
+                "size": cls.size,
+                "hits": cls.hits,
+                "misses": cls.misses,
+                "evictions": cls.evictions}
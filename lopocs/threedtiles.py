@@ -1,198 +1,310 @@
 # -*- coding: utf-8 -*-
 import json
 import numpy as np
-import py3dtiles
 import struct
+import time
 from flask import Response
 
 from . import utils
-from .greyhound import decompress
+from .greyhound import (NodeIndex, OCTANTS, decompress, points_range,
+                        read_statement)
 from .conf import Config
 from .database import Session
+from .cache import Cache, tile_key
+from .octree import OctreeKey
+from .metadata import Metadata
+from .metrics import Metrics
+from .store import TileStore
+from .timing import span, timed
 
 GEOMETRIC_ERROR_DEFAULT = 2000
 
+# colors used for each class when CESIUM_COLOR is 'classif'
+CLASSIFICATION_COLORS = np.zeros((256, 3), dtype=np.uint8)
+CLASSIFICATION_COLORS[2] = (51, 25, 0)  # ground
+CLASSIFICATION_COLORS[5] = (51, 102, 0)  # vegetation
+CLASSIFICATION_COLORS[6] = (153, 76, 0)  # buildings
+
+# magic, version, byteLength, featureTableJSONByteLength,
+# featureTableBinaryByteLength, batchTableJSONByteLength,
+# batchTableBinaryByteLength
+PNTS_HEADER = struct.Struct('<4s6I')
+
 # -----------------------------------------------------------------------------
 # classes
 # -----------------------------------------------------------------------------
 class ThreeDTilesInfo(object):
 
-    def run(self, args):
-        # bounding box
-        if (Config.BB):
-            box = Config.BB
-        else:
-            box = Session.boundingbox()
-
-        # number of points for the first patch
-        npoints = Session.approx_row_count() * Session.patch_size()
-
-        # srs
-        srs = Session.srs()
-
-        # build json
-        info = json.dumps({
-            "bounds": [box['xmin'], box['ymin'], box['zmin'],
-                       box['xmax'], box['ymax'], box['zmax']],
-            "numPoints": npoints,
-            "srs": srs}, default=utils.decimal_default)
+    @timed('3dtiles_info')
+    def run(self):
+        start = time.perf_counter()
+        info = self.info()
 
         # build the flask response
         resp = Response(info)
         resp.headers['Access-Control-Allow-Origin'] = '*'
         resp.headers['Content-Type'] = 'text/plain'
 
+        Metrics.request('3dtiles_info', start, len(info))
         return resp
 
+    def info(self):
+        return Metadata.body('3dtiles', self.build)
+
+    @staticmethod
+    def build(metadata):
+        return json.dumps({
+            "bounds": metadata['bounds'],
+            "numPoints": metadata['numPoints'],
+            "srs": metadata['srs']}, default=utils.decimal_default)
+
 
 class ThreeDTilesRead(object):
 
+    @timed('3dtiles_read')
     def run(self, args):
+        start = time.perf_counter()
+        [box, offset, schema_pcid, lod] = self.parameters(args)
+        scale = args['scale']
+
+        key = tile_key(box, lod, scale, schema_pcid, offset)
+        tile = Cache.threedtiles.get(key)
+        if tile is not None:
+            Metrics.tile('3dtiles_read', 'cache')
+            resp = Response(tile)
+        else:
+            resp = TileStore.response('3dtiles', key)
+            if resp is not None:
+                Metrics.tile('3dtiles_read', 'store')
+
+        if resp is None:
+            Metrics.tile('3dtiles_read', 'database')
+            [tile, npoints] = get_points(box, lod, offset, schema_pcid,
+                                         scale)
+            Cache.threedtiles.put(key, tile)
+            TileStore.put('3dtiles', key, tile)
+
+            if Config.DEBUG:
+                print("NPOINTS: ", npoints)
+            resp = Response(tile)
+
+        # build the flask response
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        resp.headers['Content-Type'] = 'application/octet-stream'
+
+        if tile is not None:
+            Metrics.request('3dtiles_read', start, len(tile),
+                            pnts_npoints(tile))
+        else:
+            # served from the store
+            Metrics.request('3dtiles_read', start, resp.content_length or 0)
+
+        return resp
+
+    @staticmethod
+    def parameters(args):
+        """
+        Returns the box, offset, output pcid and lod of a read request
+        """
         offset = utils.list_from_str(args['offsets'])
         schema_pcid = Config.POTREE_SCH_PCID_SCALE_01
-        scale = args['scale']
-        if scale == 0.01:
+        if args['scale'] == 0.01:
             schema_pcid = Config.POTREE_SCH_PCID_SCALE_001
         box = utils.list_from_str(args['bounds'])
         lod = args['lod']
 
-        [tile, npoints] = get_points(box, lod, offset, schema_pcid, scale)
+        return [box, offset, schema_pcid, lod]
 
-        if Config.DEBUG:
-            tile.sync()
-            print("NPOINTS: ", npoints)
 
-        # build the flask response
-        resp = Response(tile.to_array().tostring())
+class ThreeDTilesTileset(object):
+    """
+    Tileset of the dataset generated from the NodeIndex and split in pages
+    of TILESET_LEVELS levels: the nodes below a page are external tilesets
+    requested with the lod and the bounds of their root, so that clients
+    only load the parts of the octree they visit.
+    """
+
+    @timed('3dtiles_tileset')
+    def run(self, args):
+        start = time.perf_counter()
+        tileset = self.tileset(args)
+
+        if tileset is None:
+            resp = Response("bounds are not a node of the octree",
+                            status=404)
+        else:
+            resp = Response(tileset)
+            resp.headers['Content-Type'] = 'application/json'
         resp.headers['Access-Control-Allow-Origin'] = '*'
-        resp.headers['Content-Type'] = 'application/octet-stream'
 
+        Metrics.request('3dtiles_tileset', start,
+                        len(tileset) if tileset is not None else 0)
         return resp
 
+    def tileset(self, args):
+        """
+        Returns the page rooted at the node of the lod and bounds of args
+        (the root of the octree by default) or None if they're not a node
+        """
+        lod = args.get('lod') or 0
+        bbox = None
+        if args.get('bounds'):
+            try:
+                bbox = utils.list_from_str(args['bounds'])
+            except ValueError:
+                return None
+            if len(bbox) != 6:
+                return None
+        if lod < 0:
+            return None
+
+        # there's no other way to build the tileset
+        index = NodeIndex.get(wait=True)
+        cell = index.cell(bbox or index.bbox, lod)
+        if cell is None or lod >= len(index.counts):
+            return None
+
+        # pages of a previous index are never read again
+        key = ('tileset.json', index.signature, lod, cell,
+               Config.TILESET_LEVELS)
+        tileset = Cache.threedtiles.get(key)
+        if tileset is None:
+            page = tileset_page(index, lod, cell, Config.TILESET_LEVELS)
+            with span('serialize'):
+                tileset = json.dumps(page).encode('utf-8')
+            Cache.threedtiles.put(key, tileset)
+
+        return tileset
+
 
 # -----------------------------------------------------------------------------
 # utility functions specific 3dtiles
 # -----------------------------------------------------------------------------
 def get_points(box, lod, offset, schema_pcid, scale):
-    sql = sql_query(box, schema_pcid, lod)
+    [sql, parameters] = sql_query(box, schema_pcid, lod)
     if Config.DEBUG:
-        print(sql)
+        print(sql, parameters)
+
+    pcpatch_wkb = Session.query_aslist(
+        sql, parameters, context={'bounds': box, 'lod': lod})[0]
+    return pnts_from_pcpatch(pcpatch_wkb, offset, scale)
+
+
+def pnts_from_pcpatch(pcpatch_wkb, offset, scale):
+    """
+    Returns the pnts tile of the points of a laz pcpatch along with their
+    number
+    """
+    with span('decompress'):
+        points = decompress(pcpatch_wkb)
+    npoints = len(points)
+
+    with span('pnts'):
+        # positions
+        positions = np.empty((npoints, 3), dtype=np.float32)
+        positions[:, 0] = points['X'] * scale
+        positions[:, 1] = points['Y'] * scale
+        positions[:, 2] = points['Z'] * scale
+
+        # colors
+        if Config.CESIUM_COLOR == "classif":
+            colors = CLASSIFICATION_COLORS[points['Classification']]
+        elif Config.CESIUM_COLOR == "colors":
+            colors = np.empty((npoints, 3), dtype=np.uint8)
+            colors[:, 0] = points['Red'] >> 8
+            colors[:, 1] = points['Green'] >> 8
+            colors[:, 2] = points['Blue'] >> 8
+        else:
+            colors = np.zeros((npoints, 3), dtype=np.uint8)
 
-    pcpatch_wkb = Session.query_aslist(sql)[0]
-    npoints = utils.npoints_from_wkb_pcpatch(pcpatch_wkb)
+    with span('serialize'):
+        tile = pnts_from_arrays(positions, colors, offset)
 
-    # extract data
-    [decompressed_str, itemsize] = decompress(pcpatch_wkb)
+    return [tile, npoints]
 
-    pdt = np.dtype([('X', '<f4'), ('Y', '<f4'), ('Z', '<f4')])
-    cdt = np.dtype([('Red', 'u1'), ('Green', 'u1'), ('Blue', 'u1')])
 
+def pnts_from_arrays(positions, colors, rtc):
+    """
+    Build a pnts tile from a (n, 3) float32 array of positions and a
+    (n, 3) uint8 array of colors
+    """
+    npoints = len(positions)
 
-    features = []
-    for i in range(0, npoints):
-        point = decompressed_str[itemsize*i:itemsize*(i+1)]
-        x = point[0:4]
-        y = point[4:8]
-        z = point[8:12]
-        xd = struct.unpack("i", x)[0]
-        yd = struct.unpack("i", y)[0]
-        zd = struct.unpack("i", z)[0]
+    feature_table = json.dumps({
+        "POINTS_LENGTH": npoints,
+        "RTC_CENTER": rtc,
+        "POSITION": {"byteOffset": 0},
+        "RGB": {"byteOffset": positions.nbytes}}).encode('utf-8')
 
-        if Config.CESIUM_COLOR == "classif":
-            classif = point[14:15]
-            classifd = struct.unpack("B", classif)[0]
-            if classifd == 2:  # ground
-                col_arr = np.array([(51, 25, 0)], dtype=cdt).view('uint8')
-            elif classifd == 6:  # buildings
-                col_arr = np.array([(153, 76, 0)], dtype=cdt).view('uint8')
-            elif classifd == 5:  # vegetation
-                col_arr = np.array([(51, 102, 0)], dtype=cdt).view('uint8')
-        elif Config.CESIUM_COLOR == "colors":
-            r = point[15:17]
-            g = point[17:19]
-            b = point[19:21]
-            rd = struct.unpack("H", r)[0] % 255
-            gd = struct.unpack("H", g)[0] % 255
-            bd = struct.unpack("H", b)[0] % 255
-            col_arr = np.array([(rd, gd, bd)], dtype=cdt).view('uint8')
-        else:
-            col_arr = np.array([(0, 0, 0)], dtype=cdt).view('uint8')
+    # the binary body must start and end on a 8-byte boundary
+    ft_json = feature_table + b' ' * (
+        -(PNTS_HEADER.size + len(feature_table)) % 8)
+    ft_bin_length = positions.nbytes + colors.nbytes
+    ft_bin_padding = b'\x00' * (-ft_bin_length % 8)
+    ft_bin_length += len(ft_bin_padding)
 
-        xfin = xd*scale
-        yfin = yd*scale
-        zfin = zd*scale
-        pos_arr = np.array([(xfin, yfin, zfin)], dtype=pdt).view('uint8')
+    header = PNTS_HEADER.pack(
+        b'pnts', 1, PNTS_HEADER.size + len(ft_json) + ft_bin_length,
+        len(ft_json), ft_bin_length, 0, 0)
 
-        feat = py3dtiles.Feature.from_array(pdt, pos_arr, cdt, col_arr)
-        features.append(feat)
+    return b''.join([header, ft_json, np.ascontiguousarray(positions),
+                     np.ascontiguousarray(colors), ft_bin_padding])
 
-    tile = py3dtiles.Tile.from_features(pdt, cdt, features)
-    tile.body.feature_table.header.rtc = offset
 
-    return [tile, npoints]
+def pnts_npoints(tile):
+    # POINTS_LENGTH of the feature table following the header
+    ft_json_length = PNTS_HEADER.unpack_from(tile)[3]
+    feature_table = json.loads(bytes(
+        tile[PNTS_HEADER.size:PNTS_HEADER.size + ft_json_length])
+        .decode('utf-8'))
+    return feature_table['POINTS_LENGTH']
 
 
-def sql_query(box, schema_pcid, lod):
-    poly = utils.boundingbox_to_polygon(box)
+def sql_query(box, schema_pcid, lod, count=False):
+    """
+    Returns the statement reading the points of a box at a lod, or only
+    counting them, along with its parameters
+    """
+    range_min, range_max = points_range(lod)
 
-    # retrieve the number of points to select in a pcpatch
-    range_min = 0
-    range_max = 1
-    if Config.MAX_POINTS_PER_PATCH:
-        range_min = 0
-        range_max = Config.MAX_POINTS_PER_PATCH
+    if Config.USE_MORTON:
+        parameters = [box[0], box[1], box[3], box[4], range_min, range_max,
+                      box[2]-0.1, box[5]+0.1, schema_pcid, 4978,
+                      Config.MAX_PATCHS_PER_QUERY]
     else:
-        beg = 0
-        for i in range(0, lod):
-            beg = beg + pow(4, i)
+        parameters = [box[0], box[1], box[3], box[4], range_min, range_max,
+                      box[2], box[5], schema_pcid, Session.srsid(),
+                      Config.MAX_PATCHS_PER_QUERY]
 
-        end = 0
-        for i in range(0, lod+1):
-            end = end + pow(4, i)
+    if Config.USE_OCTREE_KEY:
+        parameters += OctreeKey.parameters(box)
 
-        range_min = beg
-        range_max = end-beg
+    return [read_statement(lod, schema_pcid, count), parameters]
 
-    # build the sql query
-    sql_limit = ""
-    if Config.MAX_PATCHS_PER_QUERY:
-        sql_limit = " limit {0} ".format(Config.MAX_PATCHS_PER_QUERY)
 
-    if Config.USE_MORTON:
-        sql = ("select pc_compress(pc_patchtransform(pc_union("
-               "pc_filterbetween( "
-               "pc_range({0}, {4}, {5}), 'Z', {6}, {7} )), {9}), 'laz') from "
-               "(select {0} from {1} "
-               "where pc_intersects({0}, st_geomfromtext('polygon (("
-               "{2}))',{3})) order by morton {8})_;"
-               .format(Session.column, Session.table,
-                       poly, 4978, range_min, range_max,
-                       box[2]-0.1, box[5]+0.1, sql_limit,
-                       schema_pcid))
-    else:
-        sql = ("select pc_compress(pc_patchtransform(pc_union("
-               "pc_filterbetween( "
-               "pc_range({0}, {4}, {5}), 'Z', {6}, {7} )), {9}), 'laz') from "
-               "(select {0} from {1} where pc_intersects({0}, "
-               "st_geomfromtext('polygon (({2}))',{3})) {8})_;"
-               .format(Session.column, Session.table,
-                       poly, Session.srsid(), range_min, range_max,
-                       box[2], box[5], sql_limit,
-                       schema_pcid))
+def build_hierarchy_from_pg(baseurl, lod_max, bbox, lod):
+    offsets = bbox_center(bbox)
+
+    children_list = []
+    for bb in split_bbox(bbox, lod + 1):
+        json_children = children(baseurl, lod_max, offsets, bb, lod + 1)
+        if len(json_children):
+            children_list.append(json_children)
 
-    return sql
+    return build_tileset(baseurl, bbox, lod, children_list)
 
 
-def build_hierarchy_from_pg(baseurl, lod_max, bbox, lod):
+def build_tileset(baseurl, bbox, lod, children_list):
+    """
+    Builds the tileset with a root tile for bbox at lod and the given
+    children
+    """
     tileset = {}
     tileset["asset"] = {"version": "0.0"}
     tileset["geometricError"] = GEOMETRIC_ERROR_DEFAULT # (lod_max+2)*20 - (lod+1)*20
 
     bvol = {}
-    center_x = bbox[0] + (bbox[3] - bbox[0])/2
-    center_y = bbox[1] + (bbox[4] - bbox[1])/2
-    center_z = bbox[2] + (bbox[5] - bbox[2])/2
-    offsets = [center_x, center_y, center_z]
+    [center_x, center_y, center_z] = bbox_center(bbox)
     bvol["sphere"] = [center_x, center_y, center_z, 2000]
 
     lod_str = "lod={0}".format(lod)
@@ -210,13 +322,6 @@ def build_hierarchy_from_pg(baseurl, lod_max, bbox, lod):
     root["geometricError"] = GEOMETRIC_ERROR_DEFAULT / 2  # (lod_max+2)*20 - (lod+2)*20
     root["content"] = {"url": url}
 
-    lod = 1
-    children_list = []
-    for bb in split_bbox(bbox, lod):
-        json_children = children(baseurl, lod_max, offsets, bb, lod)
-        if len(json_children):
-            children_list.append(json_children)
-
     if len(children_list):
         root["children"] = children_list
 
@@ -225,6 +330,95 @@ def build_hierarchy_from_pg(baseurl, lod_max, bbox, lod):
     return json.dumps(tileset, indent=4, separators=(',', ': '))
 
 
+def tileset_page(index, lod, cell, levels):
+    """
+    Returns the tileset rooted at the cell of lod of a NodeIndex with tiles
+    down to lod + levels - 1. Nodes at lod + levels with children are
+    external tilesets. URLs are relative to the one of the tileset.
+    """
+    offsets = bbox_center(index.bbox)
+    lod_max = len(index.counts) - 1
+    boundary = lod + max(levels, 1)
+
+    def node(lod, cell):
+        bbox = cell_bbox(index.bbox, lod, cell)
+        tile = {
+            "boundingVolume": {"box": box_volume(bbox)},
+            "geometricError": geometric_error(lod)}
+
+        children = []
+        if lod < lod_max:
+            [ix, iy, iz] = cell
+            children = [child for child in [
+                (2 * ix + dx, 2 * iy + dy, 2 * iz + dz)
+                for _, (dx, dy, dz) in OCTANTS]
+                if child in index.alive[lod + 1]]
+
+        if lod == boundary and children:
+            tile["content"] = {"url": "tileset.json?{0}".format(
+                node_parameters(bbox, lod))}
+            return tile
+
+        if index.counts[lod].get(cell):
+            tile["content"] = {"url": "read.pnts?{0}&{1}&scale={2}".format(
+                node_parameters(bbox, lod),
+                "offsets=[{0},{1},{2}]".format(*offsets), 0.01)}
+
+        if children:
+            tile["children"] = [node(lod + 1, child) for child in children]
+
+        return tile
+
+    root = node(lod, cell)
+    root["refine"] = "add"
+
+    return {
+        # tilesetVersion is sent by clients in the v argument of reads
+        "asset": {"version": "0.0", "tilesetVersion": "0.0"},
+        "geometricError": (GEOMETRIC_ERROR_DEFAULT if lod == 0
+                           else geometric_error(lod - 1)),
+        "root": root}
+
+
+def node_parameters(bbox, lod):
+    return "lod={0}&bounds=[{1},{2},{3},{4},{5},{6}]".format(lod, *bbox)
+
+
+def geometric_error(lod):
+    return GEOMETRIC_ERROR_DEFAULT / (2 * (lod + 1))
+
+
+def cell_bbox(bbox, lod, cell):
+    """
+    Returns the bounds of a cell of the octree of bbox at lod
+    """
+    ncells = pow(2, lod)
+    return (
+        [bbox[a] + (bbox[a + 3] - bbox[a]) * cell[a] / ncells
+         for a in range(0, 3)] +
+        [bbox[a] + (bbox[a + 3] - bbox[a]) * (cell[a] + 1) / ncells
+         for a in range(0, 3)])
+
+
+def box_volume(bbox):
+    """
+    Returns the 3dtiles box bounding volume of bounds: its center followed
+    by its half axes
+    """
+    [cx, cy, cz] = bbox_center(bbox)
+    return [cx, cy, cz,
+            (bbox[3] - bbox[0]) / 2, 0, 0,
+            0, (bbox[4] - bbox[1]) / 2, 0,
+            0, 0, (bbox[5] - bbox[2]) / 2]
+
+
+def bbox_center(bbox):
+    center_x = bbox[0] + (bbox[3] - bbox[0])/2
+    center_y = bbox[1] + (bbox[4] - bbox[1])/2
+    center_z = bbox[2] + (bbox[5] - bbox[2])/2
+    return [center_x, center_y, center_z]
+
+
 def build_children_section(baseurl, offsets, bbox, err, lod):
 
     cjson = {}
@@ -275,13 +469,14 @@ def split_bbox(bbox, lod):
 
 def children(baseurl, lod_max, offsets, bbox, lod):
 
-    # run sql
-    sql = sql_query(bbox, Config.POTREE_SCH_PCID_SCALE_001, lod)
-    pcpatch_wkb = Session.query_aslist(sql)[0]
+    # count points
+    [sql, parameters] = sql_query(bbox, Config.POTREE_SCH_PCID_SCALE_001, lod,
+                                  count=True)
+    npoints = Session.query_aslist(
+        sql, parameters, context={'bounds': bbox, 'lod': lod})[0]
 
     json_me = {}
-    if lod <= lod_max and pcpatch_wkb:
-        npoints = utils.npoints_from_wkb_pcpatch(pcpatch_wkb)
+    if lod <= lod_max and npoints is not None:
         if npoints > 0:
             err = GEOMETRIC_ERROR_DEFAULT/(2*(lod+1))
             json_me = build_children_section(baseurl, offsets, bbox, err, lod)
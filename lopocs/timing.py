@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import os
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # python < 3.7: the timings are only local to the thread
+    ContextVar = None
+    from threading import local
+
+from .conf import Config
+from .metrics import Metrics
+
+if ContextVar is not None:
+    _current = ContextVar('lopocs_timings', default=None)
+else:
+    _local = local()
+
+# a single request is profiled at once, python >= 3.12 doesn't allow
+# several profilers
+_profiling = Lock()
+
+
+class Timings(object):
+    """
+    Durations of the stages of a request, sent in its Server-Timing header
+    and recorded in the metrics: 'pool' (waiting for a connection),
+    'database' (queries), 'fetch' (conversion of the rows, bytea
+    decoding), 'decompress' (laz), 'pnts' (arrays of the pnts tiles),
+    'encode' (greyhound reads) and 'serialize' (json and pnts bodies).
+    A stage met several times is summed.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0) + duration
+
+    def header(self):
+        spans = list(self.spans.items())
+        spans.append(('total', time.perf_counter() - self.start))
+        return ', '.join('{0};dur={1:.3f}'.format(name, duration * 1000)
+                         for name, duration in spans)
+
+
+def current():
+    if ContextVar is not None:
+        return _current.get()
+    return getattr(_local, 'timings', None)
+
+
+def set_current(timings):
+    if ContextVar is not None:
+        _current.set(timings)
+    else:
+        _local.timings = timings
+
+
+@contextmanager
+def span(name):
+    """
+    Times a stage of the current request, if any
+    """
+    timings = current()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.add(name, time.perf_counter() - start)
+
+
+def begin(endpoint):
+    timings = Timings(endpoint)
+    set_current(timings)
+    return timings
+
+
+def end(timings, headers=None):
+    """
+    Records the stages of a request in the metrics and sets the
+    Server-Timing header of its response
+    """
+    set_current(None)
+    for name, duration in timings.spans.items():
+        Metrics.stage(timings.endpoint, name, duration)
+
+    if headers is not None and Config.SERVER_TIMING:
+        headers['Server-Timing'] = timings.header()
+        # durations are readable by the clients of other origins too
+        headers['Timing-Allow-Origin'] = '*'
+
+
+@contextmanager
+def profiled(endpoint):
+    """
+    Profiles a sample of the requests (PROFILE_RATE) with cProfile, the
+    profiles are written in PROFILE_DIR (CACHE_DIR/profiles by default).
+    Requests sampled while another one is profiled aren't.
+    """
+    if not Config.PROFILE_RATE or random.random() >= Config.PROFILE_RATE \
+            or not _profiling.acquire(blocking=False):
+        yield
+        return
+
+    try:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiling tool is active
+            profile = None
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                root = Config.PROFILE_DIR or os.path.join(Config.CACHE_DIR,
+                                                          'profiles')
+                os.makedirs(root, exist_ok=True)
+                profile.dump_stats(os.path.join(
+                    root, '{0}_{1}_{2}.prof'.format(
+                        endpoint, int(time.time() * 1000), os.getpid())))
+    finally:
+        _profiling.release()
+
+
+def timed(endpoint):
+    """
+    Decorates the run method of a handler so that the stages of its
+    requests are sent in the Server-Timing header of the response. Stages
+    of streamed responses sent after the run are not part of it.
+    """
+    def decorator(run):
+        @wraps(run)
+        def wrapper(*args, **kwargs):
+            timings = begin(endpoint)
+            try:
+                with profiled(endpoint):
+                    resp = run(*args, **kwargs)
+            except Exception:
+                end(timings)
+                raise
+            end(timings, resp.headers)
+            return resp
+        return wrapper
+    return decorator
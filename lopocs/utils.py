@@ -1,22 +1,42 @@
 # -*- coding: utf-8 -*-
 import json
-from struct import pack, unpack
-import codecs
+from struct import pack, unpack_from
 import os
 import decimal
+import tempfile
 
 from .conf import Config
 
+# umask of the process, read once as it can only be read by changing it
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
 
 # -----------------------------------------------------------------------------
 # functions
 # -----------------------------------------------------------------------------
 def write_in_cache(d, filename):
     path = os.path.join(Config.CACHE_DIR, filename)
+    write_atomic(path, json.dumps(d).encode('utf-8'))
+
 
-    f = open(path, 'w')
-    f.write(json.dumps(d))
-    f.close()
+def write_atomic(path, data):
+    """
+    Write bytes in a file so that readers never see a partial file: data
+    is written in a temporary file of the same directory which is then
+    renamed. The file gets the permissions of the umask.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp creates files readable by their owner only, files are
+        # read by the front server too (TILE_STORE_SENDFILE)
+        os.chmod(tmppath, 0o666 & ~UMASK)
+        os.replace(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
 
 
 def read_in_cache(filename):
@@ -86,12 +106,25 @@ def hexa_signed_uint8(val):
 
 
 def npoints_from_wkb_pcpatch(pcpatch_wkb):
-    npoints_hexa = pcpatch_wkb[18:26]
-    return unpack("I", codecs.decode(npoints_hexa, "hex"))[0]
+    # the first byte of the header gives the endianness, then come the
+    # pcid, the compression and the number of points
+    endian = '<I' if pcpatch_wkb[0] else '>I'
+    return unpack_from(endian, pcpatch_wkb, 9)[0]
+
+
+def lazdata_from_wkb_pcpatch(pcpatch_wkb):
+    # laz patchs have the size of their data after the header
+    return memoryview(pcpatch_wkb)[17:]
+
+
+def rawdata_from_wkb_pcpatch(pcpatch_wkb):
+    # uncompressed patchs have no size of data in their header
+    return memoryview(pcpatch_wkb)[13:]
 
 
-def hexdata_from_wkb_pcpatch(pcpatch_wkb):
-    return codecs.decode(pcpatch_wkb[34:], "hex")
+def npoints_from_greyhound_read(read):
+    # greyhound reads end with the number of points
+    return unpack_from('i', read, len(read) - 4)[0]
 
 
 # -----------------------------------------------------------------------------
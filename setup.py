@@ -17,8 +17,6 @@ requirements = (
     'psycopg2==2.6.1',
     'pyyaml',
     'pygdal >= {0}, <{1}'.format(GDAL_MIN, GDAL_MAX),
-    'redis',
-    'py3dtiles',
 )
 
 dev_requirements = (
@@ -39,6 +37,12 @@ prod_requirements = (
     'uwsgi'
 )
 
+# lopocs.aio requires python >= 3.7 (contextvars)
+async_requirements = (
+    'aiohttp; python_version >= "3.7"',
+    'aiopg; python_version >= "3.7"',
+)
+
 
 def find_version(*file_paths):
     """
@@ -78,6 +82,7 @@ setup(
     extras_require={
         'dev': dev_requirements,
         'prod': prod_requirements,
+        'async': async_requirements,
         'doc': doc_requirements
     }
 )
@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+
+from lopocs import greyhound
+from lopocs.cache import Cache, LRUCache, tile_key
+from lopocs.metadata import Metadata
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(cls):
+        patch = mock.patch.object(Metadata, 'version', return_value=[1])
+        cls.version = patch.start()
+        cls.addCleanup(patch.stop)
+
+    def test_lru_eviction(cls):
+        cache = LRUCache(10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.get('a')
+        cache.put('c', b'1234')
+
+        cls.assertEqual(cache.get('a'), b'1234')
+        cls.assertIsNone(cache.get('b'))
+        cls.assertEqual(cache.get('c'), b'1234')
+
+        stats = cache.stats()
+        cls.assertEqual(stats['size'], 8)
+        cls.assertEqual(stats['evictions'], 1)
+        cls.assertEqual(stats['hits'], 3)
+        cls.assertEqual(stats['misses'], 1)
+
+    def test_disabled(cls):
+        cache = LRUCache(0)
+        cache.put('a', b'1234')
+        cls.assertIsNone(cache.get('a'))
+        cls.assertEqual(cache.stats()['entries'], 0)
+
+    def test_tile_key(cls):
+        k1 = tile_key([0.1 + 0.2, 1, 2, 3, 4, 5], 2, 0.01, 3, [1, 2, 3])
+        k2 = tile_key([0.3, 1, 2, 3, 4, 5], 2, 0.01, 3, [1, 2, 3])
+        cls.assertEqual(k1, k2)
+
+        # the table changed
+        cls.version.return_value = [2]
+        cls.assertNotEqual(
+            tile_key([0.3, 1, 2, 3, 4, 5], 2, 0.01, 3, [1, 2, 3]), k1)
+
+    def test_failed_read(cls):
+        args = {'depthBegin': 8, 'depthEnd': 9, 'bounds': '[0,0,0,1,1,1]',
+                'scale': 0.01, 'offset': '[0,0,0]', 'compress': True}
+
+        with mock.patch.object(Cache, 'greyhound', LRUCache(1024)), \
+                mock.patch.object(greyhound, 'sql_query',
+                                  return_value=[None, []]), \
+                mock.patch.object(greyhound.Session, 'query_aslist',
+                                  side_effect=OSError), \
+                mock.patch.object(greyhound.TileStore, 'put') as put:
+            with cls.assertRaises(OSError):
+                greyhound.GreyhoundRead().run(args)
+
+            # nothing is cached from a read which failed
+            cls.assertEqual(Cache.greyhound.stats()['entries'], 0)
+            put.assert_not_called()
+
+    def test_uncompressed_read(cls):
+        args = {'depthBegin': 8, 'depthEnd': 9, 'bounds': '[0,0,0,1,1,1]',
+                'scale': 0.01, 'offset': '[0,0,0]', 'compress': False}
+        [box, offset, schema_pcid, lod] = \
+            greyhound.GreyhoundRead.parameters(args)
+
+        with mock.patch.object(Cache, 'greyhound', LRUCache(1024)), \
+                mock.patch.object(greyhound.Config, 'GREYHOUND_STREAM_BATCH',
+                                  10), \
+                mock.patch.object(greyhound, 'stream_points',
+                                  return_value=iter([b'raw'])):
+            # laz read of the same tile
+            Cache.greyhound.put(
+                tile_key(box, lod, args['scale'], schema_pcid, offset),
+                b'laz')
+            resp = greyhound.GreyhoundRead().run(args)
+
+            cls.assertEqual(resp.get_data(), b'raw')
@@ -0,0 +1,55 @@
+import unittest
+from contextlib import contextmanager
+from threading import BoundedSemaphore
+from unittest import mock
+
+from lopocs.conf import Config
+from lopocs.database import Session, SlowQueryLog, Statement
+
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(cls):
+        cls.settings = [Config.SLOW_QUERY_THRESHOLD,
+                        Config.SLOW_QUERY_EXPLAIN_RATE]
+
+    def tearDown(cls):
+        [Config.SLOW_QUERY_THRESHOLD,
+         Config.SLOW_QUERY_EXPLAIN_RATE] = cls.settings
+
+    def test_slow_query_log(cls):
+        statement = Statement('lopocs_test', 'select $1', ['integer'])
+        Config.SLOW_QUERY_THRESHOLD = 0.5
+        Config.SLOW_QUERY_EXPLAIN_RATE = 1
+
+        with mock.patch.object(SlowQueryLog, 'explain') as explain:
+            with cls.assertLogs('lopocs.database', 'WARNING') as logs:
+                SlowQueryLog.check(statement, [1], 0.1)
+                SlowQueryLog.check(statement, [1], 0.75,
+                                   {'bounds': [0, 0, 0, 1, 1, 1], 'lod': 3})
+
+        [message] = logs.output
+        cls.assertIn('750.0 ms lopocs_test bounds=[0, 0, 0, 1, 1, 1] lod=3',
+                     message)
+        explain.assert_called_once_with(
+            statement, [1], 'lopocs_test bounds=[0, 0, 0, 1, 1, 1] lod=3')
+
+    def test_stream_slots(cls):
+        conn = mock.MagicMock(closed=False)
+        conn.cursor.return_value.fetchmany.side_effect = [[(1,), (2,)], []]
+
+        @contextmanager
+        def connection():
+            yield conn
+
+        streams = BoundedSemaphore(1)
+        with mock.patch.object(Session, 'streams', streams), \
+                mock.patch.object(Session, 'connection', connection):
+            rows = Session.stream('select 1', size=2)
+            cls.assertEqual(next(rows), [(1,), (2,)])
+            # the slot is held while the client reads
+            cls.assertFalse(streams.acquire(blocking=False))
+            cls.assertEqual(list(rows), [])
+
+        cls.assertTrue(streams.acquire(blocking=False))
+        conn.rollback.assert_called_once_with()
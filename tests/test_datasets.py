@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from lopocs.cache import Cache
+from lopocs.conf import Config
+from lopocs.database import Session
+from lopocs.datasets import Datasets, DatasetDispatcher
+from lopocs.scope import activate, current
+
+
+class TestDatasets(unittest.TestCase):
+
+    def setUp(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        patches = [
+            mock.patch.object(Config, 'CACHE_DIR', cls.tmpdir.name),
+            mock.patch.object(Config, 'DEPTH', 6),
+            mock.patch.object(Session, 'table', 'pa'),
+            mock.patch.object(Session, 'column', 'pa'),
+            mock.patch.object(Session, 'dbname', 'db', create=True)]
+        for patch in patches:
+            patch.start()
+            cls.addCleanup(patch.stop)
+        cls.addCleanup(cls.tmpdir.cleanup)
+        cls.addCleanup(Datasets.init, {})
+
+        Datasets.init({'DATASETS': [
+            {'NAME': 'montreal', 'PG_TABLE': 'montreal', 'DEPTH': 8,
+             'GREYHOUND_CACHE_SIZE': 10}]})
+
+    def test_settings(cls):
+        montreal = Datasets.get('montreal')
+        with activate(montreal):
+            cls.assertEqual(Session.table, 'montreal')
+            cls.assertEqual(Session.column, 'pa')
+            cls.assertEqual(Config.DEPTH, 8)
+            cls.assertEqual(Config.CACHE_DIR, cls.tmpdir.name)
+            cls.assertEqual(Cache.greyhound.maxsize, 10)
+
+        cls.assertIsNone(current())
+        cls.assertEqual(Session.table, 'pa')
+        cls.assertEqual(Config.DEPTH, 6)
+
+    def test_dispatcher(cls):
+        seen = []
+
+        def app(environ, start_response):
+            seen.append((environ['PATH_INFO'], current(), Session.table))
+
+        dispatcher = DatasetDispatcher(app, '/lopocs')
+        dispatcher({'PATH_INFO': '/lopocs/montreal/greyhound/info'}, None)
+        dispatcher({'PATH_INFO': '/lopocs/greyhound/info'}, None)
+
+        cls.assertEqual(seen, [
+            ('/lopocs/greyhound/info', Datasets.get('montreal'), 'montreal'),
+            ('/lopocs/greyhound/info', None, 'pa')])
+
+    def test_invalid(cls):
+        for datasets in [[{'PG_TABLE': 'montreal'}],
+                         [{'NAME': 'montreal'}],
+                         [{'NAME': 'greyhound', 'PG_TABLE': 'montreal'}],
+                         [{'NAME': 'montreal', 'PG_TABLE': 'montreal'},
+                          {'NAME': 'montreal', 'PG_TABLE': 'quebec'}]]:
+            with cls.assertRaises(ValueError):
+                Datasets.init({'DATASETS': datasets})
@@ -0,0 +1,154 @@
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from lopocs import greyhound
+
+
+class TestGreyhound(unittest.TestCase):
+
+    def test_build_hierarchy_from_pg(cls):
+        counts = {
+            0: {(0, 0, 0): 10},
+            1: {(0, 1, 0): 5, (1, 0, 1): 3},
+            2: {(3, 0, 2): 1, (0, 0, 0): 2}}
+
+        def count(bbox, depth, lod):
+            return counts[lod]
+
+        with mock.patch.object(greyhound, 'count_points_by_cell', count):
+            h = greyhound.build_hierarchy_from_pg(2, [0, 0, 0, 8, 8, 8], 0)
+
+        cls.assertEqual(h, {
+            'n': 10,
+            'nwd': {'n': 5},
+            'seu': {'n': 3, 'sed': {'n': 1}},
+            'swd': {'n': 0, 'swd': {'n': 2}}})
+
+    def test_node_index(cls):
+        counts = [
+            {(0, 0, 0): 10},
+            {(0, 1, 0): 5, (1, 0, 1): 3},
+            {(3, 0, 2): 1, (0, 0, 0): 2}]
+        index = greyhound.NodeIndex([0, 0, 0, 8, 8, 8], counts, '[1, 2]')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'index.npz')
+            index.save(path)
+            index = greyhound.NodeIndex.load(path)
+
+        cls.assertEqual(index.counts, counts)
+        cls.assertEqual(index.signature, '[1, 2]')
+        cls.assertEqual(index.hierarchy(1, 2, [4, 0, 4, 8, 4, 8]),
+                        {'n': 3, 'sed': {'n': 1}})
+        cls.assertEqual(index.hierarchy(1, 2, [0, 4, 4, 4, 8, 8]), {})
+        cls.assertIsNone(index.hierarchy(1, 2, [1, 0, 4, 5, 4, 8]))
+        cls.assertIsNone(index.hierarchy(1, 3, [4, 0, 4, 8, 4, 8]))
+
+    def test_stream_points(cls):
+        def wkb(npoints, data):
+            return b'\x01' + struct.pack('<III', 2, 0, npoints) + data
+
+        batches = [[(wkb(2, b'abcd'),), (None,)], [(wkb(1, b'ef'),)]]
+
+        with mock.patch.object(greyhound, 'sql_query',
+                               return_value=[None, []]), \
+                mock.patch.object(greyhound, 'stream_statement'), \
+                mock.patch.object(greyhound.Session, 'stream',
+                                  return_value=iter(batches)):
+            chunks = list(greyhound.stream_points([0] * 6, 2, 0))
+
+        cls.assertEqual(chunks, [b'abcd', b'ef', struct.pack('<i', 3)])
+
+    def test_node_index_build(cls):
+        bbox = [0, 0, 0, 8, 8, 8]
+        version = mock.Mock(return_value=[1, 0])
+
+        def build(bbox, lod_max):
+            return greyhound.NodeIndex(bbox, [{(0, 0, 0): 1}] * 2)
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(greyhound.NodeIndex, 'filename',
+                                  return_value=tmpdir + '/index.npz'), \
+                mock.patch.object(greyhound.Config, 'DEPTH', 2), \
+                mock.patch.object(greyhound.NodeIndex, '_index', None), \
+                mock.patch.object(greyhound.Metadata, 'version', version), \
+                mock.patch.object(greyhound.Metadata, 'get',
+                                  return_value={'bounds': bbox}), \
+                mock.patch.object(greyhound.NodeIndex, 'build',
+                                  side_effect=build) as built:
+            cls.assertEqual(greyhound.NodeIndex.get().signature, '[1, 0]')
+
+            # loaded by the other workers
+            greyhound.NodeIndex._index = None
+            cls.assertEqual(greyhound.NodeIndex.get().bbox, bbox)
+            cls.assertEqual(built.call_count, 1)
+
+            # the table changed while another worker builds the index
+            version.return_value = [1, 1]
+            path = greyhound.NodeIndex.filename() + '.lock'
+            with open(path, 'a') as f:
+                greyhound.fcntl.flock(f, greyhound.fcntl.LOCK_EX)
+                cls.assertIsNone(greyhound.NodeIndex.get())
+                greyhound.fcntl.flock(f, greyhound.fcntl.LOCK_UN)
+
+            cls.assertEqual(greyhound.NodeIndex.get().signature, '[1, 1]')
+            cls.assertEqual(built.call_count, 2)
+
+    def test_read_statement(cls):
+        with mock.patch.object(greyhound.Config, 'USE_LOD_TABLES', True), \
+                mock.patch.object(greyhound.Config, 'USE_OCTREE_KEY', False), \
+                mock.patch.object(greyhound.Config, 'USE_MORTON', True), \
+                mock.patch.object(greyhound.Config, 'DEPTH', 2), \
+                mock.patch.dict(greyhound.LOD_STATEMENTS):
+            cls.assertEqual(greyhound.read_statement(1, 3).name,
+                            'lopocs_read_lod1_3')
+            # no lod table below the depth of the octree
+            cls.assertIs(greyhound.read_statement(2, 3),
+                         greyhound.READ_POINTS_MORTON)
+
+    def test_get_points(cls):
+        wkb = struct.pack('<BIIII', 1, 2, 2, 3, 4) + b'laz!'
+
+        with mock.patch.object(greyhound, 'sql_query',
+                               return_value=[None, []]), \
+                mock.patch.object(greyhound.Session, 'query_aslist',
+                                  side_effect=[[wkb], [None], OSError]):
+            cls.assertEqual(greyhound.get_points([0] * 6, [0] * 3, 2, 0),
+                            [b'laz!' + struct.pack('<i', 3), 3])
+            # no patch in the box
+            cls.assertEqual(greyhound.get_points([0] * 6, [0] * 3, 2, 0),
+                            [struct.pack('<i', 0), 0])
+            # errors aren't turned into empty tiles
+            with cls.assertRaises(OSError):
+                greyhound.get_points([0] * 6, [0] * 3, 2, 0)
+
+    def test_patch_decoder(cls):
+        points = numpy.zeros(3, dtype=greyhound.READ_DTYPE)
+        points['X'] = [1, 2, 3]
+        points['Classification'] = 6
+
+        class Decompressor(object):
+
+            def __init__(self, lazdata, schema):
+                cls.assertEqual(bytes(lazdata), b'laz!')
+
+            def decompress(self, output):
+                output[:] = points.view(numpy.uint8)
+                return output
+
+        wkb = struct.pack('<BIIII', 1, 2, 2, 3, 4) + b'laz!'
+        decoder = greyhound.PatchDecoder(greyhound.GreyhoundReadSchema(),
+                                         greyhound.READ_DTYPE)
+        with mock.patch.object(greyhound, 'Decompressor', Decompressor):
+            first = decoder.decompress(wkb)
+            cls.assertEqual(first['X'].tolist(), [1, 2, 3])
+            cls.assertEqual(first['Classification'].tolist(), [6, 6, 6])
+
+            # the buffer of the thread is reused
+            second = decoder.decompress(wkb)
+            cls.assertTrue(numpy.shares_memory(first, second))
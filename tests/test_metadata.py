@@ -0,0 +1,70 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from lopocs.conf import Config
+from lopocs.database import Session
+from lopocs.metadata import Metadata
+
+
+class TestMetadata(unittest.TestCase):
+
+    def setUp(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.cache_dir = Config.CACHE_DIR
+        Config.CACHE_DIR = cls.tmpdir.name
+        Session.dbname, Session.table, Session.column = 'db', 'pa', 'pa'
+
+    def tearDown(cls):
+        Config.CACHE_DIR = cls.cache_dir
+        cls.tmpdir.cleanup()
+
+    def test_metadata(cls):
+        box = {'xmin': 0, 'ymin': 1, 'zmin': 2,
+               'xmax': 3, 'ymax': 4, 'zmax': 5}
+        signature = [[1, 10, 0, 0]]
+        patches = [
+            mock.patch.object(Session, 'boundingbox', return_value=box),
+            mock.patch.object(Session, 'approx_row_count', return_value=10),
+            mock.patch.object(Session, 'patch_size', return_value=400),
+            mock.patch.object(Session, 'srs', return_value='WKT'),
+            mock.patch.object(Session, 'query_aslist',
+                              side_effect=lambda *a: list(signature[0]))]
+        for patch in patches:
+            patch.start()
+            cls.addCleanup(patch.stop)
+
+        build = mock.Mock(side_effect=lambda m: str(m['numPoints']))
+
+        Metadata.init()
+        cls.assertEqual(Metadata.body('greyhound', build), '4000')
+        cls.assertEqual(Metadata.body('greyhound', build), '4000')
+        cls.assertEqual(build.call_count, 1)
+        cls.assertEqual(Session.boundingbox.call_count, 1)
+
+        # a new worker loads the stored metadata
+        Metadata.init()
+        cls.assertEqual(Metadata.values['bounds'], [0, 1, 2, 3, 4, 5])
+        cls.assertEqual(Metadata.get()['srs'], 'WKT')
+        cls.assertEqual(Session.boundingbox.call_count, 1)
+
+        # rows inserted in the table
+        signature[0] = [1, 20, 0, 0]
+        Session.approx_row_count.return_value = 20
+        Metadata.checked = 0
+        cls.assertEqual(Metadata.body('greyhound', build), '8000')
+        cls.assertEqual(Session.boundingbox.call_count, 2)
+
+        # being checked by another thread
+        Metadata.checked = 0
+        with Metadata._checking:
+            signature[0] = [1, 30, 0, 0]
+            cls.assertEqual(Metadata.get()['numPoints'], 8000)
+
+        # computed by another worker
+        [values, version] = [Metadata.values, Metadata.signature]
+        Metadata.refresh()
+        Metadata.swap(version, values, 0)
+        Metadata.checked = 0
+        cls.assertEqual(Metadata.version(), [1, 30, 0, 0, None])
+        cls.assertEqual(Session.boundingbox.call_count, 3)
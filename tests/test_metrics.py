@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from lopocs.conf import Config
+from lopocs.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.metrics_dir = Config.METRICS_DIR
+        Config.METRICS_DIR = cls.tmpdir.name
+        Metrics.init()
+        # the worker joins the spool at its first write
+        Metrics.flush()
+
+    def tearDown(cls):
+        Config.METRICS_DIR = cls.metrics_dir
+        Metrics.enabled = False
+        cls.tmpdir.cleanup()
+
+    def test_render(cls):
+        start = time.perf_counter() - 0.02
+        Metrics.request('greyhound_read', start, 100, 10)
+        Metrics.tile('greyhound_read', 'cache')
+        Metrics.tile('greyhound_read', 'database')
+        Metrics.stage('greyhound_read', 'database', 0.003)
+
+        lines = Metrics.render().splitlines()
+        labels = 'dataset="",endpoint="greyhound_read"'
+
+        cls.assertIn('lopocs_response_bytes_total{%s} 100' % labels, lines)
+        cls.assertIn('lopocs_points_total{%s} 10' % labels, lines)
+        cls.assertIn('lopocs_request_duration_seconds_bucket'
+                     '{%s,le="0.01"} 0' % labels, lines)
+        cls.assertIn('lopocs_request_duration_seconds_bucket'
+                     '{%s,le="0.025"} 1' % labels, lines)
+        cls.assertIn('lopocs_request_duration_seconds_count{%s} 1' % labels,
+                     lines)
+        cls.assertIn('lopocs_stage_duration_seconds_bucket'
+                     '{%s,stage="database",le="0.005"} 1' % labels, lines)
+        cls.assertIn('lopocs_cache_hit_ratio{%s} 0.5' % labels, lines)
+        cls.assertIn('lopocs_workers 1', lines)
+
+    def test_spool(cls):
+        Metrics.tile('3dtiles_read', 'store')
+
+        # metrics of another running worker and of a dead one
+        other = [['lopocs_tiles_total', ['', '3dtiles_read', 'store'], 2]]
+        with open(os.path.join(cls.tmpdir.name, '1.json'), 'w') as f:
+            json.dump(other, f)
+        dead = os.path.join(cls.tmpdir.name, '999999999.json')
+        with open(dead, 'w') as f:
+            json.dump(other, f)
+
+        key = ('lopocs_tiles_total', ('', '3dtiles_read', 'store'))
+        [total, workers] = Metrics.collect()
+        cls.assertEqual(workers, 2)
+        cls.assertEqual(total[key], 5)
+
+        # metrics of the dead worker are kept in the aggregate
+        cls.assertFalse(os.path.exists(dead))
+        [total, workers] = Metrics.collect()
+        cls.assertEqual(total[key], 5)
+
+    def test_restart(cls):
+        Metrics.tile('3dtiles_read', 'store')
+        Metrics.flush()
+        stale = os.path.join(cls.tmpdir.name, '1.json')
+        with open(stale, 'w') as f:
+            json.dump([], f)
+
+        # workers of the same server keep the spool
+        Metrics.init()
+        Metrics.flush()
+        cls.assertTrue(os.path.exists(stale))
+
+        # the spool of a previous run is cleared by the workers, not by
+        # the master which may init the metrics
+        with open(os.path.join(cls.tmpdir.name, 'server.json'), 'w') as f:
+            json.dump([0, 0], f)
+        Metrics.init()
+        cls.assertTrue(os.path.exists(stale))
+        Metrics.flush()
+        cls.assertFalse(os.path.exists(stale))
+        cls.assertEqual(Metrics.collect(), [{}, 1])
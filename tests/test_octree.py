@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from lopocs import octree
+
+
+class TestOctree(unittest.TestCase):
+
+    def test_morton_code(cls):
+        cls.assertEqual(octree.morton_code(1, 0, 0), 1)
+        cls.assertEqual(octree.morton_code(0, 1, 0), 2)
+        cls.assertEqual(octree.morton_code(0, 0, 1), 4)
+        cls.assertEqual(octree.morton_code(3, 3, 3), 63)
+
+    def test_node_of_box(cls):
+        bbox = [0, 0, 0, 8, 8, 8]
+        cls.assertEqual(octree.node_of_box(bbox, 3, [4, 0, 4, 8, 4, 8]),
+                        [1, [1, 0, 1]])
+        cls.assertEqual(octree.node_of_box(bbox, 3, [3, 3, 3, 5, 5, 5]),
+                        [0, [0, 0, 0]])
+        cls.assertEqual(octree.node_of_box(bbox, 3, [1, 1, 1, 1.5, 2, 2]),
+                        [3, [1, 1, 1]])
+
+    def test_patch_keys(cls):
+        bbox = [0, 0, 0, 8, 8, 8]
+        pmin = np.array([[4, 0, 4], [3, 3, 3], [1, 1, 1]], dtype=np.float64)
+        pmax = np.array([[8, 4, 8], [5, 5, 5], [1.5, 2, 2]],
+                        dtype=np.float64)
+        levels, keys = octree.patch_keys(bbox, 3, pmin, pmax)
+        cls.assertEqual(levels.tolist(), [1, 0, 3])
+        cls.assertEqual(keys.tolist(), [5 << 6, 0, 7])
+
+    def test_parameters(cls):
+        with mock.patch.object(octree.OctreeKey, 'bbox', [0, 0, 0, 8, 8, 8]), \
+                mock.patch.object(octree.OctreeKey, 'depth', 3):
+            [lo, hi, level, ancestors] = octree.OctreeKey.parameters(
+                [4, 0, 4, 6, 2, 6])
+        cls.assertEqual(level, 2)
+        cls.assertEqual([lo, hi], [5 << 6, (5 << 6) + 8])
+        cls.assertEqual(ancestors, [0, 5 << 6])
+
+    def test_missing_octree(cls):
+        with mock.patch.object(octree.OctreeKey, 'bbox', None), \
+                mock.patch.object(octree.Session, 'table', 'pa'), \
+                mock.patch.object(octree.Session, 'query_aslist',
+                                  return_value=[]):
+            with cls.assertRaisesRegex(RuntimeError, 'build_octree_key'):
+                octree.OctreeKey.parameters([4, 0, 4, 6, 2, 6])
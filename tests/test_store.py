@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from lopocs.conf import Config
+from lopocs.database import Session
+from lopocs.metadata import Metadata
+from lopocs.store import TileStore
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.patches = [
+            mock.patch.object(Config, 'CACHE_DIR', cls.tmpdir.name),
+            mock.patch.object(Config, 'TILE_STORE_SIZE', 100),
+            mock.patch.object(Session, 'dbname', 'db', create=True),
+            mock.patch.object(Session, 'table', 'pa'),
+            mock.patch.object(Session, 'column', 'pa'),
+            mock.patch.object(Metadata, 'version', return_value=[1, 0])]
+        for patch in cls.patches:
+            patch.start()
+        TileStore.init()
+
+    def tearDown(cls):
+        for patch in reversed(cls.patches):
+            patch.stop()
+        TileStore.maxsize = 0
+        cls.tmpdir.cleanup()
+
+    def test_path(cls):
+        path = TileStore.path('greyhound', ('key',))
+        cls.assertTrue(path.startswith(
+            os.path.join(cls.tmpdir.name, 'tiles', 'greyhound')))
+        cls.assertEqual(path, TileStore.path('greyhound', ('key',)))
+        cls.assertNotEqual(path, TileStore.path('greyhound', ('other',)))
+
+        # tiles of a reloaded table aren't read again
+        with mock.patch.object(Metadata, 'version', return_value=[2, 0]):
+            cls.assertNotEqual(path, TileStore.path('greyhound', ('key',)))
+
+        TileStore.put('greyhound', ('key',), b'tile')
+        cls.assertEqual(TileStore.lookup('greyhound', ('key',)), path)
+        with mock.patch.object(Metadata, 'version', return_value=[2, 0]):
+            cls.assertIsNone(TileStore.lookup('greyhound', ('key',)))
+
+    def test_eviction(cls):
+        for i in range(4):
+            TileStore.put('3dtiles', (i,), b'x' * 30)
+            path = TileStore.path('3dtiles', (i,))
+            # distinct access times, older tiles first
+            os.utime(path, (i, i))
+            if TileStore._evictor is not None:
+                TileStore._evictor.join()
+
+        # the store was over 100 bytes: the least recently read tiles are
+        # removed down to 90 bytes
+        TileStore.evict()
+        stats = TileStore.stats()
+        cls.assertLessEqual(stats['size'], 90)
+        cls.assertGreater(stats['evictions'], 0)
+        cls.assertIsNone(TileStore.lookup('3dtiles', (0,)))
+        cls.assertIsNotNone(TileStore.lookup('3dtiles', (3,)))
+
+    def test_sendfile_headers(cls):
+        path = TileStore.path('greyhound', ('key',))
+        relpath = os.path.relpath(path, TileStore.root)
+
+        with mock.patch.object(Config, 'TILE_STORE_SENDFILE', 'send_file'):
+            cls.assertIsNone(TileStore.sendfile_headers(path))
+        with mock.patch.object(Config, 'TILE_STORE_SENDFILE', 'x-sendfile'):
+            cls.assertEqual(TileStore.sendfile_headers(path),
+                            {'X-Sendfile': path})
+        with mock.patch.object(Config, 'TILE_STORE_SENDFILE',
+                               'x-accel-redirect'), \
+                mock.patch.object(Config, 'TILE_STORE_ACCEL_PREFIX',
+                                  '/tiles/'):
+            cls.assertEqual(TileStore.sendfile_headers(path),
+                            {'X-Accel-Redirect': '/tiles/' + relpath})
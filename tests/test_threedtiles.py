@@ -0,0 +1,96 @@
+import json
+import struct
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from lopocs import greyhound, threedtiles
+from lopocs.cache import Cache, LRUCache
+
+
+class TestThreeDTiles(unittest.TestCase):
+
+    def test_pnts_from_arrays(cls):
+        positions = np.arange(12, dtype=np.float32).reshape(4, 3)
+        colors = np.arange(12, dtype=np.uint8).reshape(4, 3)
+        pnts = threedtiles.pnts_from_arrays(positions, colors, [1, 2, 3])
+
+        header = struct.unpack('<4s6I', pnts[:28])
+        cls.assertEqual(header[0], b'pnts')
+        cls.assertEqual(header[2], len(pnts))
+        cls.assertEqual((28 + header[3]) % 8, 0)
+        cls.assertEqual(header[4] % 8, 0)
+
+        ft = json.loads(pnts[28:28 + header[3]].decode('utf-8'))
+        cls.assertEqual(ft['POINTS_LENGTH'], 4)
+        cls.assertEqual(ft['RTC_CENTER'], [1, 2, 3])
+
+        body = pnts[28 + header[3]:]
+        pos = np.frombuffer(body, dtype=np.float32, count=12)
+        cls.assertTrue((pos == positions.ravel()).all())
+        rgb = np.frombuffer(body, dtype=np.uint8, count=12,
+                            offset=ft['RGB']['byteOffset'])
+        cls.assertTrue((rgb == colors.ravel()).all())
+
+    def test_tileset_page(cls):
+        counts = [{(0, 0, 0): 10},
+                  {(0, 0, 0): 5},
+                  {(1, 1, 0): 2, (3, 3, 3): 1},
+                  {(7, 7, 7): 1}]
+        index = greyhound.NodeIndex([0, 0, 0, 8, 8, 8], counts)
+
+        page = threedtiles.tileset_page(index, 0, (0, 0, 0), 2)
+        root = page['root']
+        cls.assertEqual(root['refine'], 'add')
+        cls.assertEqual(root['boundingVolume']['box'],
+                        [4, 4, 4, 4, 0, 0, 0, 4, 0, 0, 0, 4])
+        cls.assertTrue(root['content']['url'].startswith(
+            'read.pnts?lod=0&bounds=[0.0,0.0,0.0,8.0,8.0,8.0]&'
+            'offsets=[4.0,4.0,4.0]'))
+
+        # nodes at lod 1 without points have no content, children are in
+        # the order of greyhound.OCTANTS
+        [child1, child0] = root['children']
+        cls.assertIn('content', child0)
+        cls.assertNotIn('content', child1)
+
+        # nodes at lod 2 are external tilesets, leaves excepted
+        [leaf] = child0['children']
+        cls.assertNotIn('children', leaf)
+        cls.assertTrue(leaf['content']['url'].startswith('read.pnts?lod=2'))
+        [link] = child1['children']
+        cls.assertEqual(link['content']['url'],
+                        'tileset.json?lod=2&bounds=[6.0,6.0,6.0,8.0,8.0,8.0]')
+        cls.assertNotIn('children', link)
+
+        page = threedtiles.tileset_page(index, 2, (3, 3, 3), 2)
+        cls.assertEqual(page['geometricError'],
+                        threedtiles.geometric_error(1))
+        cls.assertTrue(page['root']['content']['url'].startswith(
+            'read.pnts?lod=2&bounds=[6.0,6.0,6.0,8.0,8.0,8.0]'))
+        [child] = page['root']['children']
+        cls.assertTrue(child['content']['url'].startswith('read.pnts?lod=3'))
+
+    def test_tileset_arguments(cls):
+        index = greyhound.NodeIndex([0, 0, 0, 8, 8, 8],
+                                    [{(0, 0, 0): 10}, {(1, 1, 1): 10}])
+        tileset = threedtiles.ThreeDTilesTileset()
+
+        with mock.patch.object(greyhound.NodeIndex, 'get',
+                               return_value=index) as get, \
+                mock.patch.object(Cache, 'threedtiles', LRUCache(4096)):
+            page = tileset.tileset({'lod': 1, 'bounds': '[4,4,4,8,8,8]'})
+            cls.assertIsNotNone(page)
+            for args in [{'lod': -1, 'bounds': None},
+                         {'lod': 1, 'bounds': '[4,4,4,8,8]'},
+                         {'lod': 1, 'bounds': '[4,4,4,8,8,x]'},
+                         {'lod': 2, 'bounds': '[4,4,4,8,8,8]'}]:
+                cls.assertIsNone(tileset.tileset(args))
+
+            # the index was built again for a new version of the table
+            get.return_value = greyhound.NodeIndex(
+                [0, 0, 0, 8, 8, 8],
+                [{(0, 0, 0): 10}, {(1, 1, 1): 10}, {(3, 3, 3): 1}], '[2]')
+            cls.assertNotEqual(
+                tileset.tileset({'lod': 1, 'bounds': '[4,4,4,8,8,8]'}), page)
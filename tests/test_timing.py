@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from lopocs import timing
+from lopocs.conf import Config
+
+
+class TestTiming(unittest.TestCase):
+
+    def test_header(cls):
+        # no request: spans are ignored
+        with timing.span('database'):
+            pass
+
+        timings = timing.begin('greyhound_read')
+        with timing.span('database'):
+            pass
+        with timing.span('encode'):
+            pass
+        with timing.span('database'):
+            pass
+        headers = {}
+        timing.end(timings, headers)
+
+        names = [metric.split(';')[0]
+                 for metric in headers['Server-Timing'].split(', ')]
+        cls.assertEqual(names, ['database', 'encode', 'total'])
+        cls.assertEqual(headers['Timing-Allow-Origin'], '*')
+        cls.assertIsNone(timing.current())
+
+    def test_profiled(cls):
+        [rate, root] = [Config.PROFILE_RATE, Config.PROFILE_DIR]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            Config.PROFILE_DIR = tmpdir
+            try:
+                Config.PROFILE_RATE = 0
+                with timing.profiled('3dtiles_read'):
+                    pass
+                cls.assertEqual(os.listdir(tmpdir), [])
+
+                Config.PROFILE_RATE = 1
+                with timing.profiled('3dtiles_read'):
+                    # not profiled while another request is
+                    with timing.profiled('greyhound_read'):
+                        sum(range(1000))
+                [profile] = os.listdir(tmpdir)
+                cls.assertTrue(profile.startswith('3dtiles_read_'))
+                cls.assertTrue(profile.endswith('.prof'))
+            finally:
+                [Config.PROFILE_RATE, Config.PROFILE_DIR] = [rate, root]
@@ -1,3 +1,7 @@
+import os
+import stat
+import struct
+import tempfile
 import unittest
 from lopocs import utils
 
@@ -25,3 +29,25 @@ class TestUtils(unittest.TestCase):
         str_box = 'BOX(1 2 3 4)'
         l_box = utils.list_from_str_box(str_box)
         cls.assertEqual(l_box, [1, 2, 3, 4])
+
+    def test_wkb_pcpatch(cls):
+        # laz patch of 3 points with 4 bytes of data
+        wkb = struct.pack('<BIIII', 1, 2, 2, 3, 4) + b'laz!'
+        cls.assertEqual(utils.npoints_from_wkb_pcpatch(wkb), 3)
+        cls.assertEqual(bytes(utils.lazdata_from_wkb_pcpatch(wkb)), b'laz!')
+
+        # uncompressed patch in big endian
+        wkb = struct.pack('>BIII', 0, 2, 0, 1) + b'raw'
+        cls.assertEqual(utils.npoints_from_wkb_pcpatch(wkb), 1)
+        cls.assertEqual(bytes(utils.rawdata_from_wkb_pcpatch(wkb)), b'raw')
+
+    def test_write_atomic(cls):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'tile')
+            utils.write_atomic(path, b'data')
+
+            with open(path, 'rb') as f:
+                cls.assertEqual(f.read(), b'data')
+            cls.assertEqual(stat.S_IMODE(os.stat(path).st_mode),
+                            0o666 & ~utils.UMASK)
+            cls.assertEqual(os.listdir(tmpdir), ['tile'])
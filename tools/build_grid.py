@@ -17,7 +17,7 @@ def get_infos():
     infos = {}
     infos.update(Session.boundingbox2d())
 
-    sql = "select count(*) from {0}".format(Session.column)
+    sql = "select count(*) from {0}".format(Session.table)
     infos['npatchs'] = Session.query_aslist(sql)[0]
 
     infos['dx'] = infos['xmax'] - infos['xmin']
@@ -114,7 +114,7 @@ def store_grid(grid_gen):
            "revert_morton integer,"
            "patchs_ids integer[],"
            "col integer, row integer)".format(pcid_schema))
-    Session.db.cursor().execute(sql)
+    Session.execute(sql)
 
     for cell in grid_gen:
         # build a cell (cube with a center)
@@ -148,48 +148,75 @@ def store_grid(grid_gen):
 
         # fill the database
         rows = [str(morton_revert), hexa, str(cell[6]), str(cell[7])]
-        Session.db.cursor().copy_from(
-            io.StringIO('\t'.join(rows)), 'grid',
-            columns=('revert_morton', 'cells', 'col', 'row'))
+        with Session.connection() as conn:
+            conn.cursor().copy_from(
+                io.StringIO('\t'.join(rows)), 'grid',
+                columns=('revert_morton', 'cells', 'col', 'row'))
 
 
 def build_index_by_morton(infos, side_x, side_y):
     # add an index column
     sql = ("ALTER TABLE {0} drop column if exists morton;"
            "ALTER TABLE {0} add column morton integer"
-           .format(Session.column)
+           .format(Session.table)
            )
-    Session.db.cursor().execute(sql)
-
-    for n in range(0, infos['npatchs']):
-        print("{0}/{1}\r".format(n, infos['npatchs']), end='')
+    Session.execute(sql)
+
+    # retrieve the extent of all the patchs at once
+    sql = ("select id, pc_patchmin({0}, 'x') as xmin, "
+           "pc_patchmin({0}, 'y') as ymin "
+           "from {1}"
+           .format(Session.column, Session.table))
+    res = np.array(Session.query(sql), dtype=np.float64).reshape(-1, 3)
+    print("{0} patchs".format(len(res)))
+
+    ids = res[:, 0].astype(np.int64)
+    center_x = res[:, 1] + side_x/2
+    center_y = res[:, 2] + side_y/2
+
+    col = np.floor((center_x - infos['xmin']) / side_x).astype(np.int64)
+    row = np.floor((center_y - infos['ymin']) / side_y).astype(np.int64)
+
+    morton = morton_revert_codes(col, row)
+
+    # load codes in a temporary table and update patchs with a join
+    codes = io.StringIO(''.join('{0}\t{1}\n'.format(i, m)
+                                for i, m in zip(ids.tolist(),
+                                                morton.tolist())))
+
+    with Session.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("create temporary table morton_codes"
+                    "(id integer, morton integer)")
+        try:
+            cur.copy_from(codes, 'morton_codes', columns=('id', 'morton'))
+            cur.execute("update {0} set morton = morton_codes.morton "
+                        "from morton_codes where {0}.id = morton_codes.id"
+                        .format(Session.table))
+        finally:
+            cur.execute("drop table morton_codes")
 
-        sql = ("select pc_patchmin({0}, 'x') as xmin, "
-               "pc_patchmax({0}, 'x') as xmax, "
-               "pc_patchmin({0}, 'y') as ymin, "
-               "pc_patchmax({0}, 'y') as ymax "
-               "from {1} where id = {2}"
-               .format(Session.column, Session.table, n+1))
-        res = Session.query_asdict(sql)[0]
 
-        center_x = float(res['xmin']) + side_x/2
-        center_y = float(res['ymin']) + side_y/2
+def morton_revert_codes(x, y):
+    """
+    Vectorized version of morton_revert_code for arrays of columns and rows
+    """
+    mcode = interleave(np.array(x, dtype=np.int64)) | \
+        (interleave(np.array(y, dtype=np.int64)) << 1)
 
-        #col = math.floor((float(res['xmin']) - infos['xmin']) / side)
-        #row = math.floor((float(res['ymin']) - infos['ymin']) / side)
-        col = math.floor((center_x - infos['xmin']) / side_x)
-        row = math.floor((center_y - infos['ymin']) / side_y)
+    # the code is reverted on 16 bits at least as in morton_revert_code
+    nbits = np.maximum(np.frexp(mcode)[1], 16)
 
-        morton = morton_revert_code(col, row)
+    mcode_revert = np.zeros_like(mcode)
+    for bit in range(0, 32):
+        mcode_revert |= ((mcode >> bit) & 1) << (31 - bit)
 
-        sql = ("update pa set morton = {0}"
-               " where id = {1}".format(morton, n+1))
-        Session.db.cursor().execute(sql)
+    return mcode_revert >> (32 - nbits)
 
 
 def create_index():
-    sql = "create index on pa(morton);"
-    Session.db.cursor().execute(sql)
+    sql = "create index on {0}(morton);".format(Session.table)
+    Session.execute(sql)
 
 
 if __name__ == '__main__':
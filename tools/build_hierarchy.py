@@ -2,14 +2,71 @@
 
 import yaml
 import argparse
+import multiprocessing
 import os
 import sys
-import json
+import time
 
 from lopocs.database import Session
+from lopocs.conf import Config
 from lopocs import greyhound
+from lopocs.metadata import Metadata
 from lopocs import threedtiles
 
+# name of the children returned by threedtiles.split_bbox
+SPLIT_BBOX_NAMES = ['nwd', 'nwu', 'ned', 'neu', 'swd', 'swu', 'sed', 'seu']
+
+
+def init_session(config):
+    app = type('', (), {})()
+    app.config = config
+
+    # open database
+    Session.init_app(app)
+    Config.init(config)
+
+
+def greyhound_subtree(bbox, cell, lod_max):
+    return greyhound.count_subtree(bbox, 1, cell, lod_max)
+
+
+def threedtiles_subtree(baseurl, lod_max, offsets, bbox):
+    return threedtiles.children(baseurl, lod_max, offsets, bbox, 1)
+
+
+def run_job(job):
+    name, func, args = job
+    t0 = time.time()
+    result = func(*args)
+    return [name, result, time.time() - t0]
+
+
+def run_subtrees(jobs, njobs, config):
+    """
+    Builds each subtree in a pool of njobs processes, each one with its
+    own connection to the database, and yields them as they are done
+    """
+    if njobs > 1:
+        # spawn new processes rather than forking to not share the
+        # connections of this one
+        ctx = multiprocessing.get_context('spawn')
+        pool = ctx.Pool(njobs, initializer=init_session, initargs=(config,))
+        results = pool.imap_unordered(run_job, jobs)
+    else:
+        pool = None
+        results = map(run_job, jobs)
+
+    t0 = time.time()
+    for n, [name, result, elapsed] in enumerate(results):
+        print("[{0}/{1}] subtree {2} built in {3:.1f}s ({4:.1f}s elapsed)"
+              .format(n+1, len(jobs), name, elapsed, time.time() - t0))
+        yield [name, result]
+
+    if pool:
+        pool.close()
+        pool.join()
+
+
 if __name__ == '__main__':
 
     # arg parse
@@ -28,6 +85,10 @@ if __name__ == '__main__':
     baseurl_help = "Base URL of the lopocs instance to use"
     parser.add_argument('u', metavar='u', type=str, help=baseurl_help)
 
+    jobs_help = ("Number of processes building the subtrees of the root "
+                 "in parallel")
+    parser.add_argument('--jobs', '-j', type=int, default=1, help=jobs_help)
+
     args = parser.parse_args()
 
     # open config file
@@ -40,14 +101,13 @@ if __name__ == '__main__':
             f.close()
             sys.exit()
 
-    app = type('', (), {})()
-    app.config = ymlconf_db
-
-    # open database
-    Session.init_app(app)
+    init_session(ymlconf_db)
 
     # build the hierarchy
-    fullbbox = Session.boundingbox()
+    if Config.BB:
+        fullbbox = Config.BB
+    else:
+        fullbbox = Session.boundingbox()
     bbox = [fullbbox['xmin'], fullbbox['ymin'], fullbbox['zmin'],
             fullbbox['xmax'], fullbbox['ymax'], fullbbox['zmax']]
 
@@ -55,23 +115,43 @@ if __name__ == '__main__':
 
     lod_min = 0
     lod_max = ymlconf_db['DEPTH']-1
-    bbox_str = '_'.join(str(e) for e in bbox)
-
-    if args.t == "greyhound":
-        h = greyhound.build_hierarchy_from_pg(lod_max, bbox, lod_min)
 
-        name = ("{0}_{1}_{2}_{3:.3f}_{4:.3f}_{5:.3f}_{6:.3f}_{7:.3f}_"
-                "{8:.3f}.hcy"
-                .format(ymlconf_db['PG_NAME'], lod_min, lod_max, bbox[0],
-                        bbox[1], bbox[2], bbox[3], bbox[4], bbox[5]))
+    t0 = time.time()
 
+    if args.t == "greyhound":
+        # taken before counting so that changes meanwhile are seen by
+        # the workers, which build the index again
+        signature = greyhound.NodeIndex.signature_of(
+            Metadata.table_signature())
+        counts = greyhound.count_subtree(bbox, 0, (0, 0, 0), 0)
+        for lod in range(1, lod_max + 1):
+            counts[lod] = {}
+
+        if lod_max > 0:
+            jobs = [[name, greyhound_subtree, [bbox, cell, lod_max]]
+                    for name, cell in greyhound.OCTANTS]
+            for name, subtree in run_subtrees(jobs, args.jobs, ymlconf_db):
+                for lod, cells in subtree.items():
+                    counts[lod].update(cells)
+
+        index = greyhound.NodeIndex(
+            bbox, [counts[lod] for lod in range(0, lod_max + 1)], signature)
+
+        name = os.path.basename(greyhound.NodeIndex.filename())
         path = os.path.join(args.outdir, name)
-        f = open(path, 'w')
-        f.write(json.dumps(h))
-        f.close()
+        index.save(path)
     else:
         baseurl = args.u
-        h = threedtiles.build_hierarchy_from_pg(baseurl, lod_max, bbox, lod_min)
+        offsets = threedtiles.bbox_center(bbox)
+        jobs = [[name, threedtiles_subtree, [baseurl, lod_max, offsets, bb]]
+                for name, bb in zip(SPLIT_BBOX_NAMES,
+                                    threedtiles.split_bbox(bbox, 1))]
+
+        subtrees = dict(run_subtrees(jobs, args.jobs, ymlconf_db))
+        children_list = [subtrees[name] for name in SPLIT_BBOX_NAMES
+                         if len(subtrees[name])]
+
+        h = threedtiles.build_tileset(baseurl, bbox, lod_min, children_list)
         name = "tileset.json"
 
         path = os.path.join(args.outdir, name)
@@ -79,4 +159,4 @@ if __name__ == '__main__':
         f.write(h)
         f.close()
 
-#    print(h)
+    print("hierarchy built in {0:.1f}s".format(time.time() - t0))
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import yaml
+import sys
+import time
+import argparse
+
+from lopocs.database import Session
+from lopocs.conf import Config
+from lopocs.greyhound import lod_table, points_range
+
+
+def build_lod_table(lod, schema_pcid):
+    """
+    Materializes the points of lod of each patch, transformed to
+    schema_pcid, in a table joined with the patchs on their id. Points
+    are stored uncompressed: reads filter them on Z and compress them
+    with laz, a laz storage would be decompressed on each read.
+    """
+    [beg, n] = points_range(lod)
+    points = "pc_patchtransform(pc_range({0}, {1}, {2}), {3})".format(
+        Session.column, beg, n, schema_pcid)
+
+    name = lod_table(lod, schema_pcid)
+    sql = ("drop table if exists {0};"
+           "create table {0} as select id, {1} as points from {2} "
+           "where pc_numpoints({3}) > {4};"
+           "create index on {0}(id);"
+           "analyze {0};"
+           .format(name, points, Session.table, Session.column, beg))
+    Session.execute(sql)
+
+
+if __name__ == '__main__':
+
+    # arg parse
+    descr = ('Materialize the points of each level of detail in a table '
+             'per lod and per output schema (USE_LOD_TABLES). Points are '
+             'stored uncompressed, reads still compress them with laz but '
+             'no longer select their range nor transform them')
+    parser = argparse.ArgumentParser(description=descr)
+
+    cfg_help = 'configuration file for the database'
+    parser.add_argument('cfg', metavar='cfg', type=str, help=cfg_help)
+
+    args = parser.parse_args()
+
+    # open config file
+    ymlconf_db = None
+    with open(args.cfg, 'r') as f:
+        try:
+            ymlconf_db = yaml.load(f)['flask']
+        except:
+            print("ERROR: ", sys.exc_info()[0])
+            f.close()
+            sys.exit()
+
+    app = type('', (), {})()
+    app.config = ymlconf_db
+
+    # open database
+    Session.init_app(app)
+    Config.init(ymlconf_db)
+
+    pcids = sorted(set([Config.POTREE_SCH_PCID_SCALE_01,
+                        Config.POTREE_SCH_PCID_SCALE_001]))
+    for schema_pcid in pcids:
+        for lod in range(0, Config.DEPTH):
+            start = time.time()
+            build_lod_table(lod, schema_pcid)
+            print("{0}: {1:.1f}s".format(lod_table(lod, schema_pcid),
+                                         time.time() - start))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import yaml
+import sys
+import io
+import argparse
+import numpy as np
+
+from lopocs.database import Session
+from lopocs.conf import Config
+from lopocs.octree import OCTREE_TABLE, patch_keys
+
+
+def add_columns():
+    sql = ("ALTER TABLE {0} drop column if exists octree_level;"
+           "ALTER TABLE {0} drop column if exists octree_key;"
+           "ALTER TABLE {0} add column octree_level smallint;"
+           "ALTER TABLE {0} add column octree_key bigint;"
+           .format(Session.table))
+    for dim in ['xmin', 'ymin', 'zmin', 'xmax', 'ymax', 'zmax']:
+        sql += ("ALTER TABLE {0} drop column if exists octree_{1};"
+                "ALTER TABLE {0} add column octree_{1} float8;"
+                .format(Session.table, dim))
+    Session.execute(sql)
+
+
+def build_keys(bbox, depth):
+    # retrieve the extent of all the patchs at once
+    sql = ("select id, "
+           "pc_patchmin({0}, 'x'), pc_patchmin({0}, 'y'), "
+           "pc_patchmin({0}, 'z'), pc_patchmax({0}, 'x'), "
+           "pc_patchmax({0}, 'y'), pc_patchmax({0}, 'z') "
+           "from {1}"
+           .format(Session.column, Session.table))
+    res = np.array(Session.query(sql), dtype=np.float64).reshape(-1, 7)
+    print("{0} patchs".format(len(res)))
+
+    ids = res[:, 0].astype(np.int64)
+    [levels, keys] = patch_keys(bbox, depth, res[:, 1:4], res[:, 4:7])
+    print("patchs per level: {0}".format(
+        np.bincount(levels, minlength=depth+1).tolist()))
+
+    # load keys in a temporary table and update patchs with a join
+    rows = io.StringIO()
+    for i, level, key, extent in zip(ids.tolist(), levels.tolist(),
+                                     keys.tolist(), res[:, 1:7].tolist()):
+        rows.write('\t'.join(str(v) for v in [i, level, key] + extent))
+        rows.write('\n')
+    rows.seek(0)
+
+    columns = ('id', 'octree_level', 'octree_key',
+               'octree_xmin', 'octree_ymin', 'octree_zmin',
+               'octree_xmax', 'octree_ymax', 'octree_zmax')
+
+    with Session.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("create temporary table octree_keys"
+                    "(id integer, octree_level smallint, octree_key bigint,"
+                    "octree_xmin float8, octree_ymin float8, "
+                    "octree_zmin float8, octree_xmax float8, "
+                    "octree_ymax float8, octree_zmax float8)")
+        try:
+            cur.copy_from(rows, 'octree_keys', columns=columns)
+            cur.execute("update {0} set {1} from octree_keys "
+                        "where {0}.id = octree_keys.id"
+                        .format(Session.table,
+                                ', '.join('{0} = octree_keys.{0}'.format(c)
+                                          for c in columns[1:])))
+        finally:
+            cur.execute("drop table octree_keys")
+
+
+def create_index():
+    sql = ("create index on {0}(octree_key);"
+           "analyze {0};".format(Session.table))
+    Session.execute(sql)
+
+
+def store_octree(bbox, depth):
+    sql = ("create table if not exists {0}("
+           "tablename text primary key, "
+           "xmin float8, ymin float8, zmin float8, "
+           "xmax float8, ymax float8, zmax float8, "
+           "depth integer);"
+           "delete from {0} where tablename = %s;"
+           "insert into {0} values (%s, %s, %s, %s, %s, %s, %s, %s)"
+           .format(OCTREE_TABLE))
+    Session.execute(sql, [Session.table, Session.table] + bbox + [depth])
+
+
+if __name__ == '__main__':
+
+    # arg parse
+    descr = ('Compute an octree key for each patch so that patchs are '
+             'selected with btree range scans (USE_OCTREE_KEY)')
+    parser = argparse.ArgumentParser(description=descr)
+
+    cfg_help = 'configuration file for the database'
+    parser.add_argument('cfg', metavar='cfg', type=str, help=cfg_help)
+
+    depth_help = 'depth of the octree (21 at most)'
+    parser.add_argument('--depth', type=int, default=16, help=depth_help)
+
+    args = parser.parse_args()
+
+    # open config file
+    ymlconf_db = None
+    with open(args.cfg, 'r') as f:
+        try:
+            ymlconf_db = yaml.load(f)['flask']
+        except:
+            print("ERROR: ", sys.exc_info()[0])
+            f.close()
+            sys.exit()
+
+    app = type('', (), {})()
+    app.config = ymlconf_db
+
+    # open database
+    Session.init_app(app)
+    Config.init(ymlconf_db)
+
+    # the octree covers the bounding box of the dataset
+    if Config.BB:
+        box = Config.BB
+    else:
+        box = Session.boundingbox()
+    bbox = [box['xmin'], box['ymin'], box['zmin'],
+            box['xmax'], box['ymax'], box['zmax']]
+
+    add_columns()
+    build_keys(bbox, args.depth)
+    create_index()
+    store_octree(bbox, args.depth)
@@ -8,15 +8,35 @@ flask:
     PG_PASSWORD: !PWD!
     PG_COLUMN: !TABLE!
     PG_TABLE: !TABLE!
+    PG_POOL_MINCONN: 1
+    PG_POOL_MAXCONN: 4
+    # connections used at once by streamed greyhound reads, at most
+    # PG_POOL_MAXCONN - 1 so that tiles are still read
+    PG_POOL_STREAMS: 1
     DEPTH: !LODMAX!
     BB: [!XMIN!, !YMIN!, !ZMIN!, !XMAX!, !YMAX!, !ZMAX!]
     MAX_PATCHS_PER_QUERY: 1024
 #    MAX_POINTS_PER_PATCH: 1
     USE_MORTON: True
+    USE_OCTREE_KEY: False
+    USE_LOD_TABLES: False
     CACHE_DIR: /home/!USER!/.cache/lopocs/
     POTREE_SCH_PCID_SCALE_01: 2
     POTREE_SCH_PCID_SCALE_001: 3
-    STATS: False
-    STATS_SERVER_PORT: 6379
+    GREYHOUND_CACHE_SIZE: 67108864
+    THREEDTILES_CACHE_SIZE: 67108864
+    GREYHOUND_STREAM_BATCH: 100
+    TILESET_LEVELS: 3
+    TILE_STORE_SIZE: 1073741824
+    TILE_STORE_SENDFILE: send_file
+    METRICS: True
+    METRICS_FLUSH_INTERVAL: 5
+    SERVER_TIMING: True
+    PROFILE_RATE: 0
+    SLOW_QUERY_THRESHOLD: 1.0
+    # share of the slow queries run again with explain (analyze, buffers)
+    # on a connection of their own to log their plan, each one costs as
+    # much as the query itself (0 to disable)
+    SLOW_QUERY_EXPLAIN_RATE: 0
 
 #    CESIUM_COLOR: classif
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import yaml
+import sys
+import argparse
+
+from lopocs.database import Session
+from lopocs.conf import Config
+from lopocs.metadata import Metadata
+
+
+if __name__ == '__main__':
+
+    # arg parse
+    descr = ('Compute the metadata of the dataset served by the info '
+             'endpoints again, running workers reload them')
+    parser = argparse.ArgumentParser(description=descr)
+
+    cfg_help = 'configuration file for the database'
+    parser.add_argument('cfg', metavar='cfg', type=str, help=cfg_help)
+
+    args = parser.parse_args()
+
+    # open config file
+    ymlconf_db = None
+    with open(args.cfg, 'r') as f:
+        try:
+            ymlconf_db = yaml.load(f)['flask']
+        except:
+            print("ERROR: ", sys.exc_info()[0])
+            f.close()
+            sys.exit()
+
+    app = type('', (), {})()
+    app.config = ymlconf_db
+
+    # open database
+    Session.init_app(app)
+    Config.init(ymlconf_db)
+
+    Metadata.refresh()
+    print(Metadata.values)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import yaml
+import argparse
+import multiprocessing
+import sys
+import time
+import numpy as np
+
+from lopocs.database import Session
+from lopocs.conf import Config
+
+# number of patchs processed by a job
+BATCH_SIZE = 100
+
+
+def progressive_order(points):
+    """
+    Returns the order of points, an (n, 2) or (n, 3) array of coordinates,
+    such that the 4^i points of each lod (see greyhound.points_range) are
+    a uniform sample of the patch.
+
+    The points of a lod are taken in a regular grid of 2^lod x 2^lod cells
+    over the extent of the patch: first the point nearest to the center of
+    each cell, then the next nearest ones of the cells with points left
+    until 4^lod points are taken.
+    """
+    npoints = len(points)
+    xy = np.asarray(points, dtype=np.float64)[:, 0:2]
+    pmin = xy.min(axis=0)
+    size = np.maximum(xy.max(axis=0) - pmin, 1e-9)
+    # shuffle with a fixed seed so that reorderings are reproducible and
+    # the points taken in a partial round are spread over the cells
+    noise = np.random.RandomState(0).permutation(npoints)
+
+    left = np.arange(npoints)
+    order = []
+    lod = 0
+    while len(left):
+        side = pow(2, lod)
+        quota = pow(4, lod)
+
+        pos = (xy[left] - pmin) / size * side
+        cell = np.minimum(pos.astype(np.int64), side - 1)
+        dist = ((pos - cell - 0.5) ** 2).sum(axis=1)
+        cell = cell[:, 0] * side + cell[:, 1]
+
+        # rank of each point in its cell, nearest to the center first
+        s = np.lexsort((dist, cell))
+        first = np.searchsorted(cell[s], cell[s], side='left')
+        rank = np.empty(len(left), dtype=np.int64)
+        rank[s] = np.arange(len(left)) - first
+
+        taken = np.lexsort((noise[left], rank))[:quota]
+        order.append(left[taken])
+        left = np.delete(left, taken)
+        lod += 1
+
+    return np.concatenate(order)
+
+
+def patch_ids():
+    sql = "select id from {0} order by id".format(Session.table)
+    return [r[0] for r in Session.query(sql)]
+
+
+def reorder_patchs(ids):
+    sql = ("select id, array_agg(pc_get(pt, 'x') order by i), "
+           "array_agg(pc_get(pt, 'y') order by i) "
+           "from {0}, lateral pc_explode({1}) with ordinality e(pt, i) "
+           "where id = any(%s) group by id"
+           .format(Session.table, Session.column))
+
+    update = ("update {0} set {1} = ("
+              "select pc_patch(pt order by o.n) "
+              "from pc_explode({1}) with ordinality e(pt, i) "
+              "join unnest(%s::integer[]) with ordinality o(i, n) using (i)) "
+              "where id = %s"
+              .format(Session.table, Session.column))
+
+    for [pid, x, y] in Session.query(sql, [ids]):
+        # pc_explode numbers points from 1
+        order = progressive_order(np.column_stack([x, y])) + 1
+        Session.execute(update, [order.tolist(), pid])
+
+    return len(ids)
+
+
+def init_session(config):
+    app = type('', (), {})()
+    app.config = config
+
+    # open database
+    Session.init_app(app)
+    Config.init(config)
+
+
+if __name__ == '__main__':
+
+    # arg parse
+    descr = ('Reorder the points of each patch so that the first points '
+             'read for a lod are a uniform sample of the patch')
+    parser = argparse.ArgumentParser(description=descr)
+
+    cfg_help = 'configuration file for the database'
+    parser.add_argument('cfg', metavar='cfg', type=str, help=cfg_help)
+
+    jobs_help = 'Number of processes reordering patchs in parallel'
+    parser.add_argument('--jobs', '-j', type=int, default=1, help=jobs_help)
+
+    args = parser.parse_args()
+
+    # open config file
+    ymlconf_db = None
+    with open(args.cfg, 'r') as f:
+        try:
+            ymlconf_db = yaml.load(f)['flask']
+        except:
+            print("ERROR: ", sys.exc_info()[0])
+            f.close()
+            sys.exit()
+
+    init_session(ymlconf_db)
+
+    ids = patch_ids()
+    batches = [ids[i:i + BATCH_SIZE] for i in range(0, len(ids), BATCH_SIZE)]
+
+    if args.jobs > 1:
+        # spawn new processes rather than forking to not share the
+        # connections of this one
+        ctx = multiprocessing.get_context('spawn')
+        pool = ctx.Pool(args.jobs, initializer=init_session,
+                        initargs=(ymlconf_db,))
+        results = pool.imap_unordered(reorder_patchs, batches)
+    else:
+        pool = None
+        results = map(reorder_patchs, batches)
+
+    t0 = time.time()
+    done = 0
+    for n in results:
+        done += n
+        print("{0}/{1}\r".format(done, len(ids)), end='')
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    print("\n{0} patchs reordered in {1:.1f}s"
+          .format(len(ids), time.time() - t0))